@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+
+# A micro-benchmark for watchless, a Python script which emulates the Unix
+# watch program and adds paging support similar to that of the less program.
+# Runs largeoutput.py at increasing sizes through WatchLess.process_command()
+# and fills a LineStore with the output the same way the display does, timing
+# how long it takes. The time per line should stay roughly constant as the
+# size of the output grows; a growing time per line indicates reallocations
+# whose cost depends on the amount of output already stored.
+#
+# Usage: benchgrowth.py [size ...]
+
+import os.path
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+from watchless import LineStore, WatchLess
+
+def fill(wl, store):
+    """Run the command once and add its output to the store, returning the
+    time spent adding output."""
+    spent = 0.0
+    wl.scheduler.next_run = None
+    wl.process_command()
+    while True:
+        rcode, output = wl.process_command()
+        start = time.time()
+        if wl.color or wl.differences:
+            for line in output:
+                store.append(wl.process_escape_codes(line)[1])
+        else:
+            store.extend(output)
+        spent += time.time() - start
+        if rcode is not None:
+            return spent
+        time.sleep(0.001)
+
+sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+generator = [sys.executable, os.path.join(here, 'largeoutput.py')]
+
+for color in (False, True):
+    sys.stdout.write('color=%s\n' % color)
+    for size in sizes:
+        wl = WatchLess(generator + [str(size)], color=color)
+        store = LineStore()
+        spent = fill(wl, store)
+        sys.stdout.write('  %8d lines  width %5d  %7.3fs  %6.0fns/line\n' %
+                         (len(store), store.width, spent, spent / size * 1e9))
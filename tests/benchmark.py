@@ -0,0 +1,430 @@
+#!/usr/bin/env python
+
+# A benchmark suite for watchless, a Python script which emulates the Unix
+# watch program and adds paging support similar to that of the less program.
+# Drives WatchLess through a set of scripted workloads (large outputs, wide
+# lines, heavy ANSI colour, high-churn differences, unchanged output, lines
+# shifting down as new ones are added, and a real command at a short interval)
+# on a real curses screen attached to a pseudo-terminal, and reports for each
+# run the time spent parsing the output, highlighting differences and
+# rendering it, the memory allocated, and the number of bytes written to the
+# terminal.
+#
+# The results are written as JSON, so those from different commits can be
+# compared. Give the results from an earlier run with --compare to print a
+# table of the changes.
+#
+# Usage: benchmark.py [--runs N] [--output FILE] [--compare FILE]
+#                     [--no-alloc] [workload ...]
+
+import curses
+import fcntl
+import json
+import optparse
+import os
+import os.path
+import platform
+import pty
+import select
+import struct
+import subprocess
+import sys
+import termios
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+import watchless
+from watchless import WatchLess, setup_screen
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
+
+# The size of the pseudo-terminal the display is drawn on.
+rows = 50
+cols = 200
+
+def plain_lines(run, count=20000, churn=0.01):
+    """A large plain output, with a small fraction of lines changing on each
+    run."""
+    every = max(int(1 / churn), 1)
+    return ['{0:6d} {1:s} {2:d}'.format(i, 'some fairly typical output text',
+                                        run if i % every == 0 else 0)
+            for i in range(count)]
+
+def wide_lines(run, count=500, width=2000):
+    """Very wide lines, most of which are off the side of the screen."""
+    return [('{0:d}:{1:d} '.format(i, run) * width)[:width]
+            for i in range(count)]
+
+def colour_lines(run, count=3000):
+    """Heavy use of colour: basic, 256-colour and 24-bit colour sequences, plus
+    bold and reset, several times a line."""
+    return ['\033[1;3{0:d}m{1:5d}\033[0m \033[38;5;{2:d}mcolour\033[0m '
+            '\033[48;2;{3:d};40;80mtruecolour\033[0m \033[4munder\033[24m '
+            'run {4:d}'.format(i % 8, i, (i + run) % 256, (i * 7) % 256, run)
+            for i in range(count)]
+
+def churn_lines(run, count=3000):
+    """Output where about half the characters change on every run, to exercise
+    the highlighting of differences."""
+    return [''.join([chr(48 + (i * 31 + j * 7 + run * (j % 2)) % 75)
+                     for j in range(100)]) for i in range(count)]
+
+def same_lines(run, count=5000):
+    """Output which never changes."""
+    return ['{0:6d} unchanging output'.format(i) for i in range(count)]
+
+def shifting_lines(run, count=10000):
+    """A log-like output where a few lines are added near the top on each
+    run, moving the rest down, and one line further down changes."""
+    lines = ['{0:6d} entry logged at step {1:d}'.format(i, i * 3)
+             for i in range(count - 3 * run, count)]
+    lines += ['{0:6d} older entry {1:d}'.format(i, i * 3) for i in range(count)]
+    lines[count // 2] = 'status line {0:d}'.format(run)
+    return lines[:count]
+
+# The workloads: name -> (function generating the lines for each run, keyword
+# arguments for WatchLess). The 'interval' workload runs a real command instead.
+workloads = [
+    ('large', plain_lines, {}),
+    ('wide', wide_lines, {}),
+    ('colour', colour_lines, {'color': True}),
+    ('churn', churn_lines, {'differences': 'sequential'}),
+    ('cumulative', churn_lines, {'differences': 'cumulative'}),
+    ('unchanged', same_lines, {'color': True, 'differences': 'sequential'}),
+    ('shifting', shifting_lines, {'differences': 'sequential'}),
+    ('shiftlines', shifting_lines, {'differences': 'lines'}),
+    ('interval', None, {'interval': 0.05}),
+]
+
+def timed(stats, key, function):
+    """Wrap a function so the time spent in it is added to stats[key]."""
+    def wrapper(*args, **kwargs):
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stats[key] += clock() - start
+    return wrapper
+
+def scripted_run(screen, name, generate, kwargs, runs, report, alloc):
+    """Run a scripted workload: the output of each run is generated in the
+    process and handed straight to the display, so only the work done by
+    watchless itself is measured.
+
+    """
+    wl = WatchLess(['bench', name], history=0, **kwargs)
+    outputs = [generate(i) for i in range(runs + 1)]
+    state = {'run': 0, 'parse': 0.0, 'diff': 0.0}
+
+    def process_command():
+        output = outputs[state['run']]
+        state['run'] += 1
+        wl.header_time = time.localtime()
+        return 0, output
+
+    wl.process_command = process_command
+    wl.highlight_differences = timed(state, 'diff', wl.highlight_differences)
+    wl.highlight_line_changes = timed(state, 'diff',
+                                      wl.highlight_line_changes)
+    wl._process_output = timed(state, 'parse', wl._process_output)
+
+    setup_screen(screen, wl.palette if wl.color else None)
+    wl.start(screen)
+    screen.clear()
+
+    # The first run has nothing to compare against, so isn't counted.
+    for i in range(runs + 1):
+        state['parse'] = state['diff'] = 0.0
+        if alloc:
+            tracemalloc.start()
+        start = clock()
+        wl.update()
+        processed = clock()
+        wl.redraw()
+        if wl.mark_refreshed():
+            screen.noutrefresh()
+            curses.doupdate()
+        end = clock()
+        if alloc:
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if i == 0:
+            report({'type': 'skip'})
+            continue
+        result = {
+            'type': 'run',
+            'total': end - start,
+            'parse': state['parse'] - state['diff'],
+            'diff': state['diff'],
+            'render': end - processed,
+            'refresh_bytes': wl.refresh_bytes,
+        }
+        if alloc:
+            result['alloc_peak'] = peak
+        report(result)
+    wl.close()
+
+def command_run(screen, name, kwargs, runs, report, alloc):
+    """Run a real command through the normal main loop, measuring the time
+    and CPU used for each run from start to display."""
+    generator = [sys.executable, '-c', 'for i in range(200): print(i)']
+    wl = WatchLess(generator, history=0, **kwargs)
+    setup_screen(screen)
+    wl._wakeup = watchless.Wakeup()
+    try:
+        wl.start(screen)
+        done = 0
+        start = clock()
+        cpu = os.times()
+        while done <= runs:
+            while wl.handle_keys():
+                pass
+            finished = wl.finished_at
+            wl.update()
+            wl.redraw()
+            if wl.mark_refreshed():
+                screen.noutrefresh()
+                curses.doupdate()
+            if wl.finished_at != finished:
+                end = clock()
+                cpu_end = os.times()
+                if done:
+                    report({
+                        'type': 'run',
+                        'total': end - start,
+                        'cpu': (cpu_end[0] + cpu_end[1]) - (cpu[0] + cpu[1]),
+                        'refresh_bytes': wl.refresh_bytes,
+                    })
+                else:
+                    report({'type': 'skip'})
+                done += 1
+                start, cpu = end, cpu_end
+            wl.wait_for_events()
+    finally:
+        wl.close()
+        wl._wakeup.close()
+
+def child(selected, runs, alloc, results):
+    """Run the workloads on a curses screen, reporting the results of each
+    run through a pipe."""
+    def report(message):
+        os.write(results, (json.dumps(message) + '\n').encode('ascii'))
+
+    def bench(screen):
+        for name, generate, kwargs in workloads:
+            if name not in selected:
+                continue
+            report({'type': 'workload', 'name': name})
+            if generate is None:
+                command_run(screen, name, kwargs, runs, report, False)
+            else:
+                scripted_run(screen, name, generate, kwargs, runs, report,
+                             False)
+                if alloc:
+                    report({'type': 'alloc'})
+                    scripted_run(screen, name, generate, kwargs, runs,
+                                 report, True)
+        report({'type': 'end'})
+
+    curses.wrapper(bench)
+
+def median(values):
+    values = sorted(values)
+    if not values:
+        return None
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def summarise(runs):
+    """Summarise the per-run results of a workload."""
+    summary = {}
+    keys = set()
+    for run in runs:
+        keys.update(run)
+    for key in sorted(keys):
+        values = [run[key] for run in runs if key in run]
+        summary[key] = {
+            'median': median(values),
+            'mean': sum(values) / float(len(values)),
+            'max': max(values),
+        }
+    return summary
+
+def benchmark(selected, runs, alloc):
+    """Fork a child attached to a pseudo-terminal to run the workloads, and
+    collect its results along with the number of bytes it writes to the
+    terminal for each run.
+
+    """
+    results_r, results_w = os.pipe()
+    pid, master = pty.fork()
+    if pid == 0:
+        os.close(results_r)
+        os.environ.setdefault('TERM', 'xterm-256color')
+        if os.environ['TERM'] in ('', 'dumb'):
+            os.environ['TERM'] = 'xterm-256color'
+        try:
+            child(selected, runs, alloc, results_w)
+        except BaseException:
+            import traceback
+            os.write(results_w, json.dumps({
+                'type': 'error', 'error': traceback.format_exc()
+            }).encode('ascii') + b'\n')
+            os._exit(1)
+        os._exit(0)
+
+    os.close(results_w)
+    fcntl.ioctl(master, termios.TIOCSWINSZ, struct.pack('hhhh', rows, cols,
+                                                         0, 0))
+    flags = fcntl.fcntl(master, fcntl.F_GETFL)
+    fcntl.fcntl(master, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+    def drain():
+        count = 0
+        while True:
+            try:
+                data = os.read(master, 65536)
+            except OSError:
+                break
+            if not data:
+                break
+            count += len(data)
+        return count
+
+    output = {}
+    current = None
+    alloc_pass = False
+    pending = b''
+    terminal_bytes = 0
+    finished = False
+    while not finished:
+        ready = select.select([master, results_r], [], [])[0]
+        if master in ready:
+            terminal_bytes += drain()
+        if results_r not in ready:
+            continue
+        data = os.read(results_r, 65536)
+        if not data:
+            break
+        pending += data
+        while b'\n' in pending:
+            line, pending = pending.split(b'\n', 1)
+            message = json.loads(line.decode('ascii'))
+
+            # Everything the child wrote to the terminal before sending the
+            # message is waiting for us to read.
+            terminal_bytes += drain()
+            kind = message.pop('type')
+            if kind == 'workload':
+                current = output[message['name']] = {'runs': [],
+                                                     'alloc': []}
+                alloc_pass = False
+            elif kind == 'alloc':
+                alloc_pass = True
+            elif kind == 'run':
+                if alloc_pass:
+                    current['alloc'].append(message['alloc_peak'])
+                else:
+                    message['terminal_bytes'] = terminal_bytes
+                    current['runs'].append(message)
+            elif kind == 'error':
+                sys.stderr.write(message['error'])
+                raise SystemExit(1)
+            elif kind == 'end':
+                finished = True
+            terminal_bytes = 0
+
+    os.waitpid(pid, 0)
+    os.close(master)
+    os.close(results_r)
+
+    workloads_out = {}
+    for name, result in output.items():
+        summary = summarise(result['runs'])
+        if result['alloc']:
+            summary['alloc_peak'] = summarise(
+                [{'v': v} for v in result['alloc']])['v']
+        workloads_out[name] = {'summary': summary, 'runs': result['runs']}
+    return workloads_out
+
+def commit():
+    """The commit of the tree being benchmarked, if it can be found."""
+    try:
+        out = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'],
+                               cwd=here, stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE).communicate()[0]
+    except OSError:
+        return None
+    return out.decode('ascii').strip() or None
+
+def compare(old, new):
+    """Print a table comparing the median results of two benchmarks."""
+    sys.stdout.write('{0:12s} {1:16s} {2:>12s} {3:>12s} {4:>8s}\n'.format(
+        'workload', 'measure', old.get('commit') or 'old',
+        new.get('commit') or 'new', 'change'))
+    for name in sorted(new['workloads']):
+        if name not in old['workloads']:
+            continue
+        a = old['workloads'][name]['summary']
+        b = new['workloads'][name]['summary']
+        for key in sorted(b):
+            if key not in a:
+                continue
+            x, y = a[key]['median'], b[key]['median']
+            if x:
+                change = '{0:+7.1f}%'.format((y - x) * 100.0 / x)
+            else:
+                change = ''
+            sys.stdout.write('{0:12s} {1:16s} {2:12.6g} {3:12.6g} {4:>8s}\n'
+                             .format(name, key, x, y, change))
+
+if __name__ == '__main__':
+    names = [name for name, generate, kwargs in workloads]
+    parser = optparse.OptionParser(usage='%prog [options] [workload ...]\n\n'
+                                   'Workloads: ' + ', '.join(names))
+    parser.add_option('--runs', type='int', default=10,
+                      help='runs of each workload [default: %default]')
+    parser.add_option('--output', metavar='FILE',
+                      help='write the results to FILE rather than stdout')
+    parser.add_option('--compare', metavar='FILE',
+                      help='compare with the results in FILE')
+    parser.add_option('--no-alloc', dest='alloc', action='store_false',
+                      default=tracemalloc is not None,
+                      help='skip measuring memory allocations')
+    options, selected = parser.parse_args()
+    for name in selected:
+        if name not in names:
+            parser.error('unknown workload: ' + name)
+
+    results = {
+        'commit': commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'terminal': {'rows': rows, 'cols': cols},
+        'runs': options.runs,
+        'workloads': benchmark(selected or names, options.runs, options.alloc),
+    }
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as f:
+            f.write(text)
+            f.write('\n')
+    elif not options.compare:
+        sys.stdout.write(text)
+        sys.stdout.write('\n')
+
+    if options.compare:
+        with open(options.compare) as f:
+            compare(json.load(f), results)
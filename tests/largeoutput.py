@@ -0,0 +1,21 @@
+#!/usr/bin/env python
+
+# A simple test script for watchless, a Python script which emulates the Unix
+# watch program and adds paging support similar to that of the less program.
+# Outputs a large number of lines (100000 by default, or the number given as
+# the first argument) whose width slowly grows, up to a maximum of 1000
+# characters. This is the worst case for any display which has to be resized
+# to fit the output as it arrives.
+
+import sys
+
+if len(sys.argv) > 1:
+    count = int(sys.argv[1])
+else:
+    count = 100000
+
+step = max(count // 1000, 1)
+for i in range(count):
+    sys.stdout.write('%d ' % i)
+    sys.stdout.write('x' * (i // step))
+    sys.stdout.write('\n')
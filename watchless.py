@@ -17,11 +17,57 @@
 # You should have received a copy of the GNU General Public License along with
 # watchless.  If not, see <http://www.gnu.org/licenses/>.
 
+import binascii
+import bisect
+import collections
+import contextlib
 import curses
+import errno
+import fcntl
+import functools
+import hashlib
+import importlib
+import json
+import math
+import mmap
+import operator
 import optparse
+import os
+import random
+import re
+import select
+import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import termios
+import threading
 import time
+import traceback
+import unicodedata
+import zlib
+from array import array
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+# A clock which is not affected by changes to the system time, used for all
+# scheduling. Python 2 doesn't have one, so falls back to the system time.
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    monotonic = time.time
+
+# A high resolution clock for timing how long things take.
+try:
+    clock = time.perf_counter
+except AttributeError:
+    clock = time.time
 
 # Version information.
 version = '0.2.0'
@@ -29,26 +75,52 @@ version_info = (0, 2, 0, 'final', 0)
 hexversion = 0x000200f0
 
 # Set up a commandline parser.
-usage = """Usage: %prog [options] <command>
+usage = """Usage: %prog [options] <command> [:: [options] <command> ...]
 
-Execute a command periodically and display the output."""
+Execute a command periodically and display the output. Several commands can
+be given, separated by '::', to watch them all at once in separate panes;
+options given before the first command apply to all of them unless a later
+command overrides them."""
 parser = optparse.OptionParser(usage=usage)
 parser.disable_interspersed_args()
 parser.add_option('-n', '--interval', dest="interval", type="float", default=2.0,
                   help="time to wait between updates [default: %defaults]",
                   metavar="seconds")
+parser.add_option('--max-interval', dest="max_interval", type="float",
+                  default=None, metavar="seconds", help="while the output "
+                  "stays the same, double the interval after each run, up to "
+                  "this many seconds; any change in the output, or a key "
+                  "press, goes back to <interval>.")
 parser.add_option('-p', '--precise', dest="precise_mode", action="store_true",
                   help="try to run the command every <interval> seconds, "
                   "rather than using <interval> second gaps between one "
                   "finishing and the next starting", default=False)
+parser.add_option('--overrun', dest="overrun", type="choice",
+                  choices=['skip', 'coalesce', 'burst'], default='coalesce',
+                  help="in precise mode, what to do when a run takes longer "
+                  "than <interval>: 'skip' the missed runs and wait for the "
+                  "next one due, 'coalesce' them into a single run straight "
+                  "away (the default), or 'burst' to run back-to-back until "
+                  "caught up.")
+parser.add_option('--jitter', dest="jitter", type="float", default=0,
+                  metavar="seconds", help="delay each run by a random amount "
+                  "of up to this long.")
+parser.add_option('--align', dest="align", action="store_true",
+                  default=False, help="run at multiples of <interval> on the "
+                  "clock, e.g., on the minute with -n 60. Implies --precise.")
 parser.add_option('-d', '--differences', dest="differences",
                   action="store_true", help="Show differences in output "
                   "between runs. Use --differences=cumulative to show all the "
-                  "positions that have changed since the first run.",
+                  "positions that have changed since the first run, or "
+                  "--differences=lines to match up lines which have moved.",
                   default=False)
 parser.add_option('-c', '--color', dest="color", action="store_true",
-                  default=False, help="Interpret ANSI foreground colour "
+                  default=False, help="Interpret ANSI colour and style "
                   "sequences in the output.")
+parser.add_option('-u', '--show-unchanged', dest="show_unchanged",
+                  action="store_true", default=False, help="show in the "
+                  "header how many runs in a row have had the same output, "
+                  "and since when.")
 parser.add_option('-b', '--beep', dest="beep", action="store_true",
                   default=False, help="Beep when <command> exits with a "
                   "non-zero return code.")
@@ -61,333 +133,3794 @@ parser.add_option('-t', '--no-title', dest="header", action="store_false",
 parser.add_option('-r', '--no-return-code', dest="returncode", action="store_false",
                   help="don't show the last return code in the header at the top of the screen",
                   default=True)
+parser.add_option('-P', '--persistent-shell', dest="persistent",
+                  action="store_true", default=False, help="run the command "
+                  "in one long-lived shell rather than starting a new process "
+                  "for each run.")
+parser.add_option('-y', '--python', dest="python", action="store_true",
+                  default=False, help="<command> is a Python function to call, "
+                  "given as module:function, followed by any string arguments "
+                  "to pass to it.")
+parser.add_option('--timeout', dest="timeout", type="float", default=None,
+                  metavar="seconds", help="give up on a run after this long, "
+                  "killing the command and anything it started.")
+parser.add_option('--history', dest="history", type="float", default=16,
+                  metavar="MiB", help="the memory to use for keeping the "
+                  "output of past runs, which can be stepped through with the "
+                  "[ and ] keys; 0 to keep no history [default: %default]")
+parser.add_option('--max-lines', dest="max_lines", type="int", default=100000,
+                  metavar="N", help="keep at most N lines of each run's "
+                  "output, half from the start and half from the end; 0 for "
+                  "no limit [default: %default]")
+parser.add_option('--max-size', dest="max_size", type="float", default=32,
+                  metavar="MiB", help="keep at most this much of each run's "
+                  "output, half from the start and half from the end; 0 for "
+                  "no limit [default: %default]")
+parser.add_option('--spill', dest="spill", action="store_true", default=False,
+                  help="write the lines left out by --max-lines or "
+                  "--max-size to a temporary file, so they can be paged "
+                  "through with the e key.")
+parser.add_option('--include', dest="include", default=None, metavar="REGEX",
+                  help="show only the lines of output matching REGEX.")
+parser.add_option('--exclude', dest="exclude", default=None, metavar="REGEX",
+                  help="leave out the lines of output matching REGEX.")
+parser.add_option('--columns', dest="columns", default=None, metavar="LIST",
+                  help="show only these whitespace-separated columns of each "
+                  "line, counting from 1, e.g., 1,3-5,7-.")
+parser.add_option('--sort', dest="sort", action="store_true", default=False,
+                  help="sort the lines of output.")
+parser.add_option('--unique', dest="unique", action="store_true",
+                  default=False, help="leave out repeated lines of output.")
+parser.add_option('--stream', dest="stream", type="choice",
+                  choices=['full', 'diff', 'json'], default=None,
+                  help="write to stdout as a stream rather than taking over "
+                  "the terminal: 'full' output of each run, the lines which "
+                  "changed in 'diff' format, or one 'json' object per run. "
+                  "'full' is used if stdout is not a terminal.")
+parser.add_option('--record', dest="record", default=None, metavar="FILE",
+                  help="record the output of every run to FILE (appending to "
+                  "it if it is an existing recording).")
+parser.add_option('--replay', dest="replay", default=None, metavar="FILE",
+                  help="replay a recording made with --record rather than "
+                  "running a command.")
+parser.add_option('--speed', dest="speed", type="float", default=1.0,
+                  help="how many times faster than real time to replay a "
+                  "recording [default: %default]")
+parser.add_option('--seek', dest="seek", default=None, metavar="RUN|TIME",
+                  help="start replaying from a run number, counting from 0, "
+                  "or from the first run finishing at or after a time, given "
+                  "as HH:MM[:SS] or YYYY-MM-DDTHH:MM:SS.")
+parser.add_option('--serve', dest="serve", default=None, metavar="SOCKET",
+                  help="run the command without a display, and serve its "
+                  "output to any number of viewers attached with --attach "
+                  "through the Unix socket SOCKET.")
+parser.add_option('--attach', dest="attach", default=None, metavar="SOCKET",
+                  help="show the output of a command being run by "
+                  "watchless --serve, rather than running it again.")
+parser.add_option('--stats-file', dest="stats_file", default=None,
+                  metavar="FILE", help="on exit, add the timings of each "
+                  "stage of the main loop to FILE as a line of JSON.")
+parser.add_option('--polling', dest="event_loop", action="store_false",
+                  default=True, help="wake up every 10ms to check for keys and "
+                  "output rather than waiting for events (uses more CPU).")
+parser.add_option('--layout', dest="layout", type="choice",
+                  choices=['stacked', 'tiled'], default='stacked',
+                  help="with several commands, how to arrange their panes: "
+                  "'stacked' (the default) or 'tiled'.")
+parser.add_option('--max-running', dest="max_running", type="int",
+                  default=None, metavar="N", help="with several commands, the "
+                  "most which may be running at once.")
 parser.add_option('-v', '--version', action="store_true", default=False,
                   dest="version", help="Show the program version and exit.")
 
+# Flags given before the first of several commands apply to the later ones
+# too; each can be turned off again for one command by its opposite, e.g.,
+# --no-differences or --title.
+overrides = optparse.OptionGroup(parser, "Overriding flags", "With several "
+                                 "commands, flags given before the first "
+                                 "command also apply to the later ones. For "
+                                 "each --FLAG, --no-FLAG turns it off again "
+                                 "for one command, and --title, "
+                                 "--return-code and --no-polling undo the "
+                                 "flags which turn things off.")
+for option in list(parser.option_list):
+    if option.action not in ('store_true', 'store_false') or \
+            option.dest == 'version':
+        continue
+    name = option.get_opt_string()
+    if name.startswith('--no-'):
+        name = '--' + name[5:]
+    else:
+        name = '--no-' + name[2:]
+    overrides.add_option(name, dest=option.dest,
+                         action={'store_true': 'store_false',
+                                 'store_false': 'store_true'}[option.action],
+                         help=optparse.SUPPRESS_HELP)
+parser.add_option_group(overrides)
+
 # List of characters which if present in a command indicate it needs to be run
 # in an external command.
 shell_chars = ('*', '|', '&', '(', '[', ' ')
 
-class WatchLess(object):
-    """The main class which implements the periodic execution and paged display
-    of its output.
+# The maximum number of bytes read from one of the command's pipes in a single
+# call. Reading is done in a loop until the pipe is empty, but this is limited
+# to a few chunks per call so that a command spewing output can't starve the
+# handling of key presses.
+read_size = 65536
+read_chunks = 16
+
+# When a line has to be split up as it is read, this many bytes are left to go
+# with the next part, which is more than the persistent shell's end-of-run
+# marker takes up.
+line_overlap = 64
+
+def set_nonblocking(fd):
+    """Put a file descriptor into non-blocking mode."""
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+
+def wait_readable(fds, timeout):
+    """Wait until at least one of the given file descriptors is readable or
+    the timeout (in seconds; ``None`` to wait forever) expires. Uses poll()
+    where the platform has it, falling back to select() otherwise.
+
+    :return: A list of the file descriptors which are ready.
+
     """
+    try:
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in fds:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+            if timeout is not None:
+                timeout = int(math.ceil(timeout * 1000))
+            return [fd for fd, event in poller.poll(timeout)]
+        return select.select(fds, [], [], timeout)[0]
 
-    # Copy module version numbering to class.
-    version = version
-    version_info = version_info
-    hexversion = hexversion
+    # Interrupted by a signal (Python < 3.5 does not retry automatically). The
+    # caller will loop around and wait again as needed.
+    except (select.error, OSError):
+        e = sys.exc_info()[1]
+        if e.args[0] != errno.EINTR:
+            raise
+        return []
 
-    def __init__(self, command, interval=2, precise_mode=False, shell=None,
-                 differences=None, color=False, beep=False, errexit=False,
-                 header=True, returncode=True):
-        """The standard Python subprocess module is used to execute the command.
-        This can either do so within the current process (``shell=False``) or
-        using an external shell (``shell=True``). In general, ``shell=False`` is
-        preferred except when the command contains special shell characters
-        (e.g., the globbing character '*') which needs to be run in a shell to
-        work properly. In this case, it usually has to be escaped when entering
-        it and so the command passed in is a single-entry list.
+def common_prefix_length(a, b):
+    """Return the length of the longest common prefix of two strings (or
+    lists). This uses a binary search over slice comparisons, so the character
+    comparisons are all done in C rather than in a Python loop.
 
-        If the ``shell`` parameter is ``None``, the class will try to guess the
-        appropriate setting using the following two steps:
+    """
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
 
-            1. If the command list has more than one item, assume the command
-               was not escaped when entered and therefore has no special
-               characters; set ``shell`` to ``False``. Otherwise go to 2.
-            2. If the single entry has any special characters (the list of which
-               is defined in the module-level variable ``shell_chars``), then
-               set ``shell`` to ``True``. Otherwise set it to ``False``.
+# The number of columns taken up on the terminal by each character seen so far
+# which doesn't take up exactly one, and the layout of each line seen recently
+# which contains such characters. Both are caches; the latter is cleared once
+# it grows too big.
+char_widths = {}
+line_layouts = {}
+line_layouts_max = 16384
 
-        :param command: The command to run as a list of one or more strings.
-        :param interval: The interval, in seconds, between execution.
-        :param shell: Whether to spawn an external shell to run the command in.
-                      If ``None``, the class tries to guess the appropriate
-                      value based on the command.
-        :param precise_mode: Normally, ``interval`` seconds are left between one
-                             execution finishing and the next starting. Enabling
-                             precise mode means that the class will try to time
-                             it so there are ``interval`` seconds between the
-                             start of each execution. If the command takes
-                             longer than ``interval`` seconds to complete, then
-                             this target obviously cannot be met; instead, the
-                             command will be executed as often as possible.
-        :param differences: Whether or not to highlight differences in the
-                            output. Can be ``None``, for no highlighting,
-                            ``'sequential'`` to show the differences between
-                            sequential runs of the output, or ``'cumulative'``
-                            to show all the characters that have changed at
-                            least once since the first run.
-        :param beep: Beep when the command results in a non-zero return code.
-        :param color: Interpret ANSI color sequences to set the foreground
-                      colour.
-        :param errexit: Exit when the command results in a non-zero return code.
-        :param header: Whether or not to show the header at the top of the
-                       screen.
-        :param returncode: Whether or not to show the last return code in the
-                           header.
+if hasattr(str, 'isascii'):
+    def is_ascii(text):
+        """Whether a string contains only ASCII characters."""
+        return text.isascii()
+else:
+    nonascii_re = re.compile(u'[^\x00-\x7f]')
 
-        """
-        # Details for the header. The time of the last execution is stored so it
-        # can be used when the window is resized etc.
-        # We do this before checking the command is in the right format for the
-        # shell setting to avoid having to special-case depending on whether the
-        # command is then a string or a list -- at this point it is a list in
-        # either case and this gives the correct display.
-        self.cmd_str = 'Every ' + str(interval) + 's: ' + ' '.join(command)
-        self.cmd_str_len = len(self.cmd_str)
-        self.header_time = None
-        self._last_return_code = None
+    def is_ascii(text):
+        """Whether a string contains only ASCII characters."""
+        return isinstance(text, bytes) or nonascii_re.search(text) is None
 
-        # Try to auto-detect if we need shell mode.
-        if shell is None:
-            # Multiple arguments --> shell not needed.
-            if len(command) > 1:
-                shell = False
+def char_width(char):
+    """The number of columns a character takes up on the terminal, as the
+    wcwidth() C function would give: 0 for combining and other zero-width
+    characters, 2 for East Asian wide and full-width characters (which
+    includes most emoji), otherwise 1.
 
-            # One argument --> check for presence of special characters which
-            # need an external shell to handle properly.
-            else:
-                shell = any(char in command[0] for char in shell_chars)
+    """
+    try:
+        return char_widths[char]
+    except KeyError:
+        pass
+    if unicodedata.combining(char) or char in u'\u200b\u200c\u200d\u2060' or \
+            (unicodedata.category(char) in ('Mn', 'Me', 'Cf') and
+             char != u'\xad') or u'\u1160' <= char <= u'\u11ff':
+        width = 0
+    elif unicodedata.east_asian_width(char) in ('W', 'F'):
+        width = 2
+    else:
+        width = 1
+    char_widths[char] = width
+    return width
 
-                # Shell mode needed --> command needs to be a single string.
-                if shell:
-                    command = command[0]
+def line_layout(line):
+    """Work out where each character of a line goes on the terminal.
 
-        # Shell mode forced on. In this case the command needs to be a single
-        # string.
-        elif shell:
-            command = ' '.join(command)
+    :return: ``None`` if every character takes up one column, otherwise a
+             tuple (starts, ends, width) of the column each character starts
+             and ends at, and the number of columns the whole line takes up.
+             Zero-width characters (e.g., combining accents) are given the same
+             columns as the character they combine with, so the two are always
+             kept together.
 
-        # Store the details we were given.
-        self.command = command
-        self.shell = shell
-        self.interval = interval
-        self.precise_mode = precise_mode
-        self.errexit = errexit
-        self.beep = beep
-        self.color = color
-        self.header = header
-        self.returncode = returncode
+    """
+    if is_ascii(line):
+        return None
+    try:
+        return line_layouts[line]
+    except KeyError:
+        pass
 
-        # Precompute difference info for efficiency.
-        self.differences = differences is not None
-        if self.differences:
-            if differences.lower().startswith('c'):
-                self.c_diff = True
-            else:
-                self.c_diff = False
+    starts = array('l')
+    ends = array('l')
+    col = 0
+    base = 0
+    simple = True
+    for char in line:
+        width = char_width(char)
+        if width:
+            base = col
+            col += width
+            if width != 1:
+                simple = False
+        else:
+            simple = False
+        starts.append(base)
+        ends.append(col)
+    layout = None if simple else (starts, ends, col)
 
-        # Some basic variables.
-        self._process = None
-        self.dirty = False
-        self.screen = None
-        self.pad = None
-        self.next_run = None
+    if len(line_layouts) > line_layouts_max:
+        line_layouts.clear()
+    line_layouts[line] = layout
+    return layout
 
-        # The width and height of the screen (i.e., the controlling terminal).
-        self.screen_width = 0
-        self.screen_height = 0
+def display_width(text):
+    """The number of columns a string takes up on the terminal."""
+    if is_ascii(text):
+        return len(text)
+    layout = line_layout(text)
+    if layout is None:
+        return len(text)
+    return layout[2]
 
-        # The y-position, width and height of the content we wish to display.
-        self.content_y = 2 if self.header else 0
-        self.content_height = 0
-        self.content_width = 0
+def extend_to_clusters(line, mask):
+    """Extend a mask of changed characters in a line so that whenever part of
+    a character cluster (a character and any zero-width characters combining
+    with it) is marked, all of it is.
 
-        # The width and height of each 'page' of the display (i.e, the maximum
-        # area of content we can put on the screen at any one time). Smaller
-        # than the screen width due to headers etc.
-        self.page_height = 0
-        self.page_width = 0
+    """
+    if is_ascii(line):
+        return mask
+    base = 0
+    marked = False
+    for i, char in enumerate(line):
+        if char_width(char):
+            if marked:
+                mask[base:i] = b'\x01' * (i - base)
+            base = i
+            marked = mask[i]
+        elif mask[i]:
+            marked = True
+    if marked:
+        mask[base:] = b'\x01' * (len(line) - base)
+    return mask
 
-        # Position within the content of the top-left character of the display.
-        self.x = 0
-        self.y = 0
+def changed_cells(old, new):
+    """Compare the text of a line with the text previously displayed in the
+    same position, character by character. Positions past the end of the old
+    line are treated as blank, as that is what was on the screen there.
 
-        # Maximum limits of the previous x and y variables.
-        self.bottom = 0
-        self.right = 0
+    :return: ``None`` if every character of the new line matches, otherwise a
+             bytearray the length of the new line with a 1 at each position
+             which differs and a 0 elsewhere.
 
-        # State variable used for processing terminal escape codes.
-        self.cur_escape = curses.A_NORMAL
+    """
+    n = len(new)
+    if len(old) != n:
+        old = old[:n].ljust(n)
+    if old == new:
+        return None
 
-        # In Python 3 and above, the subprocess returns raw bytes which we need
-        # to decode into strings. Lets figure out the appropriate encoding to
-        # decode with.
-        if sys.hexversion >= 0x03000000:
-            import locale
-            locale.setlocale(locale.LC_ALL, '')
-            self.decode = locale.getpreferredencoding()
+    # Only the part between the common prefix and suffix needs to be compared
+    # character by character.
+    start = common_prefix_length(old, new)
+    end = n - common_prefix_length(old[start:][::-1], new[start:][::-1])
+    mask = bytearray(n)
+    mask[start:end] = bytearray(map(operator.ne, old[start:end],
+                                    new[start:end]))
+    return extend_to_clusters(new, mask)
+
+def merge_marks(mask, old_mask, length):
+    """Combine the positions changed in this run with those marked in
+    previous runs (for cumulative differences), truncated or padded to the
+    length of the new line.
+
+    """
+    old_mask = old_mask[:length]
+    if mask is None:
+        return old_mask + bytearray(length - len(old_mask))
+    return bytearray(map(operator.or_, mask, old_mask)) + mask[len(old_mask):]
+
+# The most lines which may be inserted or deleted between two runs for them to
+# be matched up line by line. Past this, the diff would take too long (the
+# time grows with the square of the number of changes), and the lines which
+# changed are compared in the same positions instead.
+match_limit = 500
+
+def _myers(a, b, limit):
+    """Find the longest common subsequence of two sequences using Myers' O(ND)
+    difference algorithm.
+
+    :return: A list of the (index in a, index in b) pairs of the matching
+             items, in reverse order, or ``None`` if the sequences differ by
+             more than ``limit`` insertions and deletions.
+
+    """
+    n, m = len(a), len(b)
+    offset = limit + 1
+    v = [0] * (2 * limit + 3)
+    trace = []
+    for d in range(limit + 1):
+        # Keep the furthest points reached so far on the diagonals which can
+        # lead to this step, for tracing the path back afterwards.
+        trace.append(v[offset - d - 1:offset + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _myers_path(trace, n, m)
+    return None
+
+def _myers_path(trace, x, y):
+    """Trace the path found by ``_myers()`` back from the end, collecting the
+    matching pairs along it.
+
+    """
+    pairs = []
+    for d in range(len(trace) - 1, 0, -1):
+        vd = trace[d]
+        k = x - y
+        if k == -d or (k != d and vd[k + d] < vd[k + d + 2]):
+            prev_k = k + 1
         else:
-            self.decode = False
+            prev_k = k - 1
+        prev_x = vd[prev_k + d + 1]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            pairs.append((x, y))
+        x, y = prev_x, prev_y
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        pairs.append((x, y))
+    return pairs
 
-    @classmethod
-    def from_arguments(klass, program_name, *args):
-        """Factory method which takes a set of command line arguments and
-        returns an instance of WatchLess set up as per those arguments. If the
-        user asks for a help message, or there are errors in the arguments, the
-        appropriate output will be printed and a SystemExit raised to indicate
-        processing is complete.
+def match_lines(old, new, limit=match_limit):
+    """Match up the lines of two runs' output, so that lines which have only
+    moved (because lines were inserted or removed above them) are recognised.
 
-        :param program_name: The name of the program as it should be displayed
-                             in any help/usage messages.
+    :return: A list of the regions which don't match, as (old start, old end,
+             new start, new end) tuples of line numbers, in order.
 
-        """
-        args = list(args)
+    """
+    # Lines at the start and end which are the same in both are matched
+    # without further ado; with mostly-appended output, that's all of them.
+    start = common_prefix_length(old, new)
+    end_old, end_new = len(old), len(new)
+    while end_old > start and end_new > start and \
+            old[end_old - 1] == new[end_new - 1]:
+        end_old -= 1
+        end_new -= 1
+    if start == end_old and start == end_new:
+        return []
+    if start == end_old or start == end_new:
+        return [(start, end_old, start, end_new)]
 
-        # Figure out the difference mode the user wants, if any. optparse does
-        # not allow optional arguments to options, so to make the command-line
-        # interface to match that of the original watch command, we need to do a
-        # bit of pre-processing here.
-        diff_mode = 'sequential'
-        for i, arg in enumerate(args):
-            if arg.startswith('--differences='):
-                args[i], diff_mode = arg.split('=', 1)
+    # Replace each line by a number, the same for identical lines, so that
+    # lines can be compared cheaply.
+    ids = {}
+    a = [ids.setdefault(line, len(ids)) for line in old[start:end_old]]
+    b = [ids.setdefault(line, len(ids)) for line in new[start:end_new]]
+    pairs = _myers(a, b, limit)
+    if pairs is None:
+        return [(start, end_old, start, end_new)]
 
-        # Run the arguments through the parser. This will print errors/help and
-        # exit as appropriate.
-        parser.prog = program_name
-        options, command = parser.parse_args(args)
+    hunks = []
+    x, y = len(a), len(b)
+    for i, j in pairs + [(-1, -1)]:
+        if i + 1 < x or j + 1 < y:
+            hunks.append((start + i + 1, start + x, start + j + 1, start + y))
+        x, y = i, j
+    hunks.reverse()
+    return hunks
 
-        # Show the version.
-        if options.version:
-            sys.stdout.write(klass.version)
-            sys.stdout.write('\n')
-            raise SystemExit(0)
+def line_changes(old, new):
+    """Compare the lines of a run's output with those of the previous run,
+    matching up lines which have moved. Lines in a changed region which
+    replace one of the old lines are compared with it character by character;
+    the rest are new, and are marked in full.
 
-        # No command given.
-        if not command:
-            sys.stdout.write('Error: no command given.\n\n')
-            parser.print_help()
-            raise SystemExit(1)
+    :return: A list with an entry for each new line, ``None`` if the line is
+             unchanged, otherwise a mask as returned by ``changed_cells()``.
 
-        # Pull the arguments that were given into a dictionary.
-        initargs = {}
-        if options.interval is not None:
-            initargs['interval'] = options.interval
-        initargs['precise_mode'] = options.precise_mode
-        initargs['errexit'] = options.errexit
-        initargs['beep'] = options.beep
-        initargs['color'] = options.color
-        initargs['header'] = options.header
-        initargs['returncode'] = options.returncode
+    """
+    masks = [None] * len(new)
+    for old_start, old_end, new_start, new_end in match_lines(old, new):
+        for i in range(new_start, new_end):
+            j = old_start + i - new_start
+            if j < old_end:
+                masks[i] = changed_cells(old[j], new[i])
+            elif new[i]:
+                masks[i] = bytearray(b'\x01' * len(new[i]))
+    return masks
 
-        # Translate command line difference setting into the format the
-        # initialiser expects.
-        if options.differences:
-            initargs['differences'] = diff_mode
+# Runs of marked positions in a difference mask.
+mark_re = re.compile(b'\x01+')
 
-        # Create the object and we're done.
-        return klass(command, **initargs)
+def highlight_pieces(pieces, mask, attr):
+    """Split a list of (text, displaystyle) pieces so that the runs of
+    positions marked in the mask have the given attribute added to their
+    style.
 
-    def process_command(self):
-        """Execute the command if it is time to and return the results. This
-        takes care of timing the repetition, watching for the output etc. in a
-        non-blocking manner. Call it regularly.
+    """
+    spans = [m.span() for m in mark_re.finditer(bytes(mask))]
+    if not spans:
+        return pieces
 
-        :return: A tuple (return_code, output), where the output is in a list of
-                 lines. If the command has not finished, the return code is
-                 ``None``. If there is no new output to return at this time, an
-                 empty list is returned.
+    out = []
+    pos = 0
+    for text, style in pieces:
+        end = pos + len(text)
+        cur = pos
+        for start, stop in spans:
+            if stop <= cur or start >= end:
+                continue
+            start = max(start, cur)
+            stop = min(stop, end)
+            if start > cur:
+                out.append((text[cur - pos:start - pos], style))
+            out.append((text[start - pos:stop - pos], style | attr))
+            cur = stop
+        if cur < end:
+            out.append((text[cur - pos:], style))
+        pos = end
+    return out
 
-        """
-        # Not currently running.
-        if self._process is None:
-            t = time.time()
+# Escape sequences: control sequences (CSI, ESC [ ... final byte), operating
+# system commands (OSC, ESC ] ... terminated by BEL or ST) and any other
+# two-or-more character escapes. The parameters and final byte of a CSI are
+# captured so that select graphic rendition (SGR) sequences can be found.
+escape_re = re.compile('\033(?:\\[([0-?]*)[ -/]*([@-~])'
+                       '|\\][^\007\033]*(?:\007|\033\\\\)?'
+                       '|[ -/]*[0-~])')
 
-            # Time to run it again.
-            if self.next_run is None or t >= self.next_run:
-                # Start the command running.
-                self._process = subprocess.Popen(self.command, shell=self.shell,
-                                                 stdout=subprocess.PIPE,
-                                                 stderr=subprocess.PIPE)
+# The display style before any SGR sequences: default foreground and
+# background colours, no attributes.
+default_sgr = (-1, -1, curses.A_NORMAL)
 
-                # If we are running under precise mode, set the time for the
-                # next run.
-                if self.precise_mode:
-                    self.next_run = (self.next_run or t) + self.interval
+# The attributes which can be turned on by SGR codes, and those each of the
+# 'turn off' codes clear.
+sgr_on = {
+    1: curses.A_BOLD,
+    2: curses.A_DIM,
+    3: getattr(curses, 'A_ITALIC', curses.A_NORMAL),
+    4: curses.A_UNDERLINE,
+    5: curses.A_BLINK,
+    7: curses.A_REVERSE,
+    8: curses.A_INVIS,
+}
+sgr_off = {
+    22: curses.A_BOLD | curses.A_DIM,
+    23: getattr(curses, 'A_ITALIC', curses.A_NORMAL),
+    24: curses.A_UNDERLINE,
+    25: curses.A_BLINK,
+    27: curses.A_REVERSE,
+    28: curses.A_INVIS,
+}
 
-                # Update the header so that the inverted version is shown to
-                # indicate the command is being run.
-                #self.update_header()
+def parse_sgr(params, state):
+    """Apply the parameters of a select graphic rendition escape sequence
+    (the part between 'ESC [' and 'm') to a display style.
 
-            # Nothing to return at this point.
-            return None, []
+    :param params: The parameter string, e.g., '1;31'.
+    :param state: The current style as a tuple (foreground, background,
+                  attributes), where the colours are indices into the
+                  256-colour xterm palette or -1 for the default.
+    :return: The new style.
 
-        # Gather any current output.
-        output = self._process.stdout.read().splitlines()
-        output.extend(self._process.stderr.readlines())
+    """
+    fg, bg, attr = state
+    codes = []
+    for code in params.replace(':', ';').split(';'):
+        try:
+            codes.append(int(code))
+        except ValueError:
+            codes.append(0)
 
-        # Decode the line to a string if needed.
-        if self.decode:
-            output = [line.decode(self.decode) for line in output]
+    i = 0
+    while i < len(codes):
+        code = codes[i]
+        i += 1
+        if code == 0:
+            fg, bg, attr = default_sgr
+        elif code in sgr_on:
+            attr |= sgr_on[code]
+        elif code in sgr_off:
+            attr &= ~sgr_off[code]
+        elif 30 <= code <= 37:
+            fg = code - 30
+        elif code == 39:
+            fg = -1
+        elif 40 <= code <= 47:
+            bg = code - 40
+        elif code == 49:
+            bg = -1
+        elif 90 <= code <= 97:
+            fg = code - 82
+        elif 100 <= code <= 107:
+            bg = code - 92
 
-        # Update the status of the process.
-        self._process.poll()
+        # Extended colours: 38;5;n for the 256-colour palette or 38;2;r;g;b
+        # for 24-bit colour (48 for the background).
+        elif code in (38, 48) and i < len(codes):
+            colour = None
+            if codes[i] == 5 and i + 1 < len(codes):
+                colour = codes[i + 1] % 256
+                i += 2
+            elif codes[i] == 2 and i + 3 < len(codes):
+                colour = rgb_to_xterm(*codes[i + 1:i + 4])
+                i += 4
+            else:
+                i += 1
+            if colour is not None:
+                if code == 38:
+                    fg = colour
+                else:
+                    bg = colour
 
-        # Still running.
-        if self._process.returncode is None:
-            return None, output
+    return fg, bg, attr
 
-        # Finished. Set the time to run it next and return the output.
-        rcode = self._process.returncode
-        self._process = None
-        self.header_time = time.localtime()
-        if not self.precise_mode:
-            self.next_run = time.time() + self.interval
-        return rcode, output
+# The RGB values of the 16 basic colours, as used by xterm, and of the levels in
+# the 6x6x6 colour cube making up the rest of the 256-colour palette.
+basic_rgb = [
+    (0, 0, 0), (205, 0, 0), (0, 205, 0), (205, 205, 0),
+    (0, 0, 238), (205, 0, 205), (0, 205, 205), (229, 229, 229),
+    (127, 127, 127), (255, 0, 0), (0, 255, 0), (255, 255, 0),
+    (92, 92, 255), (255, 0, 255), (0, 255, 255), (255, 255, 255),
+]
+cube_levels = (0, 95, 135, 175, 215, 255)
 
-    def calculate_sizes(self):
-        """Calculate the screen and page heights, plus the x- and y-positions of
-        the bottom and right hand side of the content. Call whenever the
-        content changes or a screen resize notification is received.
+def xterm_rgb(index):
+    """Get the RGB value of a colour in the 256-colour xterm palette."""
+    if index < 16:
+        return basic_rgb[index]
+    if index < 232:
+        index -= 16
+        return (cube_levels[index // 36], cube_levels[(index // 6) % 6],
+                cube_levels[index % 6])
+    grey = 8 + (index - 232) * 10
+    return (grey, grey, grey)
 
-        """
-        # Get the screen size, and from this the size of the page we can
-        # display. Note we need to subtract one to get the 'index' of the last
-        # available column and row.
-        screenh, screenw = self.screen.getmaxyx()
-        self.screen_height = screenh - 1
-        self.screen_width = screenw - 1
-        self.page_height = self.screen_height - self.content_y
-        self.page_width = self.screen_width
+def nearest_colour(rgb, palette):
+    """Find the index of the colour in the palette nearest to the given RGB
+    value.
 
-        # Calculate the maximum x and y positions for the pad. Note that this is
-        # the (x, y) coordinate within the pad that should be at the top-left of
-        # the available area so that the bottom/right content is visible at the
-        # bottom-right corner of the display.
-        self.right = self.content_width - self.page_width
-        self.bottom = self.content_height - self.page_height
+    """
+    best = None
+    best_index = 0
+    for index, other in enumerate(palette):
+        distance = sum([(a - b) ** 2 for a, b in zip(rgb, other)])
+        if best is None or distance < best:
+            best = distance
+            best_index = index
+    return best_index
 
-    def handle_keys(self):
-        """Receive any keys pressed by the user and update the instance
-        variables appropriately. If the display of the content needs to be
-        changed (e.g., if the user scrolled the page), the ``dirty`` attribute
-        is set to ``True``. Since curses reports screen resize events as a key
-        press, resizes are also handled by this method.
+def rgb_to_xterm(r, g, b):
+    """Find the nearest colour in the 256-colour xterm palette to a 24-bit
+    colour, considering the colour cube and the greyscale ramp.
 
-        This method is designed to work in a non-blocking manner.
+    """
+    levels = [(level,) for level in cube_levels]
+    ri, gi, bi = [nearest_colour((value,), levels) for value in (r, g, b)]
+    cube = 16 + 36 * ri + 6 * gi + bi
+    grey = 232 + min(max((r + g + b) // 3 - 3, 0) // 10, 23)
+    if nearest_colour((r, g, b), [xterm_rgb(cube), xterm_rgb(grey)]) == 0:
+        return cube
+    return grey
 
-        NB. The x- and y-position attributes are not bounds checked after being
-        changed; this needs to be performed by the caller. The reasoning behind
-        this is that the bounds may change anyway (e.g., if the content has
-        changed), so the caller would have to do the check anyway.
+def spawn(args, **kwargs):
+    """Start a process in a new process group (and session) of its own, so
+    that it and any processes it starts can be killed together with
+    ``kill_group()``. Takes the same arguments as ``subprocess.Popen``.
 
-        """
-        # Get any pending key. In no-delay mode, -1 means there was no key
-        # waiting.
-        key = self.screen.getch()
-        if key == -1:
-            return
+    """
+    if sys.version_info[0] >= 3:
+        kwargs['start_new_session'] = True
+    else:
+        kwargs['preexec_fn'] = os.setsid
+    return subprocess.Popen(args, **kwargs)
 
-        # Page movement keys.
-        if key == curses.KEY_UP:
-            self.y -= 1
-            self.dirty = True
-        elif key == curses.KEY_DOWN:
-            self.y += 1
-            self.dirty = True
-        elif key == curses.KEY_NPAGE or key == 519:
+def kill_group(process):
+    """Kill every process in the group of a process started by ``spawn()``.
+    Nothing happens if there are none left.
+
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+def load_function(spec):
+    """Import a Python function given as a string 'module:function'. The
+    function part may be a dotted path to, e.g., a method of a class.
+
+    """
+    if ':' not in spec:
+        raise ValueError("expected 'module:function'")
+    module, name = spec.split(':', 1)
+    obj = importlib.import_module(module)
+    for attr in name.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+def function_result(result):
+    """Convert the value returned from a Python function being watched into
+    a tuple (return_code, lines). The value can be ``None`` (no output), a
+    string, a list (or any other iterable) of lines, or a tuple
+    (return_code, string or lines). A tuple of two lines is taken as lines,
+    as its first item is not an integer return code.
+
+    """
+    rcode = 0
+    if isinstance(result, tuple) and len(result) == 2 and \
+            isinstance(result[0], int):
+        rcode, result = result
+    if result is None:
+        return rcode, []
+    if isinstance(result, bytes) and not isinstance(result, str):
+        result = result.decode('utf-8', 'replace')
+    if isinstance(result, str):
+        return rcode, result.splitlines()
+
+    lines = []
+    for line in result:
+        if isinstance(line, bytes) and not isinstance(line, str):
+            line = line.decode('utf-8', 'replace')
+        lines.extend(str(line).splitlines() or [''])
+    return rcode, lines
+
+class Palette(object):
+    """The colours used on a curses screen. Colour pairs are allocated as they
+    are needed to display each combination of colours in the output.
+
+    """
+
+    def __init__(self):
+        # The number of colours the terminal supports (zero if we are not
+        # displaying colours) and of colour pairs which can be used, the colour
+        # pairs allocated so far, and caches of the curses attribute for each
+        # display style and of the mapping from the 256-colour palette to the
+        # colours the terminal has.
+        self.colours = 0
+        self.pairs = 0
+        self._colour_pairs = {}
+        self._next_pair = 1
+        self._attr_cache = {}
+        self._colour_map = None
+
+    def setup(self):
+        """Start using colours, if the terminal supports them. Must be called
+        after curses has been initialised.
+
+        """
+        if curses.has_colors():
+            self.colours = min(curses.COLORS, 256)
+
+            # The curses attribute for a colour pair only has room for pair
+            # numbers up to 255, however many the terminal says it has.
+            self.pairs = min(curses.COLOR_PAIRS, 256)
+
+    def attr(self, state):
+        """Convert a display style, as returned by ``parse_sgr()``, into a
+        curses attribute. Colour pairs are allocated as needed, and the results
+        are cached so each distinct style is only worked out once.
+
+        """
+        try:
+            return self._attr_cache[state]
+        except KeyError:
+            pass
+
+        fg, bg, attr = state
+        if self.colours and (fg != -1 or bg != -1):
+            fg = self.map_colour(fg)
+            bg = self.map_colour(bg)
+            pair = self._colour_pairs.get((fg, bg))
+            if pair is None and self._next_pair < self.pairs:
+                pair = self._next_pair
+                self._next_pair += 1
+                curses.init_pair(pair, fg, bg)
+                self._colour_pairs[(fg, bg)] = pair
+            elif pair is None:
+                pair = self.nearest_pair(fg, bg)
+            attr |= curses.color_pair(pair)
+
+        self._attr_cache[state] = attr
+        return attr
+
+    def nearest_pair(self, fg, bg):
+        """Find the colour pair already allocated which is nearest to a
+        combination of colours, for when there are no more to allocate. The
+        terminal's default colours, which can't be known, are taken to be
+        light grey on black.
+
+        """
+        def rgb(colour, default):
+            if colour < 0:
+                return basic_rgb[default]
+            return xterm_rgb(colour)
+
+        pairs = [((-1, -1), 0)] + list(self._colour_pairs.items())
+        palette = [rgb(f, 7) + rgb(b, 0) for (f, b), pair in pairs]
+        return pairs[nearest_colour(rgb(fg, 7) + rgb(bg, 0), palette)][1]
+
+    def map_colour(self, colour):
+        """Map a colour from the 256-colour xterm palette onto the nearest
+        one the terminal can display.
+
+        """
+        if colour < 0 or colour < self.colours:
+            return colour
+        if self._colour_map is None:
+            palette = [xterm_rgb(i) for i in range(min(self.colours, 16))]
+            self._colour_map = [nearest_colour(xterm_rgb(i), palette)
+                                for i in range(256)]
+        return self._colour_map[colour]
+
+class Wakeup(object):
+    """A self-pipe used to wake the event loop up from signal handlers (for
+    terminal resizes and child processes exiting) and worker threads.
+
+    """
+
+    def __init__(self):
+        self.fd, self._write_fd = os.pipe()
+        set_nonblocking(self.fd)
+        set_nonblocking(self._write_fd)
+        signal.signal(signal.SIGWINCH, self._signal)
+        signal.signal(signal.SIGCHLD, self._signal)
+
+    def _signal(self, signum, frame):
+        """Signal handler. All the real work is done in the main loop; this just
+        wakes it up.
+
+        """
+        if signum == signal.SIGWINCH:
+            self.notify(b'w')
+        else:
+            self.notify(b'c')
+
+    def notify(self, reason):
+        """Wake the event loop up, giving a single byte as the reason."""
+        try:
+            os.write(self._write_fd, reason)
+        except OSError:
+            # The pipe is full, so the main loop already has a wakeup pending.
+            pass
+
+    def drain(self):
+        """Empty the pipe, returning the reasons for any wakeups."""
+        received = b''
+        try:
+            while True:
+                data = os.read(self.fd, 64)
+                if not data:
+                    break
+                received += data
+        except OSError:
+            pass
+        return received
+
+    def close(self):
+        """Restore the default signal handlers and close the pipe."""
+        signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.close(self.fd)
+        os.close(self._write_fd)
+
+def resize_terminal():
+    """Tell curses the new size of the terminal. Since we replace the SIGWINCH
+    handler curses installs itself, we have to ask the terminal for its size
+    rather than relying on curses to do so.
+
+    :return: ``True`` if curses was told the new size.
+
+    """
+    try:
+        size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b'\0' * 8)
+        rows, cols = struct.unpack('hhhh', size)[:2]
+    except (IOError, OSError):
+        return False
+    if rows > 0 and cols > 0:
+        curses.resizeterm(rows, cols)
+        return True
+    return False
+
+def setup_screen(screen, palette=None):
+    """Prepare a curses screen for use: use the terminal's default colours,
+    hide the cursor and make getch() non-blocking.
+
+    :param palette: The ``Palette`` to set up if displaying colours.
+
+    """
+    # If this terminal supports colours, tell it to use its default colours
+    # for this screen.
+    if curses.has_colors():
+        curses.use_default_colors()
+
+        # If we're going to display colours, colour pairs are set up as they
+        # are needed.
+        if palette is not None:
+            palette.setup()
+
+    # Disable the cursor if possible.
+    try:
+        curses.curs_set(0)
+    except curses.error:
+        # Try to set it to 'normal' rather than 'very visible' if we can.
+        try:
+            curses.curs_set(1)
+        except curses.error:
+            pass
+
+    # Enter no-delay mode so that getch() is non-blocking.
+    screen.nodelay(True)
+
+class RunSlots(object):
+    """A limit on the number of commands which can be running at once, shared
+    between several WatchLess instances.
+
+    """
+
+    def __init__(self, limit=None):
+        """:param limit: The maximum number of commands running at once, or
+                         ``None`` for no limit.
+
+        """
+        self.limit = limit
+        self.used = 0
+
+    def available(self):
+        """Whether another command could start running now."""
+        return self.limit is None or self.used < self.limit
+
+    def acquire(self):
+        """Take a slot if one is free, returning whether one was taken."""
+        if not self.available():
+            return False
+        self.used += 1
+        return True
+
+    def release(self):
+        """Give a slot back."""
+        self.used -= 1
+
+class Scheduler(object):
+    """Decides when each run of the command should start, using a monotonic
+    clock so that changes to the system time do not cause runs to bunch up or
+    stall. Also keeps track of how closely the schedule is being kept.
+
+    In precise mode, runs are due at fixed points spaced ``interval`` apart. A
+    run which is still going when the next one is due is an overrun, and the
+    ``overrun`` policy says what happens to the runs missed as a result:
+
+        * ``'skip'``: they are dropped, and the next run starts at the next
+          point due after the overrunning one finishes.
+        * ``'coalesce'``: they are merged into a single run, started as soon as
+          the overrunning one finishes.
+        * ``'burst'``: they are all run, back-to-back, until the schedule has
+          caught up.
+
+    Otherwise, each run is due ``interval`` seconds after the last finished.
+
+    If a ``max_interval`` is given, the schedule adapts to the output: each
+    time a run's output is the same as the last, the interval is multiplied by
+    ``backoff``, up to ``max_interval``; as soon as the output changes (or the
+    user shows an interest by pressing a key) it goes back to the minimum.
+
+    """
+
+    backoff = 2.0
+
+    def __init__(self, interval, precise=False, overrun='coalesce', jitter=0,
+                 align=False, max_interval=None):
+        """
+        :param interval: The interval, in seconds, between runs; the minimum
+                         interval if adapting to the output.
+        :param precise: Whether to keep to a fixed schedule.
+        :param overrun: The policy for runs missed due to an overrun; one of
+                        ``'skip'``, ``'coalesce'`` or ``'burst'``.
+        :param jitter: Delay each run by a random time of up to this many
+                       seconds. This is not carried over to later runs.
+        :param align: Put the points the runs are due at on multiples of the
+                      interval in local time. Implies ``precise``.
+        :param max_interval: The longest the interval can grow to while the
+                             output stays the same, or ``None`` to keep it
+                             fixed.
+
+        """
+        self.interval = self.min_interval = interval
+        self.max_interval = max_interval or interval
+        self.precise = precise or align
+        self.overrun = overrun
+        self.jitter = jitter
+        self.align = align
+
+        # The time (on the monotonic clock) the next run is due, not including
+        # any jitter; None if it is due now. Plus the random delay to add to it.
+        self.next_run = None
+        self._delay = 0
+
+        # The time the next run was scheduled from: when the last run was due
+        # in precise mode, otherwise when it finished. If the interval changes,
+        # the next run is rescheduled from this.
+        self._anchor = None
+
+        # Statistics: the smoothed time between the starts of runs, how late
+        # the last run started, and how many runs have overrun.
+        self.period = None
+        self.lateness = 0
+        self.overruns = 0
+        self._last_start = None
+
+    def _grid_after(self, point, t):
+        """Find the first of the points the runs are due at that is after
+        time t, given another such point.
+
+        """
+        if self.align:
+            # Work out where the points are relative to the local time now,
+            # rather than trusting the one we were given: if the machine has
+            # been suspended, the monotonic clock will have stopped meanwhile.
+            now = time.time()
+            offset = getattr(time.localtime(now), 'tm_gmtoff', -time.timezone)
+            point = monotonic() - (now + offset) % self.interval
+        steps = math.floor((t - point) / self.interval) + 1
+        return point + max(steps, 1) * self.interval
+
+    def _schedule(self, when):
+        """Set the time the next run is due, choosing the jitter for it."""
+        self.next_run = when
+        if self.jitter > 0:
+            self._delay = random.uniform(0, self.jitter)
+        else:
+            self._delay = 0
+
+    def due_in(self, t):
+        """The time in seconds from t until the next run is due; zero or less
+        if it is already due.
+
+        """
+        if self.next_run is None:
+            return 0
+        return self.next_run + self._delay - t
+
+    def started(self, t):
+        """Record that a run started at time t."""
+        first = self.next_run is None
+        if first:
+            due = t
+        else:
+            due = self.next_run
+            self.lateness = t - (due + self._delay)
+
+        if self._last_start is not None:
+            period = t - self._last_start
+            if self.period is None:
+                self.period = period
+            else:
+                self.period += (period - self.period) * 0.2
+        self._last_start = t
+
+        if self.precise:
+            self._anchor = due
+            following = self._following(due)
+            if first and self.align:
+                # The first run starts straight away rather than waiting for
+                # the clock to reach the next multiple of the interval.
+                following = self._grid_after(t, t)
+
+            # Already behind by more than one run: this run covers them all.
+            if following <= t and self.overrun == 'coalesce':
+                following = self._grid_after(due, t)
+            self._schedule(following)
+
+    def _following(self, anchor):
+        """The time the run after one due (in precise mode) or finishing
+        (otherwise) at the given time is due."""
+        if not self.precise:
+            return anchor + self.interval
+        if self.align:
+            return self._grid_after(anchor, anchor + self.interval / 2)
+        return anchor + self.interval
+
+    def finished(self, t):
+        """Record that a run finished at time t."""
+        if not self.precise:
+            self._anchor = t
+            self._schedule(self._following(t))
+            return
+
+        if self.next_run + self._delay < t:
+            self.overruns += 1
+            if self.overrun == 'skip':
+                self._schedule(self._grid_after(self.next_run, t))
+
+    @property
+    def adaptive(self):
+        """Whether the interval adapts to the output."""
+        return self.max_interval > self.min_interval
+
+    def adapt(self, changed):
+        """Adjust the interval after a run, backing off if its output was the
+        same as the last run's, otherwise going back to the minimum.
+
+        :return: Whether the interval changed.
+
+        """
+        if changed:
+            return self.set_interval(self.min_interval)
+        return self.set_interval(min(self.interval * self.backoff,
+                                     self.max_interval))
+
+    def set_interval(self, interval):
+        """Change the interval, rescheduling the next run to match.
+
+        :return: Whether the interval changed.
+
+        """
+        if interval == self.interval:
+            return False
+        self.interval = interval
+        if self.next_run is not None and self._anchor is not None:
+            self._schedule(self._following(self._anchor))
+        return True
+
+    def summary(self):
+        """A brief description of the measured period, the lateness of the
+        last run and the number of overruns, for the header. ``None`` before
+        a period has been measured.
+
+        """
+        if self.period is None:
+            return None
+        return '{0:.3f}s {1:+.0f}ms {2:d}x'.format(
+            self.period, self.lateness * 1000, self.overruns)
+
+class History(object):
+    """The output of past runs, kept within a memory budget. Identical lines
+    are only stored once, and most runs are stored as the changes from the
+    previous run, with a complete copy (a keyframe) every so often to limit
+    the work needed to reconstruct any one run. When the budget is exceeded,
+    the oldest runs are discarded.
+
+    Each run is given a serial number, starting from zero, which stays the
+    same as older runs are discarded. The runs available are those from
+    ``first`` up to (but not including) ``first + len(history)``.
+
+    """
+
+    # Make every this many runs a keyframe.
+    keyframe_interval = 32
+
+    # Rough sizes, in bytes, of the Python objects used to store each run and
+    # line, for keeping track of memory use.
+    run_overhead = 200
+    line_overhead = 100
+
+    def __init__(self, budget):
+        """:param budget: The most memory, in bytes, to use. The latest run is
+                          always kept, even if it is bigger than this.
+
+        """
+        self.budget = budget
+        self.first = 0
+        self.size = 0
+
+        # The runs, oldest first. Each is a tuple (info, length, keyframe,
+        # indices, lines): info is a tuple (time, return_code, status) for
+        # display, and length the number of lines. A keyframe has all the
+        # lines in a tuple and the rest None; otherwise the indices (an
+        # array) and lines (a list) of the lines which changed since the
+        # previous run are given. A run added by ``repeat()`` has all three
+        # None, and doesn't count towards the references to its lines.
+        self._runs = []
+
+        # Map from each distinct line stored to the copy of it we keep and the
+        # number of times it appears in the runs.
+        self._canon = {}
+        self._refs = {}
+
+        # The most recently reconstructed run, as (serial, lines), as it is
+        # likely to be wanted again when stepping through the runs.
+        self._cached = (None, None)
+
+    def __len__(self):
+        return len(self._runs)
+
+    def add(self, lines, info):
+        """Store the output of a run.
+
+        :param lines: The lines of output.
+        :param info: A tuple (time, return_code, status) describing the run.
+        :return: The serial number of the run.
+
+        """
+        canon = self._canon
+        refs = self._refs
+        lines = list(lines)
+        for i, line in enumerate(lines):
+            count = refs.get(line)
+            if count is None:
+                canon[line] = line
+                refs[line] = 1
+                self.size += sys.getsizeof(line) + self.line_overhead
+            else:
+                lines[i] = canon[line]
+                refs[line] = count + 1
+
+        # Work out what changed since the previous run; identical lines are
+        # the same object so can be compared by identity.
+        serial = self.first + len(self._runs)
+        run = None
+        if self._runs and serial % self.keyframe_interval:
+            previous = self.lines(serial - 1)
+            indices = array('l')
+            changed = []
+            for i, line in enumerate(lines):
+                if i >= len(previous) or previous[i] is not line:
+                    indices.append(i)
+                    changed.append(line)
+            if len(changed) * 2 < len(lines):
+                run = (info, len(lines), None, indices, changed)
+        if run is None:
+            run = (info, len(lines), tuple(lines), None, None)
+        self._runs.append(run)
+        self.size += self._run_size(run)
+        self._cached = (serial, lines)
+
+        # Keep to the budget.
+        while self.size > self.budget and len(self._runs) > 1:
+            self._discard_oldest()
+        return serial
+
+    def repeat(self, info):
+        """Store a run whose output was exactly the same as the previous
+        run's. This is much quicker than ``add()``, as the lines don't need to
+        be looked at. There must be a previous run.
+
+        :param info: A tuple (time, return_code, status) describing the run.
+        :return: The serial number of the run.
+
+        """
+        serial = self.first + len(self._runs)
+        run = (info, self._runs[-1][1], None, None, None)
+        self._runs.append(run)
+        self.size += self._run_size(run)
+        if self._cached[0] == serial - 1:
+            self._cached = (serial, self._cached[1])
+
+        while self.size > self.budget and len(self._runs) > 1:
+            self._discard_oldest()
+        return serial
+
+    def _run_size(self, run):
+        """The rough memory use of a stored run, not including its lines."""
+        if run[2] is not None:
+            return self.run_overhead + 8 * run[1]
+        if run[3] is None:
+            return self.run_overhead
+        return self.run_overhead + 16 * len(run[3])
+
+    def _discard_oldest(self):
+        """Discard the oldest run, turning the next one into a keyframe."""
+        oldest = self._runs.pop(0)
+        self.size -= self._run_size(oldest)
+        repeated = False
+        if self._runs and self._runs[0][2] is None:
+            nxt = self._runs[0]
+
+            # A repeat of the oldest run takes over its lines, and the
+            # references to them.
+            repeated = nxt[3] is None
+            if repeated:
+                keyframe = (nxt[0], nxt[1], oldest[2], None, None)
+            else:
+                keyframe = (nxt[0], nxt[1],
+                            tuple(self._apply(oldest[2], nxt)), None, None)
+            self.size += self._run_size(keyframe) - self._run_size(nxt)
+            self._runs[0] = keyframe
+
+        # Forget any lines which no longer appear in any run.
+        refs = self._refs
+        if not repeated:
+            for line in oldest[2]:
+                count = refs[line] - 1
+                if count:
+                    refs[line] = count
+                else:
+                    del refs[line]
+                    del self._canon[line]
+                    self.size -= sys.getsizeof(line) + self.line_overhead
+
+        self.first += 1
+        if self._cached[0] is not None and self._cached[0] < self.first:
+            self._cached = (None, None)
+
+    def _apply(self, lines, run):
+        """Apply the changes stored for a run to the lines of the previous run,
+        returning a new list.
+
+        """
+        info, length, keyframe, indices, changed = run
+        if indices is None:
+            return lines
+        lines = list(lines[:length])
+        if len(lines) < length:
+            lines.extend([''] * (length - len(lines)))
+        for i, line in zip(indices, changed):
+            lines[i] = line
+        return lines
+
+    def lines(self, serial):
+        """Reconstruct the lines of output of a run."""
+        cached_serial, cached = self._cached
+        if cached_serial == serial:
+            return cached
+
+        # Start from the closest reconstruction we have: the cached run if it
+        # is earlier, otherwise the last keyframe.
+        index = serial - self.first
+        start = index
+        while self._runs[start][2] is None:
+            start -= 1
+        if cached_serial is not None and start < cached_serial - self.first < index:
+            start = cached_serial - self.first
+            lines = cached
+        else:
+            lines = self._runs[start][2]
+        for run in self._runs[start + 1:index + 1]:
+            lines = self._apply(lines, run)
+
+        self._cached = (serial, lines)
+        return lines
+
+    def info(self, serial):
+        """The (time, return_code, status) tuple describing a run."""
+        return self._runs[serial - self.first][0]
+
+# The file formats for recordings. The data file starts with a header giving
+# the command, followed by records. Each record starts with a single byte
+# giving its type: a block of output (zlib compressed lines joined by
+# newlines) or a run (its details, and the offset of the block with its
+# output, which may be shared with other runs). The index is a separate file
+# with a header followed by an entry for each run, in order, giving the time
+# it finished and the offset of its record in the data file.
+record_magic = b'WLREC1\n'
+index_magic = b'WLIDX1\n'
+record_header = struct.Struct('<I')
+block_header = struct.Struct('<cI')
+run_record = struct.Struct('<cddiBQI')
+index_entry = struct.Struct('<dQ')
+
+# How the status of a run is recorded.
+record_statuses = [None, 'timed out', 'cancelled']
+
+class Recorder(object):
+    """Records the output of every run to a file, along with the time it
+    finished, how long it took and its return code, so it can be replayed
+    later (see ``Recording``). Files are only ever appended to, apart from
+    cutting off a run left partly written by a recorder which was killed, and
+    rewriting an index which is missing runs. Each distinct output is
+    compressed and stored once; runs with the same output as an earlier one
+    refer back to it.
+
+    """
+
+    def __init__(self, path, command):
+        """:param path: The file to record to. If it is an existing recording,
+                        the new runs are added to the end of it.
+        :param command: The command being run, as it should be shown when the
+                        recording is replayed.
+        :raises ValueError: If the file, or its index, exists but isn't part
+                            of a recording.
+
+        """
+        # Never add to a file which isn't a recording.
+        for name, magic in ((path, record_magic),
+                            (path + '.idx', index_magic)):
+            try:
+                with open(name, 'rb') as f:
+                    start = f.read(len(magic))
+            except (IOError, OSError):
+                continue
+            if start and start != magic:
+                raise ValueError('{0:s} is not a watchless recording'
+                                 .format(name))
+
+        self._data = open(path, 'ab')
+        if self._data.tell() == 0:
+            command = command.encode('utf-8')
+            self._data.write(record_magic)
+            self._data.write(record_header.pack(len(command)))
+            self._data.write(command)
+        else:
+            self._repair(path)
+        self._index = open(path + '.idx', 'ab')
+        if self._index.tell() == 0:
+            self._index.write(index_magic)
+
+        # Offsets of the blocks written, by a digest of their output.
+        self._blocks = {}
+
+    def _repair(self, path):
+        """Before adding to an existing recording, make sure its index covers
+        every run in it and that it doesn't end part way through a run, as
+        the recorder may have been killed while writing one. Otherwise the
+        runs added would leave a gap in the index, or be lost after the
+        partly written run.
+
+        """
+        recording = Recording(path)
+        index, end = recording.scan()
+        recording.close()
+        if end < self._data.tell():
+            self._data.truncate(end)
+            self._data.seek(0, os.SEEK_END)
+        try:
+            with open(path + '.idx', 'rb') as f:
+                current = f.read()
+        except (IOError, OSError):
+            current = None
+        if current != index:
+            with open(path + '.idx', 'wb') as f:
+                f.write(index)
+
+    def add(self, when, duration, rcode, status, lines, encoding='utf-8'):
+        """Record a run.
+
+        :param when: The time (from ``time.time()``) the run finished.
+        :param duration: How long it took, in seconds.
+        :param rcode: Its return code.
+        :param status: How it ended if it was given up on, as for
+                       ``WatchLess.process_command()``, or None.
+        :param lines: The lines of output.
+        :param encoding: The encoding to store the output in.
+
+        """
+        data = b'\n'.join([line if isinstance(line, bytes) else
+                           line.encode(encoding, 'replace') for line in lines])
+        digest = hashlib.sha1(data).digest()
+        offset = self._blocks.get(digest)
+        if offset is None:
+            offset = self._data.tell()
+            compressed = zlib.compress(data)
+            self._data.write(block_header.pack(b'B', len(compressed)))
+            self._data.write(compressed)
+            self._blocks[digest] = offset
+
+        position = self._data.tell()
+        self._data.write(run_record.pack(b'R', when, duration, rcode,
+                                         record_statuses.index(status), offset,
+                                         len(lines)))
+        self._data.flush()
+        self._index.write(index_entry.pack(when, position))
+        self._index.flush()
+
+    def close(self):
+        self._data.close()
+        self._index.close()
+
+class Recording(object):
+    """A recording made by ``Recorder``, for replaying. Both the data and the
+    index are memory mapped, so finding a run by number or time doesn't need
+    the whole file to be read. If the index is missing or incomplete (e.g.,
+    the recorder was killed before writing to it), it is rebuilt.
+
+    """
+
+    def __init__(self, path, encoding='utf-8'):
+        """:param path: The file the recording was made to.
+        :param encoding: The encoding the output was stored in.
+
+        """
+        self.encoding = encoding
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data[:len(record_magic)] != record_magic:
+            raise ValueError('{0:s} is not a watchless recording'.format(path))
+        start = len(record_magic)
+        length, = record_header.unpack_from(self._data, start)
+        start += record_header.size
+        self.command = self._data[start:start + length].decode('utf-8')
+        self._start = start + length
+
+        # Check the index covers every run, i.e., the last run it refers to is
+        # the last record in the data.
+        self._index = None
+        try:
+            with open(path + '.idx', 'rb') as f:
+                index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            index = None
+        if index is not None and index[:len(index_magic)] == index_magic:
+            self._index = index
+            count = len(self)
+            if count:
+                offset = self._entry(count - 1)[1]
+            if not count or offset + run_record.size != len(self._data):
+                self._index = None
+        if self._index is None:
+            self._index = self.scan()[0]
+
+    def scan(self):
+        """Scan the data to make an index of the runs, in memory.
+
+        :return: A tuple (index, end) of the contents of the index, and the
+                 offset of the end of the last complete run.
+
+        """
+        entries = [index_magic]
+        data = self._data
+        pos = end = self._start
+        while pos < len(data):
+            kind = data[pos:pos + 1]
+            if kind == b'B' and pos + block_header.size <= len(data):
+                pos += block_header.size + block_header.unpack_from(data,
+                                                                    pos)[1]
+            elif kind == b'R' and pos + run_record.size <= len(data):
+                when = run_record.unpack_from(data, pos)[1]
+                entries.append(index_entry.pack(when, pos))
+                pos += run_record.size
+                end = pos
+            else:
+                # Partly written record at the end.
+                break
+        return b''.join(entries), end
+
+    def close(self):
+        self._data.close()
+        if isinstance(self._index, mmap.mmap):
+            self._index.close()
+
+    def __len__(self):
+        return (len(self._index) - len(index_magic)) // index_entry.size
+
+    def _entry(self, n):
+        """The (time, offset) index entry for run n."""
+        return index_entry.unpack_from(self._index, len(index_magic) +
+                                       n * index_entry.size)
+
+    def time(self, n):
+        """The time run n finished."""
+        return self._entry(n)[0]
+
+    def find_time(self, when):
+        """Find the first run which finished at or after a time, by a binary
+        search of the index.
+
+        :return: The run number, or the number of runs if there are none.
+
+        """
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time(mid) < when:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def run(self, n):
+        """Read run n.
+
+        :return: A tuple (time, duration, return_code, status, lines).
+
+        """
+        data = self._data
+        kind, when, duration, rcode, status, offset, count = \
+            run_record.unpack_from(data, self._entry(n)[1])
+        length = block_header.unpack_from(data, offset)[1]
+        start = offset + block_header.size
+        output = zlib.decompress(data[start:start + length])
+        if count:
+            lines = output.decode(self.encoding, 'replace').split('\n')
+        else:
+            lines = []
+        return when, duration, rcode, record_statuses[status], lines
+
+def parse_seek(spec, recording):
+    """Find the run to start replaying a recording from, given as a run number
+    or a time; see the --seek option.
+
+    """
+    if spec.isdigit():
+        return min(int(spec), len(recording))
+
+    # A time of day is taken to be on the day the recording started.
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%H:%M:%S', '%H:%M'):
+        try:
+            parsed = time.strptime(spec, fmt)
+        except ValueError:
+            continue
+        if parsed.tm_year == 1900:
+            day = time.localtime(recording.time(0) if len(recording) else 0)
+            parsed = day[:3] + parsed[3:6] + (0, 0, -1)
+        return recording.find_time(time.mktime(tuple(parsed)[:8] + (-1,)))
+    raise ValueError('cannot understand {0:s} as a run or time'.format(spec))
+
+# Messages between a server and its viewers: the length of the message, then
+# the message itself as JSON compressed with zlib.
+message_header = struct.Struct('>I')
+
+def encode_message(message):
+    """Frame a message to send through a socket."""
+    data = zlib.compress(json.dumps(message).encode('utf-8'))
+    return message_header.pack(len(data)) + data
+
+def line_delta(old, new):
+    """Describe how to get from one run's output to the next, as a list of
+    [start, end, lines] operations, each replacing the old lines from start to
+    end with the given lines. Lines which are unchanged, even if they have
+    moved, are not included.
+
+    """
+    return [[old_start, old_end, new[new_start:new_end]]
+            for old_start, old_end, new_start, new_end in match_lines(old, new)]
+
+def apply_delta(old, delta):
+    """Apply the operations from ``line_delta()`` to a run's output.
+
+    :return: The output of the next run.
+
+    """
+    new = []
+    pos = 0
+    for start, end, lines in delta:
+        new.extend(old[pos:start])
+        new.extend(lines)
+        pos = end
+    new.extend(old[pos:])
+    return new
+
+class Server(object):
+    """Serves the runs of a command to viewers attached through a Unix socket
+    (see ``Attachment``), so that however many people are watching, the
+    command is only run once each interval. When a run finishes, each viewer
+    is sent only the changes from the run before, encoded once for all of
+    them. A viewer attaching is sent the recent runs kept in the history
+    first, so it can step back through them.
+
+    Nothing here blocks: data which can't be sent straight away is kept until
+    the viewer is ready for it, and a viewer which falls too far behind is
+    disconnected.
+
+    """
+
+    # The most data to keep waiting to be sent to a viewer.
+    max_pending = 64 * 1024 * 1024
+
+    def __init__(self, path, command, history=0):
+        """
+        :param path: The path of the socket. If a stale socket (one nobody is
+                     listening on) is already there, it is replaced;
+                     anything else there is left alone.
+        :param command: The command, as it should be shown by the viewers.
+        :param history: The memory budget, in bytes, for keeping recent runs
+                        to send to viewers when they attach.
+        :raises socket.error: If the socket can't be created, another server
+                              is already using it, or something other than a
+                              socket is in the way.
+
+        """
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise socket.error(errno.EADDRINUSE, 'not a socket')
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                if sys.exc_info()[1].errno != errno.ECONNREFUSED:
+                    raise
+                os.unlink(path)
+            else:
+                raise socket.error(errno.EADDRINUSE, 'already being served')
+            finally:
+                probe.close()
+        self.path = path
+        self.command = command
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+
+        # The recent runs, and the output of the latest.
+        self.history = None
+        if history > 0:
+            self.history = History(history)
+        self.latest = None
+        self._latest_info = None
+
+        # The viewers attached: file descriptor -> (socket, data waiting to be
+        # sent to it).
+        self.clients = {}
+
+    def fds(self):
+        """The file descriptors to wait on for viewers attaching, or sending
+        something (which is only ever them going away)."""
+        return [self.sock.fileno()] + list(self.clients)
+
+    def pending(self):
+        """Whether there is any data waiting to be sent to viewers."""
+        for sock, data in self.clients.values():
+            if data:
+                return True
+        return False
+
+    def handle(self, ready):
+        """Accept any viewers attaching and notice any which have gone, given
+        the file descriptors which are ready, then send what can be sent."""
+        if self.sock.fileno() in ready:
+            while True:
+                try:
+                    sock = self.sock.accept()[0]
+                except socket.error:
+                    break
+                sock.setblocking(False)
+                self.clients[sock.fileno()] = (sock, bytearray())
+                self._catch_up(sock.fileno())
+        for fd in ready:
+            if fd in self.clients:
+                try:
+                    gone = not self.clients[fd][0].recv(4096)
+                except socket.error:
+                    gone = sys.exc_info()[1].errno not in (errno.EAGAIN,
+                                                           errno.EWOULDBLOCK,
+                                                           errno.EINTR)
+                if gone:
+                    self._drop(fd)
+        self.flush()
+
+    def _catch_up(self, fd):
+        """Send a viewer which has just attached the command and the recent
+        runs, the first in full and the rest as changes."""
+        data = self.clients[fd][1]
+        data.extend(encode_message({'type': 'hello',
+                                    'command': self.command}))
+        if self.history:
+            serials = range(self.history.first,
+                            self.history.first + len(self.history))
+            runs = [(self.history.lines(serial), self.history.info(serial))
+                    for serial in serials]
+        elif self.latest is not None:
+            runs = [(self.latest, self._latest_info)]
+        else:
+            runs = []
+        previous = []
+        for lines, info in runs:
+            data.extend(self._run_message(previous, lines, info))
+            previous = lines
+
+    def _run_message(self, old, new, info):
+        """Encode a run as a message."""
+        when, duration, rcode, status, interval = info
+        return encode_message({'type': 'run', 'time': when,
+                               'duration': duration, 'returncode': rcode,
+                               'status': status, 'interval': interval,
+                               'delta': line_delta(old, new)})
+
+    def publish(self, when, duration, rcode, status, lines, interval):
+        """Send a run which has just finished to all the viewers.
+
+        :param when: The time (from ``time.time()``) the run finished.
+        :param duration: How long it took, in seconds.
+        :param rcode: Its return code.
+        :param status: How it ended if it was given up on, or None.
+        :param lines: The lines of output.
+        :param interval: The interval until the next run, for the viewers to
+                         show.
+
+        """
+        info = (when, duration, rcode, status, interval)
+        message = self._run_message(self.latest or [], lines, info)
+        self.latest = lines
+        self._latest_info = info
+        if self.history is not None:
+            self.history.add(lines, info)
+        for fd in list(self.clients):
+            data = self.clients[fd][1]
+            if len(data) + len(message) > self.max_pending:
+                self._drop(fd)
+            else:
+                data.extend(message)
+        self.flush()
+
+    def flush(self):
+        """Send as much of the data waiting as the viewers will take."""
+        for fd in list(self.clients):
+            sock, data = self.clients[fd]
+            while data:
+                try:
+                    sent = sock.send(data)
+                except socket.error:
+                    if sys.exc_info()[1].errno not in (errno.EAGAIN,
+                                                       errno.EWOULDBLOCK,
+                                                       errno.EINTR):
+                        self._drop(fd)
+                    break
+                del data[:sent]
+
+    def _drop(self, fd):
+        """Disconnect a viewer."""
+        sock = self.clients.pop(fd)[0]
+        sock.close()
+
+    def close(self):
+        """Disconnect all the viewers and remove the socket."""
+        for fd in list(self.clients):
+            self._drop(fd)
+        self.sock.close()
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class Attachment(object):
+    """A viewer's connection to a ``Server``, through which the runs of the
+    command it is running arrive.
+
+    """
+
+    def __init__(self, path):
+        """
+        :param path: The path of the server's socket.
+        :raises socket.error: If the server can't be connected to.
+
+        """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.sock.setblocking(False)
+        self.fd = self.sock.fileno()
+        self.closed = False
+        self._data = bytearray()
+
+    def read(self):
+        """Read whatever has arrived from the server, without blocking.
+
+        :return: A list of the complete messages received.
+
+        """
+        while not self.closed:
+            try:
+                chunk = self.sock.recv(65536)
+            except socket.error:
+                if sys.exc_info()[1].errno not in (errno.EAGAIN,
+                                                   errno.EWOULDBLOCK,
+                                                   errno.EINTR):
+                    self.close()
+                break
+            if not chunk:
+                self.close()
+                break
+            self._data.extend(chunk)
+
+        messages = []
+        data = self._data
+        pos = 0
+        while len(data) - pos >= message_header.size:
+            size = message_header.unpack_from(bytes(data[pos:pos + 4]))[0]
+            end = pos + message_header.size + size
+            if len(data) < end:
+                break
+            message = zlib.decompress(bytes(data[end - size:end]))
+            messages.append(json.loads(message.decode('utf-8')))
+            pos = end
+        del data[:pos]
+        return messages
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+
+class Stats(object):
+    """Timings of the stages of the main loop, for finding out where the time
+    goes. The last few hundred timings of each stage are kept, so the average
+    and 99th percentile can be worked out; all that is done when recording a
+    timing is to store it.
+
+    The stages are:
+
+        * ``'read'``: reading (and decoding) the output of a run.
+        * ``'parse'``: interpreting escape codes in the output.
+        * ``'diff'``: highlighting differences from the previous run.
+        * ``'draw'``: drawing the visible part of the output.
+        * ``'refresh'``: updating the terminal.
+        * ``'run'``: the time from a run starting to it finishing.
+
+    """
+
+    stages = ('read', 'parse', 'diff', 'draw', 'refresh', 'run')
+
+    # The number of timings of each stage kept.
+    samples = 256
+
+    def __init__(self):
+        self._times = {}
+        self._count = {}
+        self._total = {}
+        self._last = {}
+        self.lines = 0
+
+    def add(self, stage, seconds):
+        """Record how long a stage took."""
+        times = self._times.get(stage)
+        if times is None:
+            times = self._times[stage] = []
+            self._count[stage] = 0
+            self._total[stage] = 0.0
+        count = self._count[stage]
+        if count < self.samples:
+            times.append(seconds)
+        else:
+            times[count % self.samples] = seconds
+        self._count[stage] = count + 1
+        self._total[stage] += seconds
+        self._last[stage] = seconds
+
+    def summary(self):
+        """Summarise the timings.
+
+        :return: A dictionary mapping each stage with any timings to a
+                 dictionary with the ``count`` and ``total`` time of all
+                 timings, and the ``last``, ``mean`` and ``p99`` (99th
+                 percentile) of those kept, in seconds.
+
+        """
+        summary = {}
+        for stage, times in self._times.items():
+            ordered = sorted(times)
+            summary[stage] = {
+                'count': self._count[stage],
+                'total': self._total[stage],
+                'last': self._last[stage],
+                'mean': sum(times) / len(times),
+                'p99': ordered[int(0.99 * (len(ordered) - 1))],
+            }
+        return summary
+
+    def lines_per_second(self):
+        """The number of lines of output handled per second spent reading,
+        parsing and highlighting them."""
+        spent = sum([self._total.get(stage, 0)
+                     for stage in ('read', 'parse', 'diff')])
+        if not spent:
+            return 0
+        return self.lines / spent
+
+class LineStore(object):
+    """The output from one run of the command. Each line is kept as its plain
+    text, plus a list of attribute runs if any of it is displayed in anything
+    other than the normal style. Nothing is drawn until it is needed; see
+    ``WatchLess.draw_content()``.
+
+    """
+
+    def __init__(self):
+        # The text of each line, without any escape codes.
+        self.lines = []
+
+        # For each line, None if it is all displayed normally, otherwise a
+        # tuple of (start, end, displaystyle) runs covering the line.
+        self.attrs = []
+
+        # The layout, as returned by ``line_layout()``, of each line with any
+        # characters which don't take up exactly one column, by line number.
+        self.layouts = {}
+
+        # The number of columns taken up by the widest line.
+        self.width = 0
+
+    def __len__(self):
+        return len(self.lines)
+
+    def append(self, pieces):
+        """Add a line to the end of the output.
+
+        :param pieces: The line as a list of (text, displaystyle) tuples, as
+                       returned by ``WatchLess.process_escape_codes()``.
+
+        """
+        if len(pieces) == 1 and pieces[0][1] == curses.A_NORMAL:
+            line = pieces[0][0]
+            runs = None
+        else:
+            line = ''.join([text for text, attr in pieces])
+            runs = []
+            pos = 0
+            for text, attr in pieces:
+                if text:
+                    runs.append((pos, pos + len(text), attr))
+                    pos += len(text)
+            runs = tuple(runs)
+
+        width = len(line)
+        if not is_ascii(line):
+            layout = line_layout(line)
+            if layout is not None:
+                self.layouts[len(self.lines)] = layout
+                width = layout[2]
+
+        self.lines.append(line)
+        self.attrs.append(runs)
+        if width > self.width:
+            self.width = width
+
+    def extend(self, lines):
+        """Add a batch of lines which contain no escape codes and are all
+        displayed normally. This grows the store once per batch rather than
+        once per line, and avoids any per-line work in Python.
+
+        """
+        if not lines:
+            return
+
+        # Checking the whole batch at once is much quicker than each line.
+        width = max(map(len, lines))
+        if not is_ascii(''.join(lines)):
+            offset = len(self.lines)
+            for i, line in enumerate(lines):
+                layout = line_layout(line)
+                if layout is not None:
+                    self.layouts[offset + i] = layout
+                    width = max(width, layout[2])
+
+        self.lines.extend(lines)
+        self.attrs.extend([None] * len(lines))
+        self.width = max(self.width, width)
+
+    def clear(self):
+        """Remove all lines."""
+        del self.lines[:]
+        del self.attrs[:]
+        self.layouts.clear()
+        self.width = 0
+
+    def memory(self):
+        """A rough count of the bytes used to store the lines."""
+        size = sys.getsizeof(self.lines) + sys.getsizeof(self.attrs)
+        for line in self.lines:
+            size += sys.getsizeof(line)
+        for runs in self.attrs:
+            if runs is not None:
+                size += sys.getsizeof(runs) + 72 * len(runs)
+        size += sys.getsizeof(self.layouts)
+        for starts, ends, width in self.layouts.values():
+            size += 2 * starts.itemsize * len(starts)
+        return size
+
+    def segments(self, index, start, width):
+        """Get the part of a line which falls within a range of columns.
+
+        :param index: The line number.
+        :param start: The first column to include.
+        :param width: The number of columns to include.
+        :return: A list of (text, displaystyle) tuples.
+
+        """
+        stop = start + width
+        layout = self.layouts.get(index)
+        if layout is not None:
+            return self._wide_segments(self.lines[index], self.attrs[index],
+                                       layout, start, stop)
+        runs = self.attrs[index]
+        if runs is None:
+            text = self.lines[index][start:stop]
+            if text:
+                return [(text, curses.A_NORMAL)]
+            return []
+
+        line = self.lines[index]
+        out = []
+        for rstart, rend, attr in runs:
+            if rend <= start:
+                continue
+            if rstart >= stop:
+                break
+            out.append((line[max(rstart, start):min(rend, stop)], attr))
+        return out
+
+    def pieces(self, index):
+        """Get a whole line as a list of (text, displaystyle) tuples, as it
+        was given to ``append()``.
+
+        """
+        line = self.lines[index]
+        runs = self.attrs[index]
+        if runs is None:
+            return [(line, curses.A_NORMAL)]
+        return [(line[start:end], attr) for start, end, attr in runs]
+
+    def _wide_segments(self, line, runs, layout, start, stop):
+        """The equivalent of ``segments()`` for a line with characters which
+        don't take up exactly one column. A wide character cut in half by the
+        edge of the range is replaced by a space.
+
+        """
+        starts, ends, width = layout
+        first = bisect.bisect_left(starts, start)
+        last = bisect.bisect_right(ends, stop)
+        if last <= first:
+            first = last = min(first, len(starts))
+
+        out = []
+        if first < len(starts):
+            lead = min(starts[first], stop) - start
+        else:
+            lead = min(width, stop) - start
+        if lead > 0:
+            out.append((' ' * lead, curses.A_NORMAL))
+
+        if runs is None:
+            if last > first:
+                out.append((line[first:last], curses.A_NORMAL))
+        else:
+            for rstart, rend, attr in runs:
+                if rend <= first:
+                    continue
+                if rstart >= last:
+                    break
+                out.append((line[max(rstart, first):min(rend, last)], attr))
+
+        if last < len(starts) and starts[last] < stop:
+            out.append((' ' * (stop - starts[last]), curses.A_NORMAL))
+        return out
+
+    def restyle(self, index, attr):
+        """Add an attribute to the style of the whole of a line."""
+        runs = self.attrs[index]
+        if runs is None:
+            runs = ((0, len(self.lines[index]), curses.A_NORMAL),)
+        self.attrs[index] = tuple([(start, end, style | attr)
+                                   for start, end, style in runs])
+
+def format_size(size):
+    """Format a number of bytes for people to read, e.g., ``'1.5 MiB'``."""
+    for unit in ('bytes', 'KiB', 'MiB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'GiB'
+    if unit == 'bytes':
+        return '{0:d} {1:s}'.format(int(size), unit)
+    return '{0:.1f} {1:s}'.format(size, unit)
+
+def parse_columns(spec):
+    """Parse a list of columns to show, as given to the ``--columns`` option:
+    column numbers counting from 1, and ranges of them, separated by commas.
+    A range may leave out its start or end, e.g., ``-3`` or ``5-``.
+
+    :return: A list of ``slice`` objects selecting the columns.
+    :raises ValueError: If the list is not valid.
+
+    """
+    slices = []
+    for part in spec.split(','):
+        part = part.strip()
+        if '-' in part:
+            start, end = part.split('-', 1)
+            start = int(start) if start else 1
+            end = int(end) if end else None
+        else:
+            start = end = int(part)
+        if start < 1 or (end is not None and end < start):
+            raise ValueError('invalid columns: {0:s}'.format(part))
+        slices.append(slice(start - 1, end))
+    return slices
+
+class Filter(object):
+    """A pipeline of filters and transformations applied to the lines of
+    output before they are displayed, in place of piping the command through
+    grep, cut, sort and uniq. The stages given are compiled into a list of
+    functions once, and each is applied to the whole of a run's output.
+
+    Lines are matched and split into columns without any escape codes they
+    contain; a line which is split into columns loses its colours and styles.
+
+    """
+
+    def __init__(self, include=None, exclude=None, columns=None, sort=False,
+                 unique=False):
+        """
+        :param include: A regular expression; only the lines matching it are
+                        kept.
+        :param exclude: A regular expression; the lines matching it are left
+                        out.
+        :param columns: The whitespace-separated columns of each line to keep,
+                        as for ``parse_columns()``.
+        :param sort: Whether to sort the lines.
+        :param unique: Whether to leave out repeated lines (all but the first
+                       of the lines which are the same).
+        :raises ValueError: If a regular expression or the columns are not
+                            valid.
+
+        """
+        self.include = include
+        self.exclude = exclude
+        self.columns = columns
+        self.sort = sort
+        self.unique = unique
+
+        self.stages = []
+        try:
+            if include:
+                self.stages.append(functools.partial(
+                    matching_lines, re.compile(include).search, True))
+            if exclude:
+                self.stages.append(functools.partial(
+                    matching_lines, re.compile(exclude).search, False))
+        except re.error:
+            raise ValueError(str(sys.exc_info()[1]))
+        if columns:
+            self.stages.append(functools.partial(select_columns,
+                                                 parse_columns(columns)))
+        if sort:
+            self.stages.append(sorted)
+        if unique:
+            self.stages.append(unique_lines)
+
+    def __len__(self):
+        return len(self.stages)
+
+    @property
+    def streamable(self):
+        """Whether the lines can be filtered as they arrive, rather than
+        needing the whole of a run's output at once."""
+        return not (self.sort or self.unique)
+
+    def apply(self, lines):
+        """Pass lines of output through the filters.
+
+        :return: A list of the filtered lines.
+
+        """
+        for stage in self.stages:
+            lines = stage(lines)
+        return lines
+
+    def replace(self, **kwargs):
+        """Make a copy of the filter with some settings changed.
+
+        :return: The new ``Filter``.
+
+        """
+        settings = dict(include=self.include, exclude=self.exclude,
+                        columns=self.columns, sort=self.sort,
+                        unique=self.unique)
+        settings.update(kwargs)
+        return Filter(**settings)
+
+def plain_text(line):
+    """Remove any escape codes from a line."""
+    if '\033' in line:
+        return escape_re.sub('', line)
+    return line
+
+def matching_lines(search, keep, lines):
+    """Keep the lines which match a regular expression (if ``keep`` is set)
+    or those which don't."""
+    return [line for line in lines if bool(search(plain_text(line))) == keep]
+
+def select_columns(slices, lines):
+    """Keep only some of the whitespace-separated columns of each line, joined
+    by single spaces."""
+    out = []
+    for line in lines:
+        fields = plain_text(line).split()
+        picked = []
+        for columns in slices:
+            picked.extend(fields[columns])
+        out.append(' '.join(picked))
+    return out
+
+def unique_lines(lines):
+    """Leave out all but the first of any lines which are the same."""
+    seen = set()
+    out = []
+    for line in lines:
+        if line not in seen:
+            seen.add(line)
+            out.append(line)
+    return out
+
+class Spill(object):
+    """Lines of output kept in a temporary file rather than in memory, and
+    read back when they are needed. The lines are written one after another;
+    only the position of every ``step``-th line is kept in memory, and lines
+    are read back a block of ``step`` lines at a time through a memory map of
+    the file, so the memory used barely grows with the number of lines.
+
+    """
+
+    step = 256
+
+    def __init__(self, encoding='utf-8', strip=False):
+        """
+        :param encoding: The encoding to store the lines in.
+        :param strip: Whether to remove escape codes from lines as they are
+                      read back, as they are shown without any styles.
+
+        """
+        self.encoding = encoding
+        self.strip = strip
+        self.file = tempfile.TemporaryFile()
+        self.offsets = array('Q')
+        self.count = 0
+        self.size = 0
+        self.width = 0
+        self._map = None
+        self._block = (None, [])
+
+    def __len__(self):
+        return self.count
+
+    def extend(self, lines):
+        """Add lines to the end of the file."""
+        i = 0
+        while i < len(lines):
+            if self.count % self.step == 0:
+                self.offsets.append(self.size)
+            n = min(self.step - self.count % self.step, len(lines) - i)
+            data = '\n'.join(lines[i:i + n]) + '\n'
+            if not isinstance(data, bytes):
+                data = data.encode(self.encoding, 'replace')
+            self.file.write(data)
+            self.size += len(data)
+            self.count += n
+            i += n
+        if lines:
+            self.width = max(self.width, max(map(len, lines)))
+        self._map = None
+
+    def __getitem__(self, index):
+        """Read a line back from the file."""
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        block = index // self.step
+        if self._block[0] != block:
+            if self._map is None:
+                self.file.flush()
+                self._map = mmap.mmap(self.file.fileno(), self.size,
+                                      access=mmap.ACCESS_READ)
+            start = self.offsets[block]
+            if block + 1 < len(self.offsets):
+                end = self.offsets[block + 1]
+            else:
+                end = self.size
+            data = self._map[start:end - 1]
+            if self.encoding:
+                data = data.decode(self.encoding, 'replace')
+            lines = data.split('\n' if self.encoding else b'\n')
+            if self.strip:
+                lines = [escape_re.sub('', line) for line in lines]
+            self._block = (block, lines)
+        return self._block[1][index % self.step]
+
+    def memory(self):
+        """A rough count of the bytes of memory used."""
+        return self.offsets.itemsize * len(self.offsets) + \
+            sum(map(len, self._block[1]))
+
+class SpillStore(LineStore):
+    """A read-only view of the lines in a ``Spill``, which can be displayed
+    like any other output. The lines are read from the file as they are
+    drawn, and are shown without any styles.
+
+    """
+
+    def __init__(self, spill):
+        LineStore.__init__(self)
+        self.lines = spill
+        self.width = spill.width
+
+    def segments(self, index, start, width):
+        line = self.lines[index]
+        layout = line_layout(line)
+        if layout is not None:
+            return self._wide_segments(line, None, layout, start,
+                                       start + width)
+        text = line[start:start + width]
+        if text:
+            return [(text, curses.A_NORMAL)]
+        return []
+
+    def pieces(self, index):
+        return [(self.lines[index], curses.A_NORMAL)]
+
+    def memory(self):
+        return self.lines.memory()
+
+class Capture(object):
+    """Collects the lines of output of a run as they arrive, keeping at most a
+    set number of lines and bytes (counting a character as a byte). Half of
+    each allowance goes to the start of the output and half to the end; the
+    lines in between are left out, or written to a ``Spill`` so they can be
+    paged through, and are replaced by a line saying how many there were. So
+    the memory used stays the same however much output there is.
+
+    """
+
+    def __init__(self, max_lines=0, max_bytes=0, spill=False,
+                 encoding='utf-8', strip=False):
+        """
+        :param max_lines: The most lines to keep, or 0 for no limit.
+        :param max_bytes: The most bytes to keep, or 0 for no limit.
+        :param spill: Whether to keep the lines left out in a ``Spill``.
+        :param encoding: The encoding for the ``Spill``.
+        :param strip: Whether the ``Spill`` should remove escape codes.
+
+        """
+        # Each allowance is None for no limit. A limit of 1 leaves nothing
+        # for the end of the output, which is then a limit of 0.
+        self.head_lines = self.tail_lines = None
+        if max_lines:
+            self.head_lines = max_lines - max_lines // 2
+            self.tail_lines = max_lines // 2
+        self.head_bytes = self.tail_bytes = None
+        if max_bytes:
+            self.head_bytes = max_bytes - max_bytes // 2
+            self.tail_bytes = max_bytes // 2
+        self.spill = spill
+        self.encoding = encoding
+        self.strip = strip
+        self.reset()
+
+    def reset(self):
+        """Start collecting a new run's output."""
+        self.head = []
+        self.tail = collections.deque()
+        self._head_size = 0
+        self._tail_size = 0
+        self._full = False
+        self.elided = 0
+        self.elided_bytes = 0
+        self._spill = None
+
+    def add(self, lines):
+        """Add lines to the end of the output."""
+        head = self.head
+        if not self._full:
+            # The whole batch usually fits.
+            size = 0
+            if self.head_bytes is not None:
+                size = sum(map(len, lines)) + len(lines)
+            if (self.head_lines is None or
+                    len(head) + len(lines) <= self.head_lines) and \
+                    (self.head_bytes is None or
+                     self._head_size + size <= self.head_bytes):
+                head.extend(lines)
+                self._head_size += size
+                return
+
+            for i, line in enumerate(lines):
+                size = len(line) + 1
+                if (self.head_lines is not None and
+                        len(head) >= self.head_lines) or \
+                        (self.head_bytes is not None and
+                         self._head_size + size > self.head_bytes):
+                    self._full = True
+                    lines = lines[i:]
+                    break
+                head.append(line)
+                self._head_size += size
+            else:
+                return
+
+        # Past the start: keep the latest lines, dropping the oldest ones.
+        tail = self.tail
+        tail.extend(lines)
+        if self.tail_bytes is not None:
+            self._tail_size += sum(map(len, lines)) + len(lines)
+        dropped = []
+        while (self.tail_lines is not None and
+               len(tail) > self.tail_lines) or \
+                (self.tail_bytes is not None and
+                 self._tail_size > self.tail_bytes):
+            line = tail.popleft()
+            if self.tail_bytes is not None:
+                self._tail_size -= len(line) + 1
+            self.elided_bytes += len(line) + 1
+            dropped.append(line)
+        self.elided += len(dropped)
+        if dropped and self.spill:
+            if self._spill is None:
+                self._spill = Spill(self.encoding, self.strip)
+            self._spill.extend(dropped)
+
+    def finish(self):
+        """Finish collecting a run's output, ready for the next.
+
+        :return: A tuple (lines, marker, spill) of the lines kept, the line
+                 number of the line saying how many were left out (``None`` if
+                 none were), and the ``Spill`` of those lines, if any.
+
+        """
+        lines = self.head
+        marker = None
+        if self.elided:
+            marker = len(lines)
+            text = '[... {0:d} lines ({1:s}) left out'.format(
+                self.elided, format_size(self.elided_bytes))
+            if self._spill is not None:
+                text += '; press e to view them'
+            lines.append(text + ' ...]')
+        lines.extend(self.tail)
+        spill = self._spill
+        self.reset()
+        return lines, marker, spill
+
+def moved_line(old, new, index):
+    """Find where a line of one run's output is in the next run's output.
+
+    :return: The line number in the new output, or ``None`` if the line was
+             changed or removed.
+
+    """
+    shift = 0
+    for old_start, old_end, new_start, new_end in match_lines(old, new):
+        if index < old_start:
+            break
+        if index < old_end:
+            return None
+        shift = new_end - old_end
+    return index + shift
+
+class Search(object):
+    """A search of the output for a regular expression, as with the / and ?
+    commands of less. The lines of the output shown are scanned for matches a
+    chunk at a time, between other work, building an index of the lines which
+    match; until the scan is complete, looking for a match scans ahead as far
+    as needed. Where each line matches is cached by the text of the line, so
+    lines which are the same from one run to the next don't need searching
+    again.
+
+    """
+
+    # The number of lines to scan in each chunk, and the number of distinct
+    # lines to cache the matches of before starting again.
+    chunk = 5000
+    cache_max = 65536
+
+    def __init__(self, pattern, forward=True):
+        """
+        :param pattern: The regular expression to look for.
+        :param forward: Whether the search goes towards the end of the output
+                        (``n`` finds the next match) or the start (``n`` finds
+                        the previous match).
+
+        """
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        self.forward = forward
+
+        # The positions of the matches in each line of text seen, as a tuple
+        # of (start, end) tuples.
+        self._spans = {}
+
+        # The output being searched, how many of its lines have been scanned,
+        # the line numbers of those which match, and the line number of the
+        # match last moved to, if any.
+        self.store = None
+        self.scanned = 0
+        self.matches = []
+        self.current = None
+
+    def reset(self, store):
+        """Start searching a new output."""
+        self.store = store
+        self.scanned = 0
+        self.matches = []
+        self.current = None
+
+    @property
+    def complete(self):
+        """Whether the whole of the output has been scanned."""
+        return self.store is None or self.scanned >= len(self.store)
+
+    def spans(self, index):
+        """Find the matches in a line of the output.
+
+        :return: A tuple of the (start, end) positions of the matches, empty if
+                 there are none.
+
+        """
+        line = self.store.lines[index]
+        try:
+            return self._spans[line]
+        except KeyError:
+            pass
+        spans = tuple([m.span() for m in self.regex.finditer(line)])
+        if len(self._spans) >= self.cache_max:
+            self._spans.clear()
+        self._spans[line] = spans
+        return spans
+
+    def scan(self, count=None):
+        """Scan the next chunk of the output for matches.
+
+        :return: Whether the whole of the output has now been scanned.
+
+        """
+        end = min(self.scanned + (count or self.chunk), len(self.store))
+        spans = self.spans
+        self.matches.extend([i for i in range(self.scanned, end) if spans(i)])
+        self.scanned = end
+        return self.complete
+
+    def find(self, index, forward=True):
+        """Find the first line which matches after (or before, if not forward)
+        a line, scanning as much more of the output as is needed.
+
+        :return: The line number of the match, or ``None`` if there is none.
+
+        """
+        if forward:
+            matches = self.matches
+            while not self.complete and (not matches or matches[-1] <= index):
+                self.scan()
+            i = bisect.bisect_right(matches, index)
+            if i < len(matches):
+                return matches[i]
+            return None
+        while self.scanned < index and not self.complete:
+            self.scan()
+        i = bisect.bisect_left(self.matches, index)
+        if i > 0:
+            return self.matches[i - 1]
+        return None
+
+class WatchLess(object):
+    """The main class which implements the periodic execution and paged display
+    of its output.
+    """
+
+    # Copy module version numbering to class.
+    version = version
+    version_info = version_info
+    hexversion = hexversion
+
+    def __init__(self, command, interval=2, precise_mode=False, shell=None,
+                 differences=None, color=False, beep=False, errexit=False,
+                 header=True, returncode=True, event_loop=True,
+                 persistent=False, timeout=None, slots=None,
+                 overrun='coalesce', jitter=0, align=False,
+                 history=16 * 1024 * 1024, stream=None, record=None,
+                 replay=None, speed=1.0, seek=0, show_unchanged=False,
+                 stats_file=None, max_lines=100000, max_bytes=32 * 1024 * 1024,
+                 spill=False, line_filter=None, max_interval=None,
+                 serve=None, attach=None):
+        """The standard Python subprocess module is used to execute the command.
+        This can either do so within the current process (``shell=False``) or
+        using an external shell (``shell=True``). In general, ``shell=False`` is
+        preferred except when the command contains special shell characters
+        (e.g., the globbing character '*') which needs to be run in a shell to
+        work properly. In this case, it usually has to be escaped when entering
+        it and so the command passed in is a single-entry list.
+
+        If the ``shell`` parameter is ``None``, the class will try to guess the
+        appropriate setting using the following two steps:
+
+            1. If the command list has more than one item, assume the command
+               was not escaped when entered and therefore has no special
+               characters; set ``shell`` to ``False``. Otherwise go to 2.
+            2. If the single entry has any special characters (the list of which
+               is defined in the module-level variable ``shell_chars``), then
+               set ``shell`` to ``True``. Otherwise set it to ``False``.
+
+        Instead of a command, a Python function can be given: either the
+        function itself, or a string in the form ``'module:function'`` naming
+        it. The function is called with no arguments in a worker thread for
+        each run, so no new processes are needed. It can return a string, a
+        list of lines, or a tuple (return_code, lines); if it raises an
+        exception, the traceback is shown as the output and the return code
+        is 1.
+
+        :param command: The command to run as a list of one or more strings, or
+                        a Python function or ``'module:function'`` string.
+        :param interval: The interval, in seconds, between execution.
+        :param shell: Whether to spawn an external shell to run the command in.
+                      If ``None``, the class tries to guess the appropriate
+                      value based on the command.
+        :param precise_mode: Normally, ``interval`` seconds are left between one
+                             execution finishing and the next starting. Enabling
+                             precise mode means that the class will try to time
+                             it so there are ``interval`` seconds between the
+                             start of each execution. If the command takes
+                             longer than ``interval`` seconds to complete, then
+                             this target obviously cannot be met; what
+                             happens instead is set by ``overrun``. The
+                             measured period, lateness and number of overruns
+                             are shown in the header.
+        :param differences: Whether or not to highlight differences in the
+                            output. Can be ``None``, for no highlighting,
+                            ``'sequential'`` to show the differences between
+                            sequential runs of the output, ``'lines'`` to do
+                            the same but matching up lines which have moved,
+                            or ``'cumulative'``
+                            to show all the characters that have changed at
+                            least once since the first run.
+        :param beep: Beep when the command results in a non-zero return code.
+        :param color: Interpret ANSI select graphic rendition sequences to set
+                      the colours and style of the output.
+        :param errexit: Exit when the command results in a non-zero return code.
+        :param header: Whether or not to show the header at the top of the
+                       screen.
+        :param returncode: Whether or not to show the last return code in the
+                           header.
+        :param event_loop: If ``True``, the main loop blocks until a key is
+                           pressed, the command produces output, the terminal
+                           is resized or the next run is due. If ``False``, the
+                           older behaviour of checking for these every 10ms is
+                           used instead.
+        :param persistent: If ``True``, a single shell is started and kept
+                           running, and the command is fed to it for each run.
+                           This saves creating a new process (or two, in shell
+                           mode) every interval. Note that any changes the
+                           command makes to the shell's state (e.g., changing
+                           directory) carry over to the next run. If the shell
+                           exits, execution falls back to a new process per
+                           run.
+        :param timeout: The maximum time, in seconds, to let a run take. If it
+                        takes longer, the command and any processes it started
+                        are killed (a Python function is left to finish in the
+                        background) and the run is shown as timed out, with a
+                        return code of 124. ``None`` to wait forever.
+        :param slots: A ``RunSlots`` instance limiting how many commands can
+                      be running at once, shared with other instances. Runs
+                      which are due are delayed until a slot is free.
+        :param overrun: In precise mode, what to do about runs missed while the
+                        command took longer than ``interval`` to run;
+                        ``'skip'``, ``'coalesce'`` or ``'burst'``. See the
+                        ``Scheduler`` class.
+        :param jitter: Delay each run by a random time of up to this many
+                       seconds.
+        :param align: Run at multiples of ``interval`` on the clock (e.g., on
+                      the minute for an interval of 60). Implies precise mode.
+        :param history: The memory budget, in bytes, for keeping the output of
+                        past runs so the user can step back through them. Zero
+                        to keep no history.
+        :param stream: How to write the output with ``run_stream()``, which is
+                       used instead of ``run()`` if this is given: ``'full'``,
+                       ``'diff'`` or ``'json'``. See ``run_stream()``.
+        :param record: A ``Recorder`` to record every run to.
+        :param replay: A ``Recording`` to replay instead of running the command.
+                       The runs are shown with the same gaps between them as
+                       when they were recorded, divided by ``speed``.
+        :param speed: How many times faster than real time to replay.
+        :param seek: The run to start replaying from.
+        :param show_unchanged: Whether to show in the header how many runs in a
+                               row have had the same output, and since when.
+        :param stats_file: A file to add the timings of each stage of the main
+                           loop to when finished, as a line of JSON.
+        :param max_lines: The most lines of each run's output to keep, half
+                          from the start and half from the end, or 0 for no
+                          limit. See the ``Capture`` class.
+        :param max_bytes: The most bytes of each run's output to keep, in the
+                          same way, or 0 for no limit.
+        :param spill: Whether to keep the lines left out in a temporary file,
+                      so the user can page through them.
+        :param line_filter: A ``Filter`` to pass the output through before it
+                            is displayed. The user can turn it on and off.
+        :param max_interval: If given, the interval doubles after each run
+                             whose output is the same as the last, up to this
+                             many seconds, and goes back to ``interval`` when
+                             the output changes or a key is pressed.
+        :param serve: A ``Server`` to send each run to, for ``run_serve()``,
+                      which is used instead of ``run()`` if this is given.
+        :param attach: An ``Attachment`` to a server to show the runs of
+                       instead of running the command.
+
+        """
+        # Details for the header. The time of the last execution is stored so it
+        # can be used when the window is resized etc.
+        # We do this before checking the command is in the right format for the
+        # shell setting to avoid having to special-case depending on whether the
+        # command is then a string or a list -- at this point it is a list in
+        # either case and this gives the correct display.
+        # A Python function is given as the function itself or a string naming
+        # it; load it in the latter case.
+        self.function = None
+        if isinstance(command, str):
+            self.function = load_function(command)
+            command = [command]
+        elif callable(command):
+            self.function = command
+            command = [getattr(command, '__name__', repr(command))]
+
+        self._command_str = ' '.join(command)
+        self.header_time = None
+        self._last_return_code = None
+
+        # When the current (or last) run started on the monotonic clock, how
+        # long the last run took, and the time it finished.
+        self.run_started = None
+        self.run_duration = None
+        self.finished_at = None
+
+        # Try to auto-detect if we need shell mode.
+        if self.function is not None:
+            shell = False
+        elif shell is None:
+            # Multiple arguments --> shell not needed.
+            if len(command) > 1:
+                shell = False
+
+            # One argument --> check for presence of special characters which
+            # need an external shell to handle properly.
+            else:
+                shell = any(char in command[0] for char in shell_chars)
+
+                # Shell mode needed --> command needs to be a single string.
+                if shell:
+                    command = command[0]
+
+        # Shell mode forced on. In this case the command needs to be a single
+        # string.
+        elif shell:
+            command = ' '.join(command)
+
+        # Store the details we were given.
+        self.command = command
+        self.shell = shell
+        self.interval = interval
+        self.precise_mode = precise_mode or align
+        self.scheduler = Scheduler(interval, precise_mode, overrun, jitter,
+                                   align, max_interval)
+        self._interval_title()
+        self.errexit = errexit
+        self.beep = beep
+        self.color = color
+        self.header = header
+        self.returncode = returncode
+        self.event_loop = event_loop
+        self.persistent = persistent
+        self.timeout = timeout
+        self.slots = slots
+        self.stream = stream
+        self.record = record
+        self.show_unchanged = show_unchanged
+
+        # Timings of the stages of the main loop, the time spent reading the
+        # current run so far, and whether to show the timings on screen.
+        self.stats = Stats()
+        self.stats_file = stats_file
+        self._read_time = 0.0
+        self.show_stats = False
+
+        # The current search, if any. While the user is typing a search
+        # pattern, the prompt (the / or ? and what has been typed so far) is
+        # shown in place of the header; a message for the user, such as an
+        # error, is shown there until the next key press.
+        self.search = None
+        self.prompt = None
+        self.message = None
+        self._scratch = LineStore()
+
+        # The recording being replayed, the next run to show from it and
+        # when it is due, and whether the replay is paused.
+        self.replay = replay
+        self.speed = speed
+        self._replay_pos = seek
+        self._replay_due = None
+        self.paused = False
+        self._paused_left = 0
+        if replay is not None:
+            self._replay_title()
+
+        # The server the runs are sent to, or the server they come from, the
+        # messages from it not yet handled, the output of the last run it sent
+        # and the interval it is running the command at.
+        self.serve = serve
+        self.attach = attach
+        self._attach_queue = collections.deque()
+        self._attach_lines = []
+        self._attach_interval = interval
+
+        # Precompute difference info for efficiency.
+        self.differences = differences is not None
+        self.c_diff = False
+        self.l_diff = False
+        if self.differences:
+            if differences.lower().startswith('c'):
+                self.c_diff = True
+            elif differences.lower().startswith('l'):
+                self.l_diff = True
+
+        # Masks of which characters in each line of the output are highlighted
+        # as changed, for the previous run and the run in progress. Before the
+        # first run has completed there is nothing to compare against,
+        # indicated by None.
+        self._old_marks = None
+        self._new_marks = []
+
+        # The persistent shell, if in use, and the marker used to find the end
+        # of the current run's output from it, plus the return code of the
+        # run once it has been seen.
+        self._shell = None
+        self._sentinel = None
+        self._shell_rcode = None
+
+        # The thread calling the Python function, if one is running, the list
+        # its result is put in, and the time by which it must finish.
+        self._worker = None
+        self._result = None
+
+        # The time by which the current run must finish, the reason for giving
+        # up on the current run early ('timed out' or 'cancelled') if any, and
+        # how the last run ended if it was given up on.
+        self._deadline = None
+        self._abort = None
+        self._last_status = None
+
+        # Processes which have been killed but have not yet exited.
+        self._orphans = []
+
+        # The output of the current run, a running hash of it, and the hash
+        # of the last run's output. If a run's output is the same as the last
+        # one's, it doesn't need processing or displaying. The number of runs
+        # in a row whose output has been the same, and the time the output last
+        # changed, are kept for the header. We also need to know if there are
+        # any differences highlighted on screen, as they need to be cleared.
+        # Without a display, the output is only hashed to adapt the interval.
+        self._run_lines = []
+        self._hash_runs = True
+        self._run_hash = hashlib.sha1()
+        self._last_digest = None
+        self._highlighted = False
+        self.unchanged_runs = 0
+        self.changed_at = None
+
+        # The output of past runs, if we're keeping it, and the lines of the
+        # current run to add to it. When the user is looking at a past run, or
+        # comparing with one, it is shown from the extra store _past, and the
+        # serial numbers of the run shown (None for the latest) and the one
+        # compared with (None for the previous run) are kept.
+        self.history = None
+        if history > 0:
+            self.history = History(history)
+        self._past = None
+        self._viewing = None
+        self._compare = None
+
+        # Some basic variables.
+        self._process = None
+        self._have_slot = False
+        self.dirty = False
+        self.screen = None
+        self.store = LineStore()
+        self._new_store = LineStore()
+
+        # The area of the screen to use, as a tuple (top, left, height, width),
+        # or None for the whole screen, and whether this instance has the
+        # keyboard focus when sharing the screen with others.
+        self.region = None
+        self.top = 0
+        self.left = 0
+        self.focused = False
+
+        # Buffers for data read from the command's stdout and stderr pipes,
+        # plus a map from the file descriptors of any pipes still open to the
+        # corresponding buffer. Any incomplete line at the end of the data read
+        # so far is kept in the buffer until the rest of it arrives.
+        self._stdout_buffer = bytearray()
+        self._stderr_buffer = bytearray()
+        self._buffers = {}
+
+        # What is currently on the screen: the header text and display mode,
+        # and the (text, displaystyle) segments on each row of the content.
+        # These are used to only draw the parts of the screen which change.
+        # The damaged flag is set when anything is drawn and so the physical
+        # screen needs updating.
+        self._shown_header = None
+        self._shown = []
+        self._damaged = False
+
+        # The number of bytes of text drawn in the last screen update, and in
+        # total. This doesn't include the cursor movement and attribute escape
+        # sequences curses adds, but is a good measure of how much is sent to
+        # the terminal.
+        self.refresh_bytes = 0
+        self.total_refresh_bytes = 0
+        self._drawn_bytes = 0
+
+        # Self-pipe used by the signal handlers and worker threads to wake the
+        # event loop up.
+        self._wakeup = None
+
+        # The width and height of the screen (i.e., the controlling terminal).
+        self.screen_width = 0
+        self.screen_height = 0
+
+        # The y-position, width and height of the content we wish to display.
+        self.content_y = 2 if self.header else 0
+        self.content_height = 0
+        self.content_width = 0
+
+        # The width and height of each 'page' of the display (i.e, the maximum
+        # area of content we can put on the screen at any one time). Smaller
+        # than the screen width due to headers etc.
+        self.page_height = 0
+        self.page_width = 0
+
+        # Position within the content of the top-left character of the display.
+        self.x = 0
+        self.y = 0
+
+        # Maximum limits of the previous x and y variables.
+        self.bottom = 0
+        self.right = 0
+
+        # State variables used for processing terminal escape codes: the
+        # current display style as a (foreground, background, attributes)
+        # tuple, and the curses attribute for it.
+        self._sgr_state = default_sgr
+        self.cur_escape = curses.A_NORMAL
+
+        # The colours in use on the screen, which may be shared with other
+        # instances.
+        self.palette = Palette()
+
+        # Cache of the style resulting from applying an SGR sequence to a style.
+        self._sgr_cache = {}
+
+        # In Python 3 and above, the subprocess returns raw bytes which we need
+        # to decode into strings. Lets figure out the appropriate encoding to
+        # decode with.
+        if sys.hexversion >= 0x03000000:
+            import locale
+            locale.setlocale(locale.LC_ALL, '')
+            self.decode = locale.getpreferredencoding()
+        else:
+            self.decode = False
+
+        # The output of the run in progress is collected through this, which
+        # limits how much of it is kept. The lines left out of the latest run
+        # shown, if they were kept, and the line saying how many there were in
+        # the run just finished.
+        self.capture = Capture(max_lines, max_bytes,
+                               spill and not (stream or serve),
+                               'utf-8' if self.decode else None, self.color)
+        self._spill = None
+
+        # The longest line to wait for the end of before splitting it up, so
+        # that output without newlines can't use up all the memory either. The
+        # parts are small enough for some to be kept at the start and the end.
+        self.max_line = None
+        if max_bytes:
+            self.max_line = max(max_bytes // 4, read_size)
+
+        # The filter to pass the output through, and whether it is turned on.
+        # The latest output is kept as it was before filtering, along with the
+        # line number of the line saying how much of it was left out (if any),
+        # so that it can be filtered again when the filter is changed.
+        self.line_filter = line_filter
+        self.filtering = bool(line_filter)
+        self._raw_lines = []
+        self._raw_marker = None
+
+    @classmethod
+    def from_arguments(klass, program_name, *args):
+        """Factory method which takes a set of command line arguments and
+        returns an instance of WatchLess set up as per those arguments. If the
+        user asks for a help message, or there are errors in the arguments, the
+        appropriate output will be printed and a SystemExit raised to indicate
+        processing is complete.
+
+        :param program_name: The name of the program as it should be displayed
+                             in any help/usage messages.
+
+        """
+        parser.prog = program_name
+        options, command = klass.parse_arguments(args)
+        return klass.from_options(options, command)
+
+    @classmethod
+    def parse_arguments(klass, args, defaults=None):
+        """Run a set of command line arguments through the parser, printing
+        errors/help and exiting as appropriate.
+
+        :param defaults: The option values to start from, e.g., those parsed
+                         for a previous command. ``None`` to use the defaults.
+        :return: A tuple (options, command).
+
+        """
+        args = list(args)
+
+        # Figure out the difference mode the user wants, if any. optparse does
+        # not allow optional arguments to options, so to make the command-line
+        # interface to match that of the original watch command, we need to do a
+        # bit of pre-processing here.
+        diff_mode = getattr(defaults, 'diff_mode', 'sequential')
+        for i, arg in enumerate(args):
+            if arg.startswith('--differences='):
+                args[i], diff_mode = arg.split('=', 1)
+
+        # Run the arguments through the parser. This will print errors/help and
+        # exit as appropriate.
+        if defaults is not None:
+            defaults = optparse.Values(vars(defaults))
+        options, command = parser.parse_args(args, defaults)
+        options.diff_mode = diff_mode
+
+        # Show the version.
+        if options.version:
+            sys.stdout.write(klass.version)
+            sys.stdout.write('\n')
+            raise SystemExit(0)
+
+        # No command given (and none needed for a replay or attaching).
+        if not command and not (options.replay or options.attach):
+            sys.stdout.write('Error: no command given.\n\n')
+            parser.print_help()
+            raise SystemExit(1)
+
+        return options, command
+
+    @classmethod
+    def from_options(klass, options, command):
+        """Create an instance from the options and command returned by
+        ``parse_arguments()``.
+
+        """
+        # Pull the arguments that were given into a dictionary.
+        initargs = {}
+        if options.interval is not None:
+            initargs['interval'] = options.interval
+        initargs['precise_mode'] = options.precise_mode
+        initargs['errexit'] = options.errexit
+        initargs['beep'] = options.beep
+        initargs['color'] = options.color
+        initargs['header'] = options.header
+        initargs['returncode'] = options.returncode
+        initargs['event_loop'] = options.event_loop
+        initargs['persistent'] = options.persistent
+        initargs['timeout'] = options.timeout
+        initargs['overrun'] = options.overrun
+        initargs['jitter'] = options.jitter
+        initargs['align'] = options.align
+        initargs['max_interval'] = options.max_interval
+        initargs['history'] = int(options.history * 1024 * 1024)
+        initargs['show_unchanged'] = options.show_unchanged
+        initargs['stats_file'] = options.stats_file
+        initargs['max_lines'] = options.max_lines
+        initargs['max_bytes'] = int(options.max_size * 1024 * 1024)
+        initargs['spill'] = options.spill
+        try:
+            initargs['line_filter'] = Filter(
+                options.include, options.exclude, options.columns,
+                options.sort, options.unique)
+        except ValueError:
+            sys.stdout.write('Error: {0!s}\n'.format(sys.exc_info()[1]))
+            raise SystemExit(1)
+        initargs['stream'] = options.stream
+        if options.stream is None and not sys.stdout.isatty():
+            initargs['stream'] = 'full'
+
+        # Replaying a recording, or attaching to a server: the command is only
+        # used for display, and comes from the recording or the server.
+        # Otherwise, set up recording if asked to.
+        if options.replay:
+            try:
+                recording = Recording(options.replay)
+                seek = parse_seek(options.seek or '0', recording)
+            except (IOError, OSError, ValueError):
+                sys.stdout.write('Error: could not replay {0:s}: {1!s}\n'.format(
+                    options.replay, sys.exc_info()[1]))
+                raise SystemExit(1)
+            initargs['replay'] = recording
+            initargs['speed'] = options.speed
+            initargs['seek'] = seek
+            command = [recording.command]
+        elif options.attach:
+            try:
+                initargs['attach'] = Attachment(options.attach)
+            except socket.error:
+                sys.stdout.write('Error: could not attach to {0:s}: {1!s}\n'
+                                 .format(options.attach, sys.exc_info()[1]))
+                raise SystemExit(1)
+            command = [options.attach]
+        if options.record and not options.replay:
+            try:
+                initargs['record'] = Recorder(options.record, ' '.join(command))
+            except (IOError, OSError, ValueError):
+                sys.stdout.write('Error: could not record to {0:s}: {1!s}\n'
+                                 .format(options.record, sys.exc_info()[1]))
+                raise SystemExit(1)
+
+        # Serving the runs to viewers, with the recent ones kept for viewers
+        # which attach later.
+        if options.serve:
+            try:
+                initargs['serve'] = Server(options.serve, ' '.join(command),
+                                           initargs['history'])
+            except socket.error:
+                sys.stdout.write('Error: could not serve on {0:s}: {1!s}\n'
+                                 .format(options.serve, sys.exc_info()[1]))
+                raise SystemExit(1)
+
+        # A Python function: load it, allowing modules in the current directory
+        # to be used, and pass it any arguments given after it.
+        if options.python and not (options.replay or options.attach):
+            if '' not in sys.path:
+                sys.path.insert(0, '')
+            try:
+                function = load_function(command[0])
+            except (ImportError, AttributeError, ValueError):
+                sys.stdout.write('Error: could not load {0:s}: {1!s}\n'.format(
+                    command[0], sys.exc_info()[1]))
+                raise SystemExit(1)
+            wrapped = functools.partial(function, *command[1:])
+            wrapped.__name__ = ' '.join(command)
+            command = wrapped
+
+        # Translate command line difference setting into the format the
+        # initialiser expects.
+        if options.differences:
+            initargs['differences'] = options.diff_mode
+
+        # Create the object and we're done.
+        return klass(command, **initargs)
+
+    def process_command(self):
+        """Execute the command if it is time to and return the results. This
+        takes care of timing the repetition, watching for the output etc. in a
+        non-blocking manner. Call it regularly.
+
+        Output is read from the command's stdout and stderr as it becomes
+        available, so lines are returned in the order they are received while
+        the command is still running.
+
+        :return: A tuple (return_code, output), where the output is in a list of
+                 lines. If the command has not finished, the return code is
+                 ``None``. If there is no new output to return at this time, an
+                 empty list is returned.
+
+        """
+        if self.replay is not None:
+            return self._replay_run()
+        if self.attach is not None:
+            return self._attach_run()
+
+        # Not currently running.
+        if self._process is None and self._worker is None:
+            t = monotonic()
+
+            # Time to run it again.
+            if self.scheduler.due_in(t) <= 0:
+                # Wait for any other commands sharing the limit on running
+                # commands to finish first.
+                if self.slots is not None:
+                    if not self.slots.acquire():
+                        return None, []
+                    self._have_slot = True
+
+                # Start the command running. It gets its own process group so
+                # that everything it starts can be cleaned up afterwards.
+                if self.function is not None:
+                    self._start_function()
+                elif not (self.persistent and self._run_in_shell()):
+                    self._process = spawn(self.command, shell=self.shell,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE)
+                    self._watch_pipes()
+                if self.timeout is not None:
+                    self._deadline = t + self.timeout
+                else:
+                    self._deadline = None
+
+                # Let the scheduler work out when the next run is due.
+                self.run_started = t
+                self.scheduler.started(t)
+
+                # Update the header so that the inverted version is shown to
+                # indicate the command is being run.
+                #self.update_header()
+
+            # Nothing to return at this point.
+            return None, []
+
+        # Check on the run, giving up on it if it has run out of time or been
+        # cancelled.
+        if self._orphans:
+            self._orphans = [p for p in self._orphans if p.poll() is None]
+        if self._abort is None and self._deadline is not None and \
+                monotonic() >= self._deadline:
+            self._abort = 'timed out'
+        if self._abort is not None:
+            rcode, output = self._abandon_run()
+        elif self._worker is not None:
+            rcode, output = self._collect_function()
+        else:
+            rcode, output = self._collect_process()
+        if rcode is None:
+            return None, output
+
+        # Finished. Set the time to run it next and return the output.
+        self._last_status, self._abort = self._abort, None
+        self._release_slot()
+        t = monotonic()
+        self.run_duration = t - self.run_started
+        self.finished_at = time.time()
+        self.header_time = time.localtime(self.finished_at)
+        self.scheduler.finished(t)
+        return rcode, output
+
+    def _replay_run(self):
+        """The replay equivalent of ``process_command()``: return the next
+        run from the recording when it is due.
+
+        """
+        t = monotonic()
+        recording = self.replay
+        pos = self._replay_pos
+        if self.paused or pos >= len(recording) or \
+                (self._replay_due is not None and t < self._replay_due):
+            return None, []
+
+        when, duration, rcode, status, lines = recording.run(pos)
+        self._replay_pos = pos + 1
+        if pos + 1 < len(recording):
+            gap = max(recording.time(pos + 1) - when, 0)
+            self._replay_due = t + gap / self.speed
+        self._last_status = status
+        self.run_duration = duration
+        self.finished_at = when
+        self.header_time = time.localtime(when)
+        return rcode, lines
+
+    def _attach_run(self):
+        """The equivalent of ``process_command()`` when attached to a server:
+        return the next run it has sent, if any.
+
+        """
+        queue = self._attach_queue
+        if not queue and not self.attach.closed:
+            queue.extend(self.attach.read())
+
+        while queue:
+            message = queue.popleft()
+            if message['type'] == 'hello':
+                self._command_str = message['command']
+                self._attach_title()
+                continue
+            self._attach_lines = apply_delta(self._attach_lines,
+                                             message['delta'])
+            if message['interval'] != self._attach_interval:
+                self._attach_interval = message['interval']
+                self._attach_title()
+            self._last_status = message['status']
+            self.run_duration = message['duration']
+            self.finished_at = message['time']
+            self.header_time = time.localtime(self.finished_at)
+            return message['returncode'], self._attach_lines
+
+        # The server has gone away: say so, leaving the last output shown.
+        if self.attach.closed and self._last_status != 'disconnected':
+            self._last_status = 'disconnected'
+            if self.screen is not None:
+                self.update_header()
+        return None, []
+
+    def _attach_title(self):
+        """Set the command shown in the header when attached to a server."""
+        self.cmd_str = 'Every {0!s}s (shared): {1:s}'.format(
+            round(self._attach_interval, 3), self._command_str)
+        self.cmd_str_len = len(self.cmd_str)
+
+    def _interval_title(self):
+        """Set the command shown in the header, with the current interval."""
+        self.cmd_str = 'Every {0!s}s: {1:s}'.format(
+            round(self.scheduler.interval, 3), self._command_str)
+        self.cmd_str_len = len(self.cmd_str)
+
+    def _replay_title(self):
+        """Set the command shown in the header for a replay, which says how
+        fast it is going.
+
+        """
+        if self.paused:
+            state = 'Paused'
+        else:
+            state = 'Replay x{0:g}'.format(self.speed)
+        self.cmd_str = '{0:s}: {1:s}'.format(state, self.replay.command)
+        self.cmd_str_len = len(self.cmd_str)
+
+    def set_speed(self, factor):
+        """Change the replay speed by a factor, keeping the time until the
+        next run in proportion.
+
+        """
+        if self.replay is None:
+            return
+        if self._replay_due is not None:
+            t = monotonic()
+            self._replay_due = t + max(self._replay_due - t, 0) / factor
+        self.speed *= factor
+        self._replay_title()
+        self.update_header()
+
+    def toggle_pause(self):
+        """Pause or resume a replay, keeping the time until the next run."""
+        if self.replay is None:
+            return
+        t = monotonic()
+        if self.paused:
+            self._replay_due = t + self._paused_left
+        elif self._replay_due is not None:
+            self._paused_left = max(self._replay_due - t, 0)
+        else:
+            self._paused_left = 0
+        self.paused = not self.paused
+        self._replay_title()
+        self.update_header()
+
+    def _release_slot(self):
+        """Give back our slot in the limit on running commands, if we have
+        one.
+
+        """
+        if self._have_slot:
+            self.slots.release()
+            self._have_slot = False
+
+    def running(self):
+        """Whether a run of the command is currently in progress."""
+        return self._process is not None or self._worker is not None
+
+    def _collect_process(self):
+        """Gather the output of the command's process and check whether it
+        has finished.
+
+        :return: A tuple (return_code, output) as for ``process_command()``.
+
+        """
+        # Gather any output currently available. When using the persistent
+        # shell, each pipe is finished with once the end-of-run marker has
+        # been seen on it.
+        output = []
+        for fd in list(self._buffers):
+            lines = self._read_lines(fd)
+            if self._sentinel is not None:
+                lines = self._find_sentinel(fd, lines)
+            output.extend(lines)
+
+        # Decode the line to a string if needed.
+        if self.decode:
+            output = [line.decode(self.decode, 'replace') for line in output]
+
+        # Still running. We don't check the status of the process until both
+        # pipes have been closed so that no output is lost.
+        if self._buffers:
+            return None, output
+
+        # Run in the persistent shell completed.
+        if self._sentinel is not None and self._shell_rcode is not None:
+            rcode = self._shell_rcode
+            self._sentinel = None
+
+        # Otherwise the process must have exited.
+        else:
+            if self._process.poll() is None:
+                return None, output
+            rcode = self._process.returncode
+            self._process.stdout.close()
+            self._process.stderr.close()
+
+            # Kill anything the command left running, e.g., in the background.
+            kill_group(self._process)
+
+            # The persistent shell died (most likely the command ran 'exit').
+            # Fall back to starting a new process for each run.
+            if self._process is self._shell:
+                self._process.stdin.close()
+                self._shell = None
+                self._sentinel = None
+                self.persistent = False
+
+        self._process = None
+        return rcode, output
+
+    def cancel(self):
+        """Give up on the run in progress, if there is one. The command and
+        anything it started are killed. The run is finished with on the next
+        call to ``process_command()``.
+
+        """
+        if self.running() and self._abort is None:
+            self._abort = 'cancelled'
+
+    def _abandon_run(self):
+        """Give up on the run in progress, as requested by ``_abort``. A
+        Python function is left running in the background, since there's no
+        way to stop a thread. A process is killed, along with anything it
+        started; we don't wait for it to exit in case it is stuck in the kernel
+        (e.g., on a hung NFS mount), but it will be reaped when it does.
+
+        :return: A tuple (return_code, output) as for ``process_command()``.
+
+        """
+        process = self._process
+        if process is not None:
+            kill_group(process)
+            process.stdout.close()
+            process.stderr.close()
+            self._buffers = {}
+
+            # The persistent shell has been killed along with the command; a
+            # new one will be started for the next run.
+            if process is self._shell:
+                process.stdin.close()
+                self._shell = None
+                self._sentinel = None
+
+            if process.poll() is None:
+                self._orphans.append(process)
+            self._process = None
+
+        self._worker = None
+        self._result = None
+
+        if self._abort == 'timed out':
+            return 124, ['watchless: timed out after {0:g}s'.format(
+                self.timeout)]
+        return 130, ['watchless: cancelled']
+
+    def _start_function(self):
+        """Start a run of the Python function in a worker thread. The thread
+        puts the result into a list specific to this run, so that if we give
+        up on it, a late result can't be mistaken for that of a later run.
+
+        """
+        result = []
+
+        def worker():
+            try:
+                result.append(function_result(self.function()))
+            except Exception:
+                # Leave this function out of the traceback.
+                etype, value, tb = sys.exc_info()
+                lines = traceback.format_exception(etype, value, tb.tb_next)
+                result.append((1, ''.join(lines).splitlines()))
+
+            # Wake up the event loop to collect the result.
+            if self._wakeup is not None:
+                self._wakeup.notify(b'f')
+
+        self._result = result
+        self._worker = threading.Thread(target=worker)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _collect_function(self):
+        """Check whether the Python function has returned.
+
+        :return: A tuple (return_code, output) as for ``process_command()``.
+
+        """
+        if not self._result:
+            return None, []
+        rcode, output = self._result[0]
+
+        self._worker = None
+        self._result = None
+        return rcode, output
+
+    def _watch_pipes(self):
+        """Prepare to read the output of a new run from the stdout and stderr
+        pipes of the current process without blocking.
+
+        """
+        del self._stdout_buffer[:]
+        del self._stderr_buffer[:]
+        self._buffers = {
+            self._process.stdout.fileno(): self._stdout_buffer,
+            self._process.stderr.fileno(): self._stderr_buffer,
+        }
+        for fd in self._buffers:
+            set_nonblocking(fd)
+
+    def _run_in_shell(self):
+        """Start a run of the command in the persistent shell, starting the
+        shell first if needed. After the command, the shell prints a unique
+        marker and the return code on stdout, and the marker on stderr, so we
+        can tell where the output of this run ends.
+
+        :return: ``True`` if the command was started, ``False`` if the shell
+                 could not be used.
+
+        """
+        if self._shell is None:
+            try:
+                self._shell = spawn(['/bin/sh'], stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            except OSError:
+                self.persistent = False
+                return False
+
+        if self.shell:
+            command = self.command
+        else:
+            command = ' '.join([quote(arg) for arg in self.command])
+
+        # The command is run in a group with stdin from /dev/null so it can't
+        # read the rest of what we send to the shell. It is quoted and passed
+        # to eval, so a syntax error in it is only an error in this run rather
+        # than swallowing the lines after it; through 'command', so the shell
+        # doesn't exit on the error either. The marker has a random part so it
+        # can't turn up in the output by accident.
+        self._sentinel = '__watchless_{0:s}__'.format(
+            binascii.hexlify(os.urandom(8)).decode('ascii'))
+        script = ('{{ command eval {0:s}\n}} </dev/null\n'
+                  "printf '%s %d\\n' {1:s} $?\n"
+                  "printf '%s\\n' {1:s} >&2\n").format(quote(command),
+                                                        self._sentinel)
+        self._sentinel = self._sentinel.encode('ascii')
+        self._shell_rcode = None
+
+        try:
+            self._shell.stdin.write(script.encode(self.decode or 'ascii'))
+            self._shell.stdin.flush()
+        except (IOError, OSError):
+            # The shell has died. Fall back to running the command directly.
+            self._shell.stdin.close()
+            self._shell.wait()
+            self._shell = None
+            self._sentinel = None
+            self.persistent = False
+            return False
+
+        self._process = self._shell
+        self._watch_pipes()
+        return True
+
+    def _find_sentinel(self, fd, lines):
+        """Look for the end-of-run marker from the persistent shell in some
+        lines read from one of its pipes. If it is found, the pipe is finished
+        with for this run and the return code is picked up from stdout.
+
+        :return: The lines of output before the marker.
+
+        """
+        for i, line in enumerate(lines):
+            pos = line.find(self._sentinel)
+            if pos == -1:
+                continue
+
+            # If the command's output didn't end with a newline, the marker
+            # will be on the end of the last line of output.
+            if fd == self._shell.stdout.fileno():
+                rest = line[pos + len(self._sentinel):]
+                try:
+                    self._shell_rcode = int(rest)
+                except ValueError:
+                    self._shell_rcode = -1
+            self._buffers.pop(fd, None)
+            if pos:
+                return lines[:i] + [line[:pos]]
+            return lines[:i]
+
+        return lines
+
+    def close(self):
+        """Shut down any process still running. This is called when the
+        display exits, but should also be called if the instance is being used
+        without ``run()``.
+
+        """
+        # Give the processes killed a moment to exit so they are reaped, but
+        # don't wait for any stuck in the kernel (see ``_abandon_run()``).
+        killed = [process for process in (self._process, self._shell)
+                  if process is not None]
+        for process in killed:
+            kill_group(process)
+        killed.extend(self._orphans)
+        deadline = monotonic() + 0.5
+        while killed and monotonic() < deadline:
+            killed = [process for process in killed if process.poll() is None]
+            if killed:
+                time.sleep(0.01)
+        self._process = None
+        self._shell = None
+        self._orphans = []
+        if self.record is not None:
+            self.record.close()
+            self.record = None
+        if self.serve is not None:
+            self.serve.close()
+        if self.attach is not None:
+            self.attach.close()
+        if self.stats_file is not None:
+            self.dump_stats(self.stats_file)
+            self.stats_file = None
+
+        # There is no way to stop a thread, but as a daemon it won't stop the
+        # program exiting.
+        self._worker = None
+        self._release_slot()
+
+    def dump_stats(self, path):
+        """Add the timings of the stages of the main loop to a file, as a
+        line of JSON with a summary of each stage as given by
+        ``Stats.summary()``, along with the command and the number of lines of
+        output handled per second.
+
+        """
+        stats = {
+            'command': self.cmd_str,
+            'time': time.time(),
+            'stages': self.stats.summary(),
+            'lines': self.stats.lines,
+            'lines_per_second': self.stats.lines_per_second(),
+        }
+        if self.history is not None:
+            stats['history_bytes'] = self.history.size
+        try:
+            with open(path, 'a') as f:
+                f.write(json.dumps(stats, sort_keys=True))
+                f.write('\n')
+        except (IOError, OSError):
+            sys.stderr.write('watchless: could not write stats to {0:s}: '
+                             '{1!s}\n'.format(path, sys.exc_info()[1]))
+
+    def _read_lines(self, fd):
+        """Read whatever data is waiting on one of the command's pipes without
+        blocking, and return any complete lines. If the end of the pipe is
+        reached, any incomplete final line is returned as well and the pipe is
+        removed from the set of those being read.
+
+        """
+        buf = self._buffers[fd]
+        eof = False
+        for i in range(read_chunks):
+            try:
+                chunk = os.read(fd, read_size)
+            except OSError:
+                # The error isn't kept in a local variable: that would make a
+                # reference cycle through the traceback, keeping the caller's
+                # frames (and the output in them) alive until the garbage
+                # collector next runs.
+                if sys.exc_info()[1].errno in (errno.EAGAIN, errno.EWOULDBLOCK,
+                                               errno.EINTR):
+                    break
+                raise
+            if not chunk:
+                eof = True
+                break
+            buf.extend(chunk)
+
+        # Split off the complete lines, leaving any partial line behind.
+        if eof:
+            del self._buffers[fd]
+            end = len(buf)
+        else:
+            end = buf.rfind(b'\n') + 1
+        lines = []
+        if end:
+            lines = bytes(buf[:end]).splitlines()
+            del buf[:end]
+
+        # A partial line too long to keep waiting for the end of is split up,
+        # but not in the middle of a UTF-8 character, and leaving the end of
+        # it in case the start of the persistent shell's marker is there.
+        if self.max_line is not None:
+            while len(buf) > self.max_line + line_overlap:
+                end = self.max_line
+                while end and buf[end] & 0xc0 == 0x80:
+                    end -= 1
+                lines.append(bytes(buf[:end]))
+                del buf[:end]
+        return lines
+
+    def calculate_sizes(self):
+        """Calculate the screen and page heights, plus the x- and y-positions of
+        the bottom and right hand side of the content. Call whenever the
+        content changes or a screen resize notification is received.
+
+        """
+        # Get the screen size (or that of our part of it), and from this the
+        # size of the page we can display. Note we need to subtract one to get
+        # the 'index' of the last available column and row.
+        if self.region is None:
+            self.top = self.left = 0
+            screenh, screenw = self.screen.getmaxyx()
+        else:
+            self.top, self.left, screenh, screenw = self.region
+        self.screen_height = screenh - 1
+        self.screen_width = screenw - 1
+        self.page_height = self.screen_height - self.content_y
+        self.page_width = self.screen_width
+
+        # Calculate the maximum x and y positions for the display. Note that
+        # this is the (x, y) coordinate within the content that should be at the
+        # top-left of the available area so that the bottom/right content is
+        # visible at the bottom-right corner of the display.
+        self.right = self.content_width - self.page_width
+        self.bottom = self.content_height - self.page_height
+
+    def handle_keys(self):
+        """Receive any keys pressed by the user and update the instance
+        variables appropriately. If the display of the content needs to be
+        changed (e.g., if the user scrolled the page), the ``dirty`` attribute
+        is set to ``True``. Since curses reports screen resize events as a key
+        press, resizes are also handled by this method.
+
+        This method is designed to work in a non-blocking manner. It returns
+        ``False`` if there were no keys waiting, and ``True`` otherwise.
+
+        NB. The x- and y-position attributes are not bounds checked after being
+        changed; this needs to be performed by the caller. The reasoning behind
+        this is that the bounds may change anyway (e.g., if the content has
+        changed), so the caller would have to do the check anyway.
+
+        """
+        # Get any pending key. In no-delay mode, -1 means there was no key
+        # waiting.
+        key = self.screen.getch()
+        if key == -1:
+            return False
+        self.handle_key(key)
+        return True
+
+    def handle_key(self, key):
+        """Act on a single key press, as received by ``handle_keys()``."""
+        # The user is paying attention, so keep the output up to date.
+        if key != curses.KEY_RESIZE:
+            self.adapt_interval(True)
+            self.update_header()
+        if self.message is not None:
+            self.message = None
+            self.invalidate()
+        if self.prompt is not None:
+            self.prompt_key(key)
+            return
+
+        # Page movement keys.
+        if key == curses.KEY_UP:
+            self.y -= 1
+            self.dirty = True
+        elif key == curses.KEY_DOWN:
+            self.y += 1
+            self.dirty = True
+        elif key == curses.KEY_NPAGE or key == 519:
             # 519 == control-down
             self.y += self.page_height
             self.dirty = True
@@ -407,6 +3940,34 @@ class WatchLess(object):
         elif key == curses.KEY_HOME:
             self.y = 0
             self.dirty = True
+        elif key == ord('k'):
+            self.cancel()
+        elif key == ord('['):
+            self.step_history(-1)
+        elif key == ord(']'):
+            self.step_history(1)
+        elif key == ord('m'):
+            self.toggle_compare()
+        elif key == ord('+'):
+            self.set_speed(2.0)
+        elif key == ord('-'):
+            self.set_speed(0.5)
+        elif key == ord('p'):
+            self.toggle_pause()
+        elif key == ord('s'):
+            self.show_stats = not self.show_stats
+            self.dirty = True
+        elif key == ord('f'):
+            self.toggle_filter()
+        elif key == ord('/') or key == ord('?') or key == ord('&'):
+            self.prompt = bytearray([key])
+            self.update_header()
+        elif key == ord('e'):
+            self.toggle_elided()
+        elif key == ord('n'):
+            self.next_match(True)
+        elif key == ord('N'):
+            self.next_match(False)
         elif key == 539:
             # Control-left
             self.x -= self.page_width
@@ -416,58 +3977,338 @@ class WatchLess(object):
             self.x += self.page_width
             self.dirty = True
 
-        # Resize signals are sent via getch (go figure). When the screen is
-        # resized, we need to recalculate the page area etc. A full screen
-        # refresh (in addition to the pad refresh to update the content) is
-        # needed to clear any artifacts.
+        # Resize signals are sent via getch (go figure).
         elif key == curses.KEY_RESIZE:
-            self.calculate_sizes()
+            self.handle_resize()
+
+    def toggle_elided(self):
+        """Switch between the latest output and the lines left out of it,
+        if they were kept (see the ``spill`` option).
+
+        """
+        if isinstance(self._past, SpillStore):
+            self.show_run(None)
+        elif self._viewing is None and self._spill is not None:
+            self._past = SpillStore(self._spill)
+            self.y = self.x = 0
+            self._show_store()
+
+    def prompt_key(self, key):
+        """Act on a key pressed while the user is typing a search pattern, or
+        a pattern to filter the lines by after pressing ``&``. Enter starts the
+        search (an empty pattern repeats the last search) or sets the filter
+        (an empty pattern clears it), Escape abandons it, and backspacing past
+        the start of the pattern abandons it as with less.
+
+        """
+        if key in (10, 13, curses.KEY_ENTER):
+            prompt, self.prompt = self.prompt, None
+            self.invalidate()
+            forward = prompt[:1] == b'/'
+            pattern = bytes(prompt[1:])
+            if self.decode:
+                pattern = pattern.decode(self.decode, 'replace')
+            if prompt[:1] == b'&':
+                self.set_include(pattern)
+            elif pattern:
+                self.start_search(pattern, forward)
+            elif self.search is not None:
+                self.search.forward = forward
+                self.next_match(True)
+        elif key == 27:
+            self.prompt = None
+            self.invalidate()
+        elif key in (8, 127, curses.KEY_BACKSPACE):
+            del self.prompt[-1:]
+            if len(self.prompt) == 0:
+                self.prompt = None
+                self.invalidate()
+            else:
+                self.update_header()
+        elif 32 <= key < 256:
+            self.prompt.append(key)
             self.update_header()
-            self.screen.refresh()
-            self.dirty = True
+
+    def start_search(self, pattern, forward):
+        """Start a new search, and move to the first match after (or before)
+        the top of the page.
+
+        """
+        try:
+            search = Search(pattern, forward)
+        except re.error:
+            self.message = 'Invalid pattern: {0!s}'.format(sys.exc_info()[1])
+            self.update_header()
+            return
+        self.search = search
+        search.reset(self.store if self._past is None else self._past)
+        self.dirty = True
+        if forward:
+            self.find_match(self.y - 1, True)
+        else:
+            self.find_match(self.y + self.page_height, False)
+
+    def next_match(self, same):
+        """Move to the next match of the current search, in the same direction
+        as the search (``n``) or the opposite direction (``N``). The search
+        carries on from the last match if it is on the page, otherwise from
+        the page shown.
+
+        """
+        search = self.search
+        if search is None:
+            return
+        forward = search.forward == same
+        current = search.current
+        if current is None or not self.y <= current < self.y + self.page_height:
+            current = self.y - 1 if forward else self.y + self.page_height
+        self.find_match(current, forward)
+
+    def find_match(self, index, forward):
+        """Move to the first match of the current search after (or before) a
+        line, showing it at the top of the page.
+
+        """
+        match = self.search.find(index, forward)
+        if match is None:
+            self.message = 'Pattern not found'
+            self.update_header()
+            return
+        self.search.current = match
+        self.y = match
+        self.dirty = True
+
+    def follow_search(self, old):
+        """Keep the match last moved to in the same place on the page when the
+        output changes, as far as possible, by finding where its line has
+        moved to. If it has changed or gone, the next match after where it was
+        is used instead.
+
+        :param old: The lines of the output before the change.
+
+        """
+        search = self.search
+        current = search.current
+        search.reset(self.store)
+        if current is None or not self.y <= current < self.y + self.page_height:
+            return
+        index = moved_line(old, self.store.lines, current)
+        if index is None or not search.spans(index):
+            index = search.find(current - 1, True)
+            if index is None:
+                return
+        search.current = index
+        self.y += index - current
+        self.dirty = True
+
+    def search_segments(self, store, index, spans, width):
+        """Get the visible part of a line with the matches of the search
+        highlighted, as for ``LineStore.segments()``.
+
+        """
+        mask = bytearray(len(store.lines[index]))
+        for start, end in spans:
+            mask[start:end] = b'\x01' * (end - start)
+        scratch = self._scratch
+        scratch.clear()
+        scratch.append(highlight_pieces(store.pieces(index), mask,
+                                        curses.A_REVERSE))
+        return scratch.segments(0, self.x, width)
+
+    def handle_resize(self):
+        """Respond to the terminal being resized. The whole screen needs to be
+        redrawn to clear any artifacts.
+
+        """
+        self.screen.clear()
+        self.invalidate()
+
+    def invalidate(self):
+        """Recalculate the page area etc. and forget what we think is on the
+        screen, so that everything is redrawn. Call after the screen or our
+        region of it has changed size or been cleared.
+
+        """
+        self.calculate_sizes()
+        self._shown_header = None
+        del self._shown[:]
+        self.update_header()
+        self.dirty = True
+
+    def wait_fds(self):
+        """Find what the main loop needs to wait for on our behalf.
+
+        :return: A tuple (fds, timeout) of a list of file descriptors to wait
+                 for, and the maximum time in seconds to wait (``None`` for no
+                 limit).
+
+        """
+        # Still searching the output: carry on as soon as possible.
+        if self.search is not None and not self.search.complete:
+            return [], 0
+
+        # Command running: wait for it to produce some output or close its
+        # pipes. Once the pipes are closed, the SIGCHLD handler will wake us up
+        # when it exits. A Python function's worker thread wakes us up when it
+        # is done. Either way, we may need to give up on it first.
+        if self.running():
+            if self._deadline is None:
+                return list(self._buffers), None
+            return list(self._buffers), max(self._deadline - monotonic(), 0)
+
+        # Replaying: wait for the next run from the recording, if any.
+        if self.replay is not None:
+            if self.paused or self._replay_pos >= len(self.replay):
+                return [], None
+            if self._replay_due is None:
+                return [], 0
+            return [], max(self._replay_due - monotonic(), 0)
+
+        # Attached to a server: wait for it to send a run, unless there are
+        # some still to handle.
+        if self.attach is not None:
+            if self._attach_queue:
+                return [], 0
+            if self.attach.closed:
+                return [], None
+            return [self.attach.fd], None
+
+        # Otherwise wait until the next run is due. If it is due but is waiting
+        # for another command to finish, that will wake us up.
+        timeout = max(self.scheduler.due_in(monotonic()), 0)
+        if timeout == 0 and self.slots is not None and \
+                not self.slots.available():
+            return [], None
+        return [], timeout
+
+    def wait_for_events(self):
+        """Block until the main loop has something to do: a key has been
+        pressed, the command has produced some output, the terminal has been
+        resized or it is time to run the command again.
+
+        In polling mode (``event_loop=False``) this just sleeps for 10ms.
+
+        """
+        if not self.event_loop:
+            time.sleep(0.01)
+            return
+
+        fds, timeout = self.wait_fds()
+        fds.extend([sys.stdin.fileno(), self._wakeup.fd])
+        ready = wait_readable(fds, timeout)
+        if self._wakeup.fd in ready:
+            if b'w' in self._wakeup.drain() and resize_terminal():
+                self.handle_resize()
 
     def update_header(self):
         """Updates the header at the top of the screen with the command being
         executed and the time that the last execution finished. Should be called
-        whenever execution finished or the screen is resized.
+        whenever execution finished or the screen is resized. Nothing is drawn
+        if the header is the same as that already on the screen.
+
+        """
+        # The search prompt, or a message, takes the place of the header.
+        if self.prompt is not None or self.message is not None:
+            if self.prompt is not None:
+                text = bytes(self.prompt)
+                if self.decode:
+                    text = text.decode(self.decode, 'replace')
+                text = text[-self.screen_width:]
+            else:
+                text = self.message[:self.screen_width]
+            text = text.ljust(self.screen_width)
+            if (text, curses.A_BOLD) != self._shown_header:
+                self._shown_header = (text, curses.A_BOLD)
+                self.screen.addstr(self.top, self.left, text, curses.A_BOLD)
+                self._damaged = True
+                self._drawn_bytes += self._byte_length(text)
+            return
 
-        """
         if not self.header:
             return
 
         # How to display the header: inverted if the command is currently
-        # running, normal if it is not.
-        if self._process is not None:
+        # running, normal if it is not, and bold if we have the focus.
+        if self.running():
             mode = curses.A_REVERSE
         else:
             mode = curses.A_NORMAL
+        if self.focused:
+            mode |= curses.A_BOLD
 
-        # Write over the existing header. By clearing it this way rather than
-        # with the curses clrtoeol() function, the 'background' of the header
-        # will also be inverted if appropriate.
-        self.screen.addstr(0, 0, ' ' * self.screen_width, mode)
+        # The header is built up as a single string the width of the screen.
+        # By padding it with spaces rather than using the curses clrtoeol()
+        # function, the 'background' of the header will also be inverted if
+        # appropriate.
+        text = ' ' * self.screen_width
+
+        # Details of the run shown: a past one if the user has gone back
+        # through the history, otherwise the latest.
+        if self._viewing is not None:
+            header_time, rcode, status = self.history.info(self._viewing)
+        else:
+            header_time = self.header_time
+            rcode = self._last_return_code
+            status = self._last_status
 
         # If the command has been executed, show the time the execution
         # completed.
-        if self.header_time:
+        if header_time:
             # Let the time module convert it to a string in the appropriate
             # locale.
-            tstr = time.strftime('%c', self.header_time)
+            tstr = time.strftime('%c', header_time)
+
+            # Say if the output is filtered.
+            if self.filtering:
+                tstr = "[filtered] {0:s}".format(tstr)
+
+            # Say if the lines left out of the output are shown.
+            if isinstance(self._past, SpillStore):
+                tstr = "[left out] {0:s}".format(tstr)
+
+            # Say which run from the history is shown and, with an asterisk,
+            # whether it is being compared against a chosen run.
+            if self._viewing is not None or self._compare is not None:
+                history = self.history
+                if self._viewing is None:
+                    position = len(history)
+                else:
+                    position = self._viewing - history.first + 1
+                tstr = "{0:s}{1:d}/{2:d} {3:s}".format(
+                    '*' if self._compare is not None else '', position,
+                    len(history), tstr)
 
-            # Add in the return code of the last run.
-            if self.returncode and self._last_return_code is not None:
+            # Say how long the output has been the same, if asked to.
+            if self.show_unchanged and self.unchanged_runs and \
+                    self._viewing is None:
+                tstr = "[same {0:d}x since {1:s}] {2:s}".format(
+                    self.unchanged_runs,
+                    time.strftime('%H:%M:%S', self.changed_at), tstr)
+
+            # In precise mode, show how well the schedule is being kept to, if
+            # there is room.
+            stats = self.precise_mode and self.scheduler.summary()
+            if stats and self.screen_width > (16 + self.cmd_str_len + len(tstr)
+                                              + len(stats)):
+                tstr = "[{0:s}] {1:s}".format(stats, tstr)
+
+            # Add in the return code of the last run, or say why we gave up on
+            # it.
+            if status is not None:
+                tstr = "{0:s} ({1:s})".format(tstr, status.capitalize())
+            elif self.returncode and rcode is not None:
                 if self.screen_width > (13 + self.cmd_str_len + len(tstr)):
-                    tstr = "{0:s} (Return: {1:d})".format(tstr, self._last_return_code)
+                    tstr = "{0:s} (Return: {1:d})".format(tstr, rcode)
                 else:
-                    tstr = "{0:s} (R:{1:d})".format(tstr, self._last_return_code)
+                    tstr = "{0:s} (R:{1:d})".format(tstr, rcode)
 
             # Sort out the position and truncation, and add the text.
             tlen = len(tstr)
             tpos = self.screen_width - tlen
             if tpos < 0:
-                self.screen.addstr(0, 0, tstr[:self.screen_width], mode)
+                text = tstr[:self.screen_width]
             else:
-                self.screen.addstr(0, tpos, tstr, mode)
+                text = text[:tpos] + tstr
         else:
             tpos = self.screen_width
 
@@ -479,10 +4320,17 @@ class WatchLess(object):
             # If the whole command string cannot fit before the date, truncate it
             # and append an ellipsis.
             if self.cmd_str_len > (tpos - 2):
-                self.screen.addstr(0, 0, self.cmd_str[:tpos-5], mode)
-                self.screen.addstr(0, tpos-5, "...", mode)
+                cmd = self.cmd_str[:tpos-5] + "..."
             else:
-                self.screen.addstr(0, 0, self.cmd_str, mode)
+                cmd = self.cmd_str
+            text = cmd + text[len(cmd):]
+
+        # Only draw it if it has changed.
+        if (text, mode) != self._shown_header:
+            self._shown_header = (text, mode)
+            self.screen.addstr(self.top, self.left, text, mode)
+            self._damaged = True
+            self._drawn_bytes += self._byte_length(text)
 
     def process_escape_codes(self, line):
         """Process any ANSI escape codes in the line of text.
@@ -501,231 +4349,1075 @@ class WatchLess(object):
         them in.
 
         """
-        # Not colouring the output, just return the whole line.
+        # Not colouring the output, or nothing to interpret: just return the
+        # whole line in the current style.
         if not self.color:
-            return len(line), [(line, curses.A_NORMAL)]
-
-        # Split into pieces around the escape character.
-        chunks = line.split('\033')
+            return display_width(line), [(line, curses.A_NORMAL)]
+        if '\033' not in line:
+            return display_width(line), [(line, self.cur_escape)]
 
-        # If there was any text before the first escape character, display that
-        # with the escape code from the end of the previous line.
+        # Walk through the escape sequences, keeping the text between them.
         out = []
-        length = len(chunks[0])
-        if chunks[0]:
-            out.append((chunks[0], self.cur_escape))
-
-        for chunk in chunks[1:]:
-            # Delete to end of line. The later processing should take care of
-            # any clearing actually needed, but we don't need to process any
-            # later chunks in the line since they should be cleared...
-            if chunk.startswith('[K'):
-                text = chunk[2:]
+        length = 0
+        pos = 0
+        for match in escape_re.finditer(line):
+            text = line[pos:match.start()]
+            if text:
+                length += display_width(text)
                 out.append((text, self.cur_escape))
-                break
+            pos = match.end()
+
+            # Only select graphic rendition (SGR) sequences change the display
+            # style; anything else (cursor movement, clearing, titles etc.) is
+            # dropped.
+            # The same few sequences tend to be used over and over, so the
+            # result of each is cached.
+            params, final = match.group(1, 2)
+            if final == 'm':
+                key = (params, self._sgr_state)
+                state = self._sgr_cache.get(key)
+                if state is None:
+                    if len(self._sgr_cache) > 4096:
+                        self._sgr_cache.clear()
+                    state = self._sgr_cache[key] = parse_sgr(*key)
+                self._sgr_state = state
+                self.cur_escape = self.palette.attr(state)
+
+        text = line[pos:]
+        if text:
+            length += display_width(text)
+            out.append((text, self.cur_escape))
 
-            # Split out the display codes.
-            code, text = chunk.split('m', 1)
-            codes = [int(c) for c in code[1:].split(';')]
+        # And done.
+        return length, out
 
-            # Reset.
-            if codes[0] == 0:
-                self.cur_escape = curses.A_NORMAL
+    def highlight_differences(self, index, pieces):
+        """Compare a line of new output with the line in the same position in
+        the previous run, and highlight any characters which have changed (or,
+        in cumulative mode, have ever changed).
 
-            # Bold colour.
-            elif codes[0] == 1:
-                self.cur_escape = curses.color_pair(codes[1] - 29) | curses.A_BOLD
+        :param index: The line number of the new output.
+        :param pieces: The (text, displaystyle) list for the line, as returned
+                       by ``process_escape_codes()``.
+        :return: The pieces of the line with the highlighting applied.
 
-            # Normal colour.
-            elif codes[0] == 2:
-                self.cur_escape = curses.color_pair(codes[1] - 29)
+        """
+        line = ''.join([text for text, attr in pieces])
+        if self._old_marks is None:
+            self._new_marks.append(None)
+            return pieces
+        if index < len(self.store):
+            old = self.store.lines[index]
+        else:
+            old = ''
 
-            # Is there actually any text to display from this chunk, or was it
-            # just an update of the display style?
-            if text:
-                length += len(text)
-                out.append((text, self.cur_escape))
+        # Whole-line fast path for the common case of nothing changing.
+        if line == old:
+            mask = None
+        else:
+            mask = changed_cells(old, line)
 
-        # And done.
-        return length, out
+        if self.c_diff and index < len(self._old_marks):
+            old_mask = self._old_marks[index]
+            if old_mask is not None:
+                mask = merge_marks(mask, old_mask, len(line))
 
-    def run(self, screen):
-        """Run the display. This takes control of the execution and blocks until
-        the user stops it.
+        self._new_marks.append(mask)
+        if mask is None:
+            return pieces
+        return highlight_pieces(pieces, mask, curses.A_STANDOUT)
 
-        :param screen: The curses screen to display the content on.
+    def highlight_line_changes(self, parsed):
+        """Compare the lines of new output with those of the previous run,
+        matching up lines which have moved, and highlight the lines inserted
+        and the characters changed in lines which replace others.
+
+        :param parsed: The (text, displaystyle) lists for the lines, as
+                       returned by ``process_escape_codes()``.
+        :return: The pieces of each line with the highlighting applied.
 
         """
-        # Wrap the whole thing in a try-except block so we can detect the user
-        # pressing Ctrl-C to exit.
-        try:
-            # Save the screen for future reference.
-            self.screen = screen
+        if self._old_marks is None:
+            self._new_marks = [None] * len(parsed)
+            return parsed
+        lines = [''.join([text for text, attr in pieces]) for pieces in parsed]
+        self._new_marks = masks = line_changes(self.store.lines, lines)
+        return [pieces if mask is None else
+                highlight_pieces(pieces, mask, curses.A_STANDOUT)
+                for pieces, mask in zip(parsed, masks)]
 
-            # If this terminal supports colours, tell it to use its default
-            # colours for this screen.
-            if curses.has_colors():
-                curses.use_default_colors()
-
-                # If we're going to display colours, set them up.
-                if self.color:
-                    curses.init_pair(1, curses.COLOR_BLACK, -1)
-                    curses.init_pair(2, curses.COLOR_RED, -1)
-                    curses.init_pair(3, curses.COLOR_GREEN, -1)
-                    curses.init_pair(4, curses.COLOR_YELLOW, -1)
-                    curses.init_pair(5, curses.COLOR_BLUE, -1)
-                    curses.init_pair(6, curses.COLOR_MAGENTA, -1)
-                    curses.init_pair(7, curses.COLOR_CYAN, -1)
-                    curses.init_pair(8, curses.COLOR_WHITE, -1)
-
-            # Disable the cursor if possible.
-            try:
-                curses.curs_set(0)
-            except curses.error:
-                # Try to set it to 'normal' rather than 'very visible' if we
-                # can.
+    def _byte_length(self, text):
+        """The number of bytes needed to send some text to the terminal."""
+        if self.decode:
+            return len(text.encode(self.decode, 'replace'))
+        return len(text)
+
+    def draw_content(self):
+        """Draw the visible window of the output onto the screen. Only the
+        lines and columns which can actually be seen are drawn, so the cost
+        depends on the size of the terminal rather than that of the output.
+        Rows whose contents are the same as those already on the screen are
+        skipped.
+
+        """
+        start = clock()
+        store = self.store if self._past is None else self._past
+        width = self.page_width + 1
+        shown = self._shown
+        rows = self.screen_height + 1 - self.content_y
+        if len(shown) != rows:
+            shown[:] = [None] * rows
+        search = self.search
+        if search is not None and search.store is not store:
+            search = None
+
+        # The timings overlay covers the top of the output.
+        overlay = []
+        if self.show_stats:
+            overlay = [[(text[:width], curses.A_REVERSE)]
+                       for text in self.stats_lines(width)]
+
+        for i in range(rows):
+            index = self.y + i
+            if i < len(overlay):
+                segments = overlay[i]
+            elif index < len(store):
+                spans = search is not None and search.spans(index)
+                if spans:
+                    segments = self.search_segments(store, index, spans, width)
+                else:
+                    segments = store.segments(index, self.x, width)
+            else:
+                segments = []
+            if segments == shown[i]:
+                continue
+            shown[i] = segments
+            self._damaged = True
+
+            # Clear anything left over from the previous contents of the row.
+            # When sharing the screen, it is overwritten with spaces instead so
+            # that anything to our right is left alone.
+            row = self.top + self.content_y + i
+            col = 0
+            if self.region is None:
+                self.screen.move(row, 0)
+                self.screen.clrtoeol()
+            for text, attr in segments:
+                self._drawn_bytes += self._byte_length(text)
+                # Writing to the bottom-right corner of the screen leaves the
+                # cursor with nowhere to go, which curses reports as an error
+                # even though the text was written.
                 try:
-                    curses.curs_set(1)
+                    self.screen.addstr(row, self.left + col, text, attr)
                 except curses.error:
                     pass
+                col += display_width(text)
+            if self.region is not None and col < width:
+                self._drawn_bytes += width - col
+                try:
+                    self.screen.addstr(row, self.left + col, ' ' * (width - col))
+                except curses.error:
+                    pass
+        self.stats.add('draw', clock() - start)
+
+    def stats_lines(self, width):
+        """Format the timings of the stages of the main loop for the overlay.
+
+        :return: A list of lines of text, padded to the given width.
+
+        """
+        summary = self.stats.summary()
+        lines = ['{0:8s} {1:>9s} {2:>9s} {3:>9s} {4:>7s}'.format(
+            'ms', 'last', 'mean', 'p99', 'count')]
+        for stage in Stats.stages:
+            if stage in summary:
+                s = summary[stage]
+                lines.append('{0:8s} {1:9.3f} {2:9.3f} {3:9.3f} {4:7d}'.format(
+                    stage, s['last'] * 1000, s['mean'] * 1000,
+                    s['p99'] * 1000, s['count']))
+        memory = self.store.memory()
+        if self._past is not None:
+            memory += self._past.memory()
+        line = 'lines/s {0:.0f}  output {1:.1f}KiB'.format(
+            self.stats.lines_per_second(), memory / 1024.0)
+        if self.history is not None:
+            line += '  history {0:.1f}KiB ({1:d} runs)'.format(
+                self.history.size / 1024.0, len(self.history))
+        lines.append(line)
+        return [line.ljust(width) for line in lines]
+
+    def start(self, screen):
+        """Prepare to display on a screen. The screen must already have been
+        set up; see ``setup_screen()``.
+
+        """
+        self.screen = screen
+        self.calculate_sizes()
+
+        # Show the header so the user knows things have started up.
+        self.update_header()
+        self.dirty = True
+
+    def update(self):
+        """Check for output from the command, and process it. Call this once
+        for every trip around the main loop.
+
+        :return: ``False`` if the command failed and we should exit as a result,
+                 ``True`` otherwise.
+
+        """
+        # Carry on searching the output, a chunk at a time.
+        if self.search is not None and not self.search.complete:
+            self.search.scan()
+
+        rcode, output = self._read_output()
+
+        # Process has finished.
+        if rcode is not None:
+            self._run_lines, marker, spill, same = self._finish_run(rcode)
+
+            # Non-zero return code. Runs cancelled by the user don't count.
+            if rcode != 0 and self._last_status != 'cancelled':
+                if self.beep:
+                    sys.stdout.write(chr(7))
+                    sys.stdout.flush()
+                if self.errexit:
+                    return False
+
+            # If the output is exactly the same as last time, there's nothing to
+            # do but update the header. This doesn't apply if differences from
+            # the run before last are highlighted, as they need clearing.
+            unchanged = same and not self._highlighted
+            if unchanged:
+                self.unchanged_runs += 1
+            else:
+                self.unchanged_runs = 0
+                self.changed_at = self.header_time
+                self._spill = spill
+                self._raw_lines, self._raw_marker = self._run_lines, marker
+                self._process_output()
 
-            # Enter no-delay mode so that getch() is non-blocking.
-            self.screen.nodelay(True)
+            # Add the run to the history, and refresh the view of it if the
+            # user is comparing the latest run against a past one.
+            if self.history is not None:
+                info = (self.header_time, rcode, self._last_status)
+                if same and len(self.history):
+                    self.history.repeat(info)
+                else:
+                    self.history.add(self._run_lines, info)
+                if self._viewing is not None and \
+                        self._viewing < self.history.first:
+                    self._viewing = self.history.first
+                if self._compare is not None and \
+                        self._compare < self.history.first:
+                    self._compare = None
+                if self._viewing is None and self._compare is not None and \
+                        not unchanged:
+                    self.show_run(None)
+
+            self._run_lines = []
+
+            # Prepare for the refresh.
+            if unchanged:
+                self.update_header()
+            else:
+                self._show_store()
+            if self.show_stats:
+                self.dirty = True
+
+        return True
+
+    def _read_output(self, keep=True):
+        """Check on the command with ``process_command()``, timing it. Any
+        output is hashed as it comes in, so we can tell if it is the same as
+        the last run's, and (if ``keep``) kept until the run is finished.
+
+        :return: The tuple (return_code, output) from ``process_command()``.
+
+        """
+        start = clock()
+        rcode, output = self.process_command()
+        if output:
+            self.stats.lines += len(output)
+            if keep:
+                self.capture.add(output)
+            if self._hash_runs:
+                self._hash_output(output)
+        self._read_time += clock() - start
+        return rcode, output
+
+    def _finish_run(self, rcode):
+        """Do what is needed for every run when it finishes, with or without
+        a display: collect its output, record its timings, add it to any
+        recording, and work out if its output was the same as the last run's,
+        adapting the interval to that.
+
+        :return: A tuple (lines, marker, spill, same) of the output kept, and
+                 the line saying how much was left out and the ``Spill`` of
+                 those lines as for ``Capture.finish()``, and whether the
+                 output was the same as the last run's.
+
+        """
+        self._last_return_code = rcode
+        lines, marker, spill = self.capture.finish()
+        self.stats.add('read', self._read_time)
+        self._read_time = 0.0
+        if self.run_duration is not None:
+            self.stats.add('run', self.run_duration)
+        if self.record is not None:
+            self.record.add(self.finished_at, self.run_duration, rcode,
+                            self._last_status, lines, self.decode or 'utf-8')
+
+        same = False
+        if self._hash_runs:
+            digest = self._run_hash.digest()
+            self._run_hash = hashlib.sha1()
+            same = digest == self._last_digest
+            self._last_digest = digest
+            self.adapt_interval(not same)
+        return lines, marker, spill, same
+
+    @contextlib.contextmanager
+    def _headless(self):
+        """Set up for a main loop without a display, for ``run_stream()`` and
+        ``run_serve()``, and clean up afterwards. Being terminated (e.g., by a
+        supervisor) exits cleanly, so the command is cleaned up too, and
+        Ctrl-C ends the loop. Only the interval needs hashing the output.
+
+        """
+        def terminate(signum, frame):
+            raise SystemExit(128 + signum)
+        signal.signal(signal.SIGTERM, terminate)
+        self._hash_runs = self.scheduler.adaptive
+
+        try:
+            if self.event_loop:
+                self._wakeup = Wakeup()
+            yield
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self._wakeup is not None:
+                self._wakeup.close()
+                self._wakeup = None
+
+    def _wait_headless(self, fds=(), timeout=None):
+        """Wait for output, the command to exit or the next run without a
+        display, or for any of some other file descriptors to be readable, for
+        at most ``timeout`` seconds (``None`` for no extra limit).
+
+        :return: The file descriptors which are ready.
+
+        """
+        wait_fds, wait_timeout = self.wait_fds()
+        wait_fds.extend(fds)
+        if self._wakeup is not None:
+            wait_fds.append(self._wakeup.fd)
+        if not self.event_loop:
+            wait_timeout = 0.01
+        elif timeout is not None and (wait_timeout is None or
+                                      wait_timeout > timeout):
+            wait_timeout = timeout
+        ready = wait_readable(wait_fds, wait_timeout)
+        if self._wakeup is not None and self._wakeup.fd in ready:
+            self._wakeup.drain()
+        return ready
+
+    def _hash_output(self, output):
+        """Add lines of output to the hash of the current run's output."""
+        data = '\n'.join(output) + '\n'
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8', 'replace')
+        self._run_hash.update(data)
+
+    def adapt_interval(self, changed):
+        """Back off the interval after a run whose output was the same as the
+        last run's, or go back to the minimum interval if it changed (or the
+        user pressed a key), if the interval is adaptive.
+
+        """
+        if self.scheduler.adaptive and self.replay is None and \
+                self.attach is None and self.scheduler.adapt(changed):
+            self._interval_title()
+
+    def _process_output(self):
+        """Process the output of a finished run for display, and switch it
+        in as the latest output.
+
+        """
+        # Plain output can be added to the store in one go. Otherwise, process
+        # it line by line, then highlight any differences from the previous
+        # run. The two are done separately so they can be timed.
+        new_store = self._new_store
+        start = clock()
+        lines, marker = self.filtered(self._raw_lines, self._raw_marker)
+        stage = 'parse'
+        if not (self.color or self.differences):
+            new_store.extend(lines)
+        elif not self.differences:
+            for line in lines:
+                new_store.append(self.process_escape_codes(line)[1])
+        else:
+            parsed = [self.process_escape_codes(line)[1] for line in lines]
+            self.stats.add('parse', clock() - start)
+            start = clock()
+            stage = 'diff'
+            if self.l_diff:
+                for pieces in self.highlight_line_changes(parsed):
+                    new_store.append(pieces)
+            else:
+                for index, pieces in enumerate(parsed):
+                    new_store.append(self.highlight_differences(index, pieces))
+        self.stats.add(stage, clock() - start)
+
+        # Make the line saying how much output was left out stand out.
+        if marker is not None:
+            new_store.restyle(marker, curses.A_REVERSE)
+
+        # Switch the line stores over.
+        self.store, self._new_store = new_store, self.store
+
+        # Keep the highlighting of this run to diff the next one against. In
+        # sequential mode, note whether anything is highlighted.
+        self._old_marks, self._new_marks = self._new_marks, []
+        self._highlighted = self.differences and not self.c_diff and \
+            any([mask is not None for mask in self._old_marks])
+
+        # Keep the view on the match the user moved to, if searching.
+        if self.search is not None and self._past is None:
+            self.follow_search(self._new_store.lines)
+
+        # Prepare the other store for the next run.
+        self._new_store.clear()
+        self._sgr_state = default_sgr
+        self.cur_escape = curses.A_NORMAL
+
+    def filtered(self, lines, marker=None):
+        """Pass the lines of a run's output through the filter, if it is
+        turned on. The line saying how much output was left out is kept, with
+        the lines before and after it filtered separately.
+
+        :return: A tuple (lines, marker) of the filtered lines and the new line
+                 number of that line.
+
+        """
+        if not self.filtering:
+            return lines, marker
+        apply = self.line_filter.apply
+        if marker is None:
+            return apply(lines), None
+        head = apply(lines[:marker])
+        return head + [lines[marker]] + apply(lines[marker + 1:]), len(head)
 
-            # Create a pad for the output of the command.
-            self.pad = curses.newpad(1, 1)
+    def refilter(self):
+        """Filter the latest output again after the filter has changed, without
+        running the command again. Differences are not highlighted, as the
+        output hasn't really changed.
 
-            # And a second one for new output.
-            newpad = curses.newpad(1, 1)
+        """
+        self._old_marks = None
+        self._process_output()
+        self.show_run(self._viewing)
 
-            # State variables used when updating the new pad.
-            new_h = 0
-            new_w = 0
-            cur_l = 0
+    def toggle_filter(self):
+        """Turn the filter on or off."""
+        if not self.line_filter:
+            self.message = 'No filter given'
+            self.update_header()
+            return
+        self.filtering = not self.filtering
+        self.refilter()
 
-            # Calculate size of page area etc.
-            self.calculate_sizes()
+    def set_include(self, pattern):
+        """Change the pattern lines must match to be shown, as typed by the
+        user after pressing ``&``. An empty pattern shows all the lines again.
 
-            # Show the header so the user knows things have started up.
+        """
+        try:
+            if self.line_filter is None:
+                line_filter = Filter(include=pattern or None)
+            else:
+                line_filter = self.line_filter.replace(include=pattern or None)
+        except ValueError:
+            self.message = 'Invalid pattern: {0!s}'.format(sys.exc_info()[1])
             self.update_header()
-            self.screen.refresh()
+            return
+        self.line_filter = line_filter
+        self.filtering = bool(line_filter)
+        self.refilter()
+
+    def _show_store(self):
+        """Update the display for a change in the output shown, which is
+        that of a past run if the user has chosen one, otherwise the latest.
+
+        """
+        store = self.store if self._past is None else self._past
+        if self.search is not None and self.search.store is not store:
+            self.search.reset(store)
+        self.content_width = store.width
+        self.content_height = len(store)
+        self.calculate_sizes()
+        self.update_header()
+        self.dirty = True
+
+    def show_run(self, serial):
+        """Show the output of a past run from the history, highlighting the
+        differences from the run being compared against (if the user has
+        picked one) or the run before it (if showing differences).
+
+        :param serial: The serial number of the run in the history, or
+                       ``None`` to go back to showing the latest output.
+
+        """
+        self._viewing = serial
+        if serial is None and self._compare is None:
+            self._past = None
+            self._show_store()
+            return
+
+        # The latest run, when compared against a chosen past run.
+        history = self.history
+        if serial is None:
+            serial = history.first + len(history) - 1
+        if self._compare is not None:
+            base = self._compare
+        elif self.differences and serial > history.first:
+            base = serial - 1
+        else:
+            base = None
+
+        # Run the lines through the same processing as the live output. The
+        # escape code state is saved in case a run is in progress.
+        state = self._sgr_state, self.cur_escape
+        if base is not None:
+            self._sgr_state, self.cur_escape = default_sgr, curses.A_NORMAL
+            old = [''.join([text for text, attr in
+                            self.process_escape_codes(line)[1]])
+                   for line in self.filtered(history.lines(base))[0]]
+        self._sgr_state, self.cur_escape = default_sgr, curses.A_NORMAL
+        parsed = [self.process_escape_codes(line)[1]
+                  for line in self.filtered(history.lines(serial))[0]]
+        self._sgr_state, self.cur_escape = state
+
+        masks = [None] * len(parsed)
+        if base is not None:
+            lines = [''.join([text for text, attr in pieces])
+                     for pieces in parsed]
+            if self.l_diff:
+                masks = line_changes(old, lines)
+            else:
+                masks = [changed_cells(old[i] if i < len(old) else '', line)
+                         for i, line in enumerate(lines)]
+        store = LineStore()
+        for pieces, mask in zip(parsed, masks):
+            if mask is not None:
+                pieces = highlight_pieces(pieces, mask, curses.A_STANDOUT)
+            store.append(pieces)
+
+        self._past = store
+        self._show_store()
+
+    def step_history(self, step):
+        """Move through the history of past runs, by one run backwards
+        (``step=-1``) or forwards (``step=1``). Moving forwards past the last
+        run goes back to showing the latest output.
+
+        """
+        history = self.history
+        if not history:
+            return
+        last = history.first + len(history) - 1
+        if self._viewing is None:
+            serial = last + step
+        else:
+            serial = self._viewing + step
+        serial = max(serial, history.first)
+        if serial >= last and step > 0:
+            serial = None
+        self.show_run(serial)
+
+    def toggle_compare(self):
+        """Pick the run being shown as the one to compare others against, or
+        if one has been picked already, go back to comparing each run with the
+        one before it.
+
+        """
+        if not self.history:
+            return
+        if self._compare is not None:
+            self._compare = None
+        elif self._viewing is not None:
+            self._compare = self._viewing
+        else:
+            self._compare = self.history.first + len(self.history) - 1
+        self.show_run(self._viewing)
+
+    def redraw(self):
+        """Redraw the content if it needs it."""
+        if self.dirty:
+            # Ensure the position is kept within limits.
+            self.y = max(min(self.y, self.bottom), 0)
+            self.x = max(min(self.x, self.right), 0)
+
+            # Redraw whatever has changed and we're done.
+            self.draw_content()
+            self.dirty = False
+
+    def refresh(self):
+        """Update the physical screen with everything drawn, timing it."""
+        start = clock()
+        self.screen.noutrefresh()
+        curses.doupdate()
+        self.stats.add('refresh', clock() - start)
+
+    def mark_refreshed(self):
+        """Record that the physical screen is about to be updated.
+
+        :return: Whether we drew anything which needs the update.
+
+        """
+        if not self._damaged:
+            return False
+        self.refresh_bytes = self._drawn_bytes
+        self.total_refresh_bytes += self._drawn_bytes
+        self._drawn_bytes = 0
+        self._damaged = False
+        return True
+
+    def run(self, screen):
+        """Run the display. This takes control of the execution and blocks until
+        the user stops it.
+
+        :param screen: The curses screen to display the content on.
+
+        """
+        # Wrap the whole thing in a try-except block so we can detect the user
+        # pressing Ctrl-C to exit.
+        try:
+            setup_screen(screen, self.palette if self.color else None)
+
+            # Take over resize and child exit notifications so they can wake
+            # the event loop.
+            if self.event_loop:
+                self._wakeup = Wakeup()
+
+            self.start(screen)
 
             # Keep going as long as we need to.
-            first_run = True
             while True:
                 # Handle any key presses.
-                self.handle_keys()
+                while self.handle_keys():
+                    pass
 
                 # Check for output.
-                rcode, output = self.process_command()
+                if not self.update():
+                    break
+
+                # Redraw, and update the physical screen if anything was drawn.
+                self.redraw()
+                if self.mark_refreshed():
+                    self.refresh()
+
+                # Wait until there is something else to do.
+                self.wait_for_events()
+
+        # User pressed Ctrl-C.
+        except KeyboardInterrupt:
+            pass
+
+        # Clean up the resize notification and any processes.
+        finally:
+            self.close()
+            if self._wakeup is not None:
+                self._wakeup.close()
+                self._wakeup = None
+
+    def run_stream(self, out=None):
+        """Run the command without a display, writing its output to a file
+        (normally stdout) as a stream. Curses is not used at all, so this works
+        when there is no terminal, e.g., in a pipeline or from cron. Blocks
+        until the user stops it, the output can no longer be written, or the
+        command fails and ``errexit`` is set.
+
+        The format of the output is given by ``stream``:
+
+            * ``'full'``: each line of output as it arrives, with a line
+              giving the time, duration and return code after each run.
+            * ``'diff'``: after each run, a unified-diff style hunk with the
+              lines which changed since the previous run, or nothing if none
+              did.
+            * ``'json'``: after each run, a JSON object on a line of its own,
+              with the time the run finished, its duration, return code,
+              status and output.
+
+        Colour and style escape codes in the output are passed through as-is.
+
+        :return: The exit status for the program: the return code of the failed
+                 run if exiting due to ``errexit``, otherwise zero.
+
+        """
+        if out is None:
+            out = sys.stdout
+        mode = self.stream or 'full'
+
+        # Filters which need the whole of a run's output (sorting, and leaving
+        # out repeated lines) hold back the output until the run is finished.
+        whole = self.filtering and not self.line_filter.streamable
+        keep = mode != 'full' or self.record is not None or whole
 
-                # New output.
+        # The reader going away (e.g., piped into head) stops it too.
+        with self._headless():
+            try:
+                return self._stream_runs(out, mode, whole, keep)
+            except (IOError, OSError):
+                if sys.exc_info()[1].errno != errno.EPIPE:
+                    raise
+        return 0
+
+    def _stream_runs(self, out, mode, whole, keep):
+        """The main loop of ``run_stream()``, writing to ``out`` in the given
+        mode.
+
+        :param whole: Whether to hold back the output until each run is
+                      finished, for filters which need all of it.
+        :param keep: Whether the whole of each run's output is needed.
+
+        """
+        previous = []
+        runs = 0
+        while True:
+            rcode, output = self._read_output(keep)
+            if mode == 'full' and not whole:
+                if self.filtering:
+                    output = self.line_filter.apply(output)
                 if output:
-                    # Increase the height of the pad to suit.
-                    new_h += len(output)
-                    newpad.resize(new_h + 1, new_w + 1)
-
-                    # Process the output line by line.
-                    for line in output:
-                        newpad.move(cur_l, 0)
-                        linelen, pieces = self.process_escape_codes(line)
-                        line = pieces[0][0]
-
-                        # Increase the width of the output if needed.
-                        if linelen > new_w:
-                            new_w = linelen
-                            newpad.resize(new_h + 1, new_w + 1)
-
-                        # If we are doing a diff, we need to add the output
-                        # character by character.
-                        if self.differences and not first_run:
-                            for piece, rawattr in pieces:
-                                for x, c in enumerate(piece):
-                                    # Get the character previously in this position.
-                                    # The lower 8 bits of the returned value is the
-                                    # character itself, the rest is the display
-                                    # attributes.
-                                    temp = self.pad.inch(cur_l, x)
-
-                                    # If we are doing a cumulative diff, we start
-                                    # with the previous attributes, otherwise we
-                                    # start from normal.
-                                    if self.c_diff:
-                                        attr = temp & ~0xFF
-                                    else:
-                                        attr = curses.A_NORMAL
-
-                                    # Highlight the display if the new character
-                                    # differs from the old.
-                                    c = ord(c)
-                                    oldc = temp & 0xFF
-                                    if c != oldc:
-                                        attr |= curses.A_STANDOUT
-
-                                    # Add this character.
-                                    newpad.addch(c, attr)
-
-                        # Not doing a diff, we can just add the line.
-                        else:
-                            for piece, attr in pieces:
-                                newpad.attron(attr)
-                                newpad.addstr(piece)
-                                newpad.attroff(attr)
-
-                        # Done with this line.
-                        cur_l += 1
-
-                # Process has finished.
+                    out.write('\n'.join(output))
+                    out.write('\n')
+
+            if rcode is not None:
+                runs += 1
+                status = self._last_status or rcode
+                lines, marker = self._finish_run(rcode)[:2]
+                lines = self.filtered(lines, marker)[0]
+                if mode == 'full':
+                    if whole and lines:
+                        out.write('\n'.join(lines))
+                        out.write('\n')
+                    out.write('--- run {0:d} at {1:s} took {2:.3f}s: '
+                              '{3!s}\n'.format(runs, time.strftime(
+                                  '%Y-%m-%dT%H:%M:%S', self.header_time),
+                                  self.run_duration, status))
+                elif mode == 'diff':
+                    out.write(self._stream_diff(previous, lines, runs,
+                                                status))
+                else:
+                    out.write(json.dumps({
+                        'time': self.finished_at,
+                        'duration': self.run_duration,
+                        'returncode': rcode,
+                        'status': self._last_status,
+                        'output': lines,
+                    }))
+                    out.write('\n')
+                out.flush()
+                previous = lines
+
+                if rcode != 0 and self.errexit and \
+                        self._last_status != 'cancelled':
+                    return rcode
+
+                # The end of a recording being replayed.
+                if self.replay is not None and \
+                        self._replay_pos >= len(self.replay):
+                    return 0
+
+            # The server being attached to has gone away.
+            if self.attach is not None and self.attach.closed and \
+                    not self._attach_queue:
+                return 0
+
+            # Wait for output, the command to exit, or the next run.
+            self._wait_headless()
+
+    def run_serve(self):
+        """Run the command without a display, sending each run to the viewers
+        attached to ``serve`` (see ``Server``). However many viewers there
+        are, the command is only run once each interval. Blocks until the user
+        stops it or the command fails and ``errexit`` is set.
+
+        :return: The exit status for the program: the return code of the failed
+                 run if exiting due to ``errexit``, otherwise zero.
+
+        """
+        server = self.serve
+        with self._headless():
+            while True:
+                rcode, output = self._read_output()
                 if rcode is not None:
-                    self._last_return_code = rcode
-
-                    # Non-zero return code.
-                    if rcode != 0:
-                        if self.beep:
-                            sys.stdout.write(chr(7))
-                            sys.stdout.flush()
-                        if self.errexit:
-                            break
-
-                    # Switch the pads over.
-                    self.pad, newpad = newpad, self.pad
-                    self.content_width = new_w
-                    self.content_height = new_h
-
-                    # Prepare for the refresh.
-                    self.calculate_sizes()
-                    self.screen.clear()
-                    self.update_header()
-                    self.dirty = True
-
-                    # Prepare the 'new' pad for the next run.
-                    newpad.clear()
-                    first_run = False
-                    new_w = 0
-                    new_h = 0
-                    cur_l = 0
-                    self.cur_escape = curses.A_NORMAL
-
-                # We need to refresh the screen.
-                if self.dirty:
-                    # Ensure the position is kept within limits.
-                    self.y = max(min(self.y, self.bottom), 0)
-                    self.x = max(min(self.x, self.right), 0)
-
-                    # Redraw and we're done.
-                    self.screen.refresh()
-                    self.pad.refresh(self.y, self.x, self.content_y, 0, self.screen_height,
-                                     self.screen_width)
-                    self.dirty = False
-
-                # Sleep a bit to avoid hogging all the CPU.
-                time.sleep(0.01)
+                    lines = self._finish_run(rcode)[0]
+                    server.publish(self.finished_at, self.run_duration, rcode,
+                                   self._last_status, lines,
+                                   self.scheduler.interval)
+                    if rcode != 0 and self.errexit and \
+                            self._last_status != 'cancelled':
+                        return rcode
+
+                # Wait for output, the command to exit, the next run or a
+                # viewer. Data waiting to be sent to viewers which weren't
+                # ready for it is tried again shortly.
+                timeout = None
+                if server.pending():
+                    timeout = 0.05
+                server.handle(self._wait_headless(server.fds(), timeout))
+        return 0
+
+    def _stream_diff(self, old, new, run, status):
+        """Format the lines which changed between two runs for
+        ``run_stream()``, as a unified-diff style hunk comparing the lines in
+        the same positions (or, with ``--differences=lines``, matching up
+        lines which have moved).
+
+        """
+        out = []
+        if self.l_diff:
+            for old_start, old_end, new_start, new_end in \
+                    match_lines(old, new):
+                out.extend(['-' + line for line in old[old_start:old_end]])
+                out.extend(['+' + line for line in new[new_start:new_end]])
+        else:
+            for i in range(max(len(old), len(new))):
+                a = old[i] if i < len(old) else None
+                b = new[i] if i < len(new) else None
+                if a == b:
+                    continue
+                if a is not None:
+                    out.append('-' + a)
+                if b is not None:
+                    out.append('+' + b)
+        if not out:
+            return ''
+        out.insert(0, '@@ run {0:d} at {1:s}: {2!s} @@'.format(
+            run, time.strftime('%Y-%m-%dT%H:%M:%S', self.header_time),
+            status))
+        out.append('')
+        return '\n'.join(out)
+
+class MultiWatch(object):
+    """Watch several commands at once, each in its own pane of the screen. Each
+    pane is a WatchLess instance with its own settings and scroll position;
+    they share the screen, the event loop and an optional limit on how many
+    commands can be running at once. The Tab and Shift-Tab keys move the
+    keyboard focus between the panes.
+
+    """
+
+    def __init__(self, watches, layout='stacked', max_running=None):
+        """
+        :param watches: A list of WatchLess instances, one per pane.
+        :param layout: How to arrange the panes: ``'stacked'`` one above the
+                       other, or ``'tiled'`` in a grid.
+        :param max_running: The maximum number of commands which may be
+                            running at once, or ``None`` for no limit.
+
+        """
+        self.watches = list(watches)
+        self.layout = layout
+        self.slots = RunSlots(max_running)
+        self.palette = Palette()
+        for watch in self.watches:
+            watch.slots = self.slots
+            watch.palette = self.palette
+        self.event_loop = all([watch.event_loop for watch in self.watches])
+        self.focus = 0
+        self.screen = None
+        self._wakeup = None
+
+    @classmethod
+    def from_arguments(klass, program_name, *args):
+        """Factory method which takes a set of command line arguments with
+        the commands separated by '::' and returns an instance set up as per
+        those arguments. Options given before the first command apply to the
+        later ones as well, unless overridden. Help and errors are handled as
+        for ``WatchLess.from_arguments()``.
+
+        """
+        groups = [[]]
+        for arg in args:
+            if arg == '::':
+                groups.append([])
+            else:
+                groups[-1].append(arg)
+
+        parser.prog = program_name
+        options, command = WatchLess.parse_arguments(groups[0])
+        parsed = [(options, command)]
+        for group in groups[1:]:
+            parsed.append(WatchLess.parse_arguments(group, options))
+
+        # A recording holds the runs of one command, and serving and
+        # streaming need the whole process (and stdout) to themselves. Stdout
+        # not being a terminal means streaming.
+        if not sys.stdout.isatty():
+            sys.stdout.write('Error: only one command can be streamed, and '
+                             'stdout is not a terminal.\n')
+            raise SystemExit(1)
+        for name, verb in (('record', 'recorded'), ('replay', 'replayed'),
+                           ('serve', 'served'), ('stream', 'streamed')):
+            if any(getattr(group_options, name)
+                   for group_options, group_command in parsed):
+                sys.stdout.write('Error: only one command can be {0:s}.\n'
+                                 .format(verb))
+                raise SystemExit(1)
+
+        watches = [WatchLess.from_options(*args) for args in parsed]
+        return klass(watches, layout=options.layout,
+                     max_running=options.max_running)
+
+    def layout_panes(self):
+        """Divide the screen up between the panes."""
+        rows, cols = self.screen.getmaxyx()
+        count = len(self.watches)
+        if self.layout == 'tiled':
+            ncols = int(math.ceil(math.sqrt(count)))
+        else:
+            ncols = 1
+        nrows = int(math.ceil(count / float(ncols)))
+
+        for i, watch in enumerate(self.watches):
+            row, col = divmod(i, ncols)
+            top = rows * row // nrows
+            left = cols * col // ncols
+            height = rows * (row + 1) // nrows - top
+            width = cols * (col + 1) // ncols - left
+
+            # Leave a gap between panes side by side.
+            if col < ncols - 1:
+                width -= 1
+            watch.region = (top, left, height, width)
+
+    def set_focus(self, index):
+        """Give the keyboard focus to one of the panes."""
+        self.watches[self.focus].focused = False
+        self.watches[self.focus].update_header()
+        self.focus = index % len(self.watches)
+        self.watches[self.focus].focused = True
+        self.watches[self.focus].update_header()
+
+    def handle_keys(self):
+        """Receive a key pressed by the user, and either act on it or pass it
+        on to the pane with the focus.
+
+        :return: ``False`` if there were no keys waiting, ``True`` otherwise.
+
+        """
+        key = self.screen.getch()
+        if key == -1:
+            return False
+        if self.watches[self.focus].prompt is not None:
+            self.watches[self.focus].handle_key(key)
+        elif key == ord('\t'):
+            self.set_focus(self.focus + 1)
+        elif key == curses.KEY_BTAB:
+            self.set_focus(self.focus - 1)
+        elif key == curses.KEY_RESIZE:
+            self.handle_resize()
+        else:
+            self.watches[self.focus].handle_key(key)
+        return True
+
+    def handle_resize(self):
+        """Lay the panes out again after the terminal has been resized."""
+        self.screen.clear()
+        self.layout_panes()
+        for watch in self.watches:
+            watch.invalidate()
+
+    def wait_for_events(self):
+        """Block until any of the panes has something to do, or a key is
+        pressed or the terminal is resized.
+
+        """
+        if not self.event_loop:
+            time.sleep(0.01)
+            return
+
+        fds = [sys.stdin.fileno(), self._wakeup.fd]
+        timeout = None
+        for watch in self.watches:
+            watch_fds, watch_timeout = watch.wait_fds()
+            fds.extend(watch_fds)
+            if watch_timeout is not None:
+                if timeout is None or watch_timeout < timeout:
+                    timeout = watch_timeout
+
+        ready = wait_readable(fds, timeout)
+        if self._wakeup.fd in ready:
+            if b'w' in self._wakeup.drain() and resize_terminal():
+                self.handle_resize()
+
+    def run(self, screen):
+        """Run the display. This takes control of the execution and blocks until
+        the user stops it.
+
+        :param screen: The curses screen to display the panes on.
+
+        """
+        try:
+            self.screen = screen
+            setup_screen(screen, self.palette)
+            if self.event_loop:
+                self._wakeup = Wakeup()
+            for watch in self.watches:
+                watch._wakeup = self._wakeup
+
+            self.layout_panes()
+            for watch in self.watches:
+                watch.start(screen)
+            self.set_focus(self.focus)
+
+            while True:
+                while self.handle_keys():
+                    pass
+
+                for watch in self.watches:
+                    if not watch.update():
+                        return
+
+                # Redraw all the panes, then update the physical screen once.
+                for watch in self.watches:
+                    watch.redraw()
+                refreshed = [watch for watch in self.watches
+                             if watch.mark_refreshed()]
+                if refreshed:
+                    start = clock()
+                    self.screen.noutrefresh()
+                    curses.doupdate()
+                    spent = clock() - start
+                    for watch in refreshed:
+                        watch.stats.add('refresh', spent)
+
+                self.wait_for_events()
 
-        # User pressed Ctrl-C.
         except KeyboardInterrupt:
             pass
 
+        finally:
+            for watch in self.watches:
+                watch.close()
+                watch._wakeup = None
+            if self._wakeup is not None:
+                self._wakeup.close()
+                self._wakeup = None
 
 if __name__ == '__main__':
-    wl = WatchLess.from_arguments(*sys.argv)
+    if '::' in sys.argv[1:]:
+        wl = MultiWatch.from_arguments(*sys.argv)
+    else:
+        wl = WatchLess.from_arguments(*sys.argv)
+        if wl.serve:
+            raise SystemExit(wl.run_serve())
+        if wl.stream:
+            raise SystemExit(wl.run_stream())
     curses.wrapper(wl.run)